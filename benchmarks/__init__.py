@@ -0,0 +1,11 @@
+"""
+Benchmarks for nc2nc and nccompress
+
+Synthetic datasets are made by benchmarks.datasets, and the throughput
+of nc2nc, nccompress and nccopy over a grid of options is measured by
+benchmarks.run, which records the results as JSON. Run
+
+    python -m benchmarks.run -h
+
+for the options.
+"""
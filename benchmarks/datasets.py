@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Reproducible synthetic netCDF datasets for benchmarking. The same seed
+and scale always give the same file contents.
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import os
+
+# Datasets available to the benchmarks. Shapes are (time, lat, lon) at scale 1,
+# and are multiplied by the scale along the horizontal dimensions
+datasets = {
+    'smooth' : {'kind' : 'smooth', 'shape' : (12, 90, 180)},
+    'noisy' : {'kind' : 'noisy', 'shape' : (12, 90, 180)},
+    'masked' : {'kind' : 'masked', 'shape' : (12, 90, 180)},
+    'record' : {'kind' : 'smooth', 'shape' : (12, 90, 180), 'unlimited' : True},
+    'manyvars' : {'kind' : 'smooth', 'shape' : (2, 45, 90), 'nvars' : 100},
+}
+
+def scaled_shape(shape, scale):
+    """ Return shape with the last two (horizontal) dimensions multiplied by scale
+
+    >>> scaled_shape((12, 90, 180), 2)
+    (12, 180, 360)
+    """
+    return tuple(shape[:-2]) + tuple(max(int(n*scale), 1) for n in shape[-2:])
+
+def make_field(shape, kind='smooth', seed=0):
+    """ Return a float32 array of shape (time, lat, lon). kind is smooth, a sum of
+        waves which compresses well, noisy, which is smooth plus random noise and
+        compresses poorly, or masked, which is smooth with a land mask where the
+        values are masked
+    """
+
+    rng = np.random.RandomState(seed)
+    nt, ny, nx = shape
+    t = np.arange(nt).reshape(nt, 1, 1)
+    y = np.linspace(-np.pi/2, np.pi/2, ny).reshape(1, ny, 1)
+    x = np.linspace(0, 2*np.pi, nx, endpoint=False).reshape(1, 1, nx)
+
+    field = 280. + 30.*np.cos(y) + 5.*np.sin(3*x + 0.1*t) * np.cos(2*y)
+    field = field.astype(np.float32)
+
+    if kind == 'noisy':
+        field += rng.normal(0., 1., shape).astype(np.float32)
+    elif kind == 'masked':
+        # Land is a fixed pattern of blobs, the same at every time
+        land = (np.sin(2*x) * np.cos(3*y) + 0.3*rng.normal(0., 1., (1, ny, nx))) > 0.5
+        field = np.ma.masked_array(field, mask=np.broadcast_to(land, shape))
+    elif kind != 'smooth':
+        raise ValueError('Unknown kind of field: %s' % kind)
+
+    return field
+
+def make_dataset(filename, kind='smooth', shape=(12, 90, 180), nvars=1, unlimited=False,
+                 seed=0, format='NETCDF4_CLASSIC'):
+    """ Make an uncompressed netCDF file filename with nvars variables of shape
+        (time, lat, lon), filled by make_field. If unlimited is True time is an
+        unlimited dimension. Returns filename
+    """
+
+    ncfile = Dataset(filename, 'w', format=format)
+    try:
+        ncfile.createDimension('time', None if unlimited else shape[0])
+        ncfile.createDimension('lat', shape[1])
+        ncfile.createDimension('lon', shape[2])
+
+        for name, size, units in [('time', shape[0], 'days since 2000-01-01'),
+                                  ('lat', shape[1], 'degrees_north'), ('lon', shape[2], 'degrees_east')]:
+            var = ncfile.createVariable(name, 'f8', (name,))
+            var.units = units
+        ncfile.variables['time'][:] = np.arange(shape[0])
+        ncfile.variables['lat'][:] = np.linspace(-90., 90., shape[1])
+        ncfile.variables['lon'][:] = np.linspace(0., 360., shape[2], endpoint=False)
+
+        for i in range(nvars):
+            name = 'var%d' % i if nvars > 1 else kind
+            var = ncfile.createVariable(name, 'f4', ('time', 'lat', 'lon'), fill_value=1.e20)
+            var.long_name = 'Synthetic %s field' % kind
+            var[:] = make_field(shape, kind, seed + i)
+    finally:
+        ncfile.close()
+
+    return filename
+
+def make_tree(root, nfiles=100, ndirs=4, kind='smooth', shape=(1, 45, 90), seed=0):
+    """ Make a tree of many small netCDF files, nfiles spread across ndirs
+        subdirectories of root. Returns the list of files
+    """
+
+    files = []
+    for i in range(nfiles):
+        directory = os.path.join(root, 'dir%d' % (i % ndirs))
+        if not os.path.isdir(directory): os.makedirs(directory)
+        files.append(make_dataset(os.path.join(directory, 'file%04d.nc' % i), kind, shape, seed=seed + i))
+    return files
+
+def make_named(name, directory, scale=1., seed=0):
+    """ Make the dataset name, from datasets, in directory at scale. Returns the
+        path of the file
+    """
+    options = dict(datasets[name])
+    options['shape'] = scaled_shape(options['shape'], scale)
+    return make_dataset(os.path.join(directory, name + '.nc'), seed=seed, **options)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Time nc2nc, nccompress and nccopy on synthetic datasets over a grid of
+options, and record the results as JSON so runs on different commits can
+be compared:
+
+    python -m benchmarks.run run -o before.json
+    python -m benchmarks.run run -o after.json
+    python -m benchmarks.run compare before.json after.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import netCDF4
+
+from nccompress import nc2nc, nccompress
+from benchmarks import datasets
+
+# Options which identify a benchmark, so the same case can be matched between runs
+case_keys = ['bench', 'dataset', 'scale', 'dlevel', 'shuffle', 'chunking', 'chunksize', 'buffersize', 'numproc']
+
+def git_commit():
+    """ Return the commit of the source tree being benchmarked, or None
+    """
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """ Return a dict describing where the benchmarks were run
+    """
+    return {
+        'commit' : git_commit(),
+        'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host' : platform.node(),
+        'platform' : platform.platform(),
+        'cpus' : os.cpu_count(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'netCDF4' : netCDF4.__version__,
+        'hdf5' : netCDF4.__hdf5libversion__,
+        'netcdf' : netCDF4.__netcdf4libversion__,
+        'h5py' : None if nc2nc.h5py is None else nc2nc.h5py.__version__,
+    }
+
+def best(times):
+    """ Return the fastest of a number of repeats, which is least affected by other
+        activity on the machine
+    """
+    return min(times)
+
+def time_nc2nc(infile, outfile, dlevel, shuffle, chunking, chunksize, buffersize, numproc, repeat=1):
+    """ Copy infile to outfile with nc2nc repeat times. Returns a result for the
+        fastest copy, with the time of each stage recorded by nc2nc
+    """
+    times = []
+    for i in range(repeat):
+        stats = {}
+        nc2nc.nc2nc(infile, outfile, zlib=(dlevel == 'auto' or dlevel > 0), complevel=dlevel, shuffle=shuffle,
+                    chunksize=chunksize, buffersize=buffersize, numproc=numproc, clobber=True,
+                    stats=stats, chunking=nc2nc.chunking_type(chunking))
+        times.append(stats['total'])
+        if stats['total'] == best(times): fastest = stats
+
+    return {
+        'elapsed' : best(times),
+        'times' : times,
+        'bytes_in' : fastest['bytes_in'],
+        'bytes_out' : fastest['bytes_out'],
+        'rate' : fastest['rate'],
+        # maxrss is left out, it is the high-water mark of every copy made by this process
+        'stages' : dict((stage, fastest[stage]) for stage in ('open', 'plan', 'sync', 'utime', 'stime')),
+    }
+
+def time_nccopy(infile, outfile, dlevel, shuffle, buffersize, repeat=1):
+    """ Copy infile to outfile with nccopy repeat times. Returns a result for the
+        fastest copy
+    """
+    times = []
+    for i in range(repeat):
+        if os.path.exists(outfile): os.remove(outfile)
+        stats = {}
+        nccompress.run_nccopy(infile, outfile, dlevel, shuffle, False, buffersize, stats)
+        times.append(stats['total'])
+        if stats['total'] == best(times): fastest = stats
+
+    return {
+        'elapsed' : best(times),
+        'times' : times,
+        'bytes_in' : fastest['bytes_in'],
+        'bytes_out' : fastest['bytes_out'],
+        'rate' : fastest['rate'],
+    }
+
+def time_nccompress(tree, tmpdir, dlevel, shuffle, chunking, chunksize, buffersize, numproc, repeat=1):
+    """ Compress all the files in tree with nccompress repeat times, cleaning tmpdir
+        each time. Returns a result for the fastest run, from the summary in the report
+    """
+    report = os.path.join(os.path.dirname(tmpdir), 'nccompress_report.jsonl')
+    arglist = ['-r', '-c', '-t', tmpdir, '-d', str(dlevel), '-s', str(chunksize),
+               '-b', str(buffersize), '-np', str(numproc), '--chunking', chunking, '--report', report, tree]
+    if not shuffle: arglist.append('-n')
+
+    times = []
+    for i in range(repeat):
+        # The summary of each directory is not wanted among the results
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            nccompress.main_parse_args(arglist)
+        with open(report) as f:
+            summary = [json.loads(line) for line in f][-1]
+        times.append(summary['elapsed'])
+        if summary['elapsed'] == best(times): fastest = summary
+
+    return {
+        'elapsed' : best(times),
+        'times' : times,
+        'bytes_in' : fastest['total_size_old'],
+        'bytes_out' : fastest['total_size_new'],
+        'rate' : nc2nc.transfer_rate(fastest['total_size_old'], fastest['elapsed']),
+    }
+
+def grid(args):
+    """ Return every combination of the compression options in args as a list of dicts
+    """
+    names = ['dlevel', 'shuffle', 'chunking', 'chunksize', 'buffersize', 'numproc']
+    values = [args.dlevel, args.shuffle, args.chunking, args.chunksize, args.buffersize, args.numproc]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+def run(args):
+    """ Make the datasets and run every benchmark in the grid. Returns the record
+        of the run
+    """
+
+    workdir = args.workdir
+    if workdir is None: workdir = tempfile.mkdtemp(prefix='nccompress_bench')
+    # The tmpdir of nccompress is relative to each directory unless it is absolute
+    workdir = os.path.abspath(workdir)
+    if not os.path.isdir(workdir): os.makedirs(workdir)
+
+    if any(numproc > 1 for numproc in args.numproc) and nc2nc.h5py is None:
+        sys.stderr.write("h5py is not installed, skipping benchmarks with more than one process\n")
+        args.numproc = [numproc for numproc in args.numproc if numproc == 1]
+
+    havenccopy = args.nccopy and shutil.which(nccompress.nccopy) is not None
+    if args.nccopy and not havenccopy:
+        sys.stderr.write("{} not found, skipping nccopy benchmarks\n".format(nccompress.nccopy))
+
+    results = []
+
+    def record(result, bench, dataset, options):
+        result.update(options)
+        result['bench'] = bench
+        result['dataset'] = dataset
+        result['scale'] = args.scale
+        result['ratio'] = None
+        if result['bytes_out'] > 0: result['ratio'] = float(result['bytes_in']) / result['bytes_out']
+        results.append(result)
+        if args.verbose:
+            sys.stderr.write('{bench:10s} {dataset:10s} d={dlevel} shuffle={shuffle!s:5s} {chunking} s={chunksize} b={buffersize} '
+                  'np={numproc} {elapsed:8.3f} s {rate:>13s} ratio {ratio:.2f}\n'.format(**dict(result, rate=nccompress.format_rate(result['rate']))))
+
+    try:
+        for name in args.datasets:
+            if name == 'tree':
+                tree = os.path.join(workdir, 'tree')
+                if not os.path.isdir(tree):
+                    datasets.make_tree(tree, nfiles=args.tree_files, seed=args.seed)
+                for options in grid(args):
+                    result = time_nccompress(tree, os.path.join(workdir, 'tmp.nc_compress'),
+                                             repeat=args.repeat, **options)
+                    record(result, 'nccompress', name, options)
+                continue
+
+            infile = os.path.join(workdir, name + '.nc')
+            if not os.path.exists(infile):
+                datasets.make_named(name, workdir, args.scale, args.seed)
+            outfile = os.path.join(workdir, name + '.out.nc')
+
+            for options in grid(args):
+                result = time_nc2nc(infile, outfile, repeat=args.repeat, **options)
+                record(result, 'nc2nc', name, options)
+
+            # nccopy has no control over chunking or parallelism, so only dlevel
+            # and shuffle are varied
+            if havenccopy:
+                for dlevel, shuffle in itertools.product(args.dlevel, args.shuffle):
+                    if dlevel == 'auto': continue
+                    options = {'dlevel' : dlevel, 'shuffle' : shuffle, 'chunking' : None, 'chunksize' : None,
+                               'buffersize' : args.buffersize[0], 'numproc' : 1}
+                    result = time_nccopy(infile, outfile, dlevel, shuffle, options['buffersize'], args.repeat)
+                    record(result, 'nccopy', name, options)
+    finally:
+        if args.workdir is None: shutil.rmtree(workdir)
+
+    return {'environment' : environment(), 'options' : {'scale' : args.scale, 'repeat' : args.repeat,
+            'seed' : args.seed}, 'results' : results}
+
+def case(result):
+    """ Key identifying the benchmark case of result
+    """
+    return tuple(result.get(key) for key in case_keys)
+
+def compare(old, new, threshold=0.1, stream=sys.stdout):
+    """ Print the change in elapsed time of each benchmark case present in both the old
+        and new records. Returns a list of the cases which are slower by more than the
+        fraction threshold
+    """
+
+    old_results = dict((case(result), result) for result in old['results'])
+    regressions = []
+
+    stream.write('old commit: {}\nnew commit: {}\n'.format(old['environment']['commit'], new['environment']['commit']))
+    stream.write('{:<60s} {:>9s} {:>9s} {:>8s}\n'.format('case', 'old (s)', 'new (s)', 'change'))
+    for result in new['results']:
+        key = case(result)
+        if key not in old_results: continue
+        before = old_results[key]['elapsed']
+        after = result['elapsed']
+        change = (after - before) / max(before, 1e-9)
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = ' slower'
+        label = ' '.join('{}={}'.format(name, value) for (name, value) in zip(case_keys, key) if value is not None)
+        stream.write('{:<60s} {:9.3f} {:9.3f} {:+7.1%}{}\n'.format(label, before, after, change, flag))
+
+    return regressions
+
+def parse_args(arglist):
+    """
+    Parse arguments given as list (arglist)
+    """
+
+    def shuffle_type(x):
+        if x not in ('yes', 'no'):
+            raise argparse.ArgumentTypeError("Shuffle must be yes or no")
+        return x == 'yes'
+
+    parser = argparse.ArgumentParser(description="Benchmark nc2nc, nccompress and nccopy on synthetic datasets")
+    subparsers = parser.add_subparsers(dest='command')
+
+    runparser = subparsers.add_parser('run', help="Run the benchmarks")
+    runparser.add_argument("-o","--output", help="Write the results to this JSON file (default is standard output)")
+    runparser.add_argument("--datasets", help="Datasets to benchmark (default all)", nargs='+',
+                           choices=sorted(datasets.datasets) + ['tree'], default=sorted(datasets.datasets) + ['tree'])
+    runparser.add_argument("--scale", help="Scale the horizontal dimensions of the datasets by this factor (default 1)", type=float, default=1.)
+    runparser.add_argument("--tree-files", help="Number of files in the tree of small files (default 100)", type=int, default=100)
+    runparser.add_argument("--seed", help="Seed for the random numbers in the datasets (default 0)", type=int, default=0)
+    runparser.add_argument("-d","--dlevel", help="Deflate levels, 0-9 or auto (default 5)", type=nc2nc.dlevel_type, nargs='+', default=[5], metavar='{0-9,auto}')
+    runparser.add_argument("--shuffle", help="Shuffle settings (default yes)", type=shuffle_type, nargs='+', default=[True], metavar='{yes,no}')
+    runparser.add_argument("--chunking", help="Chunking strategies, or comma separated weights (default balanced)", nargs='+', default=['balanced'])
+    runparser.add_argument("-s","--chunksize", help="Chunk sizes in KiB (default 64)", type=int, nargs='+', default=[64])
+    runparser.add_argument("-b","--buffersize", help="Copy buffer sizes in MiB (default 50)", type=int, nargs='+', default=[50])
+    runparser.add_argument("-np","--numproc", help="Numbers of processes (default 1)", type=int, nargs='+', default=[1])
+    runparser.add_argument("--repeat", help="Run each benchmark this many times and keep the fastest (default 3)", type=int, default=3)
+    runparser.add_argument("--no-nccopy", help="Don't benchmark nccopy", dest='nccopy', action='store_false')
+    runparser.add_argument("--workdir", help="Directory for the datasets, which are kept and reused (default is a temporary directory which is removed)")
+    runparser.add_argument("-v","--verbose", help="Print each result as it is measured", action='store_true')
+
+    compareparser = subparsers.add_parser('compare', help="Compare the results of two runs")
+    compareparser.add_argument("old", help="JSON results of the earlier run")
+    compareparser.add_argument("new", help="JSON results of the later run")
+    compareparser.add_argument("--threshold", help="Report cases which are slower by more than this percentage (default 10)", type=float, default=10.)
+
+    args = parser.parse_args(arglist)
+    if args.command is None: parser.error("a command, run or compare, is required")
+    if args.command == 'run':
+        for chunking in args.chunking:
+            try:
+                nc2nc.chunking_type(chunking)
+            except argparse.ArgumentTypeError as e:
+                parser.error(str(e))
+    return args
+
+def main(args):
+
+    if args.command == 'compare':
+        with open(args.old) as f: old = json.load(f)
+        with open(args.new) as f: new = json.load(f)
+        regressions = compare(old, new, args.threshold/100.)
+        return 1 if regressions else 0
+
+    record = run(args)
+    if args.output is None:
+        json.dump(record, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=1)
+    return 0
+
+def main_parse_args(arglist):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    return main(parse_args(arglist))
+
+if __name__ == "__main__":
+    sys.exit(main_parse_args(sys.argv[1:]))
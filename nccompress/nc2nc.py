@@ -17,11 +17,28 @@ import os
 import sys
 import math
 import operator
+import itertools
+import functools
 from warnings import warn
 import argparse
 import copy
 import numbers
+import zlib as zlibmodule
+import struct
+import multiprocessing as mp
+import time
+import hashlib
+import json
+import resource
+import sqlite3
+import threading
 from six.moves import reduce
+
+try:
+    import h5py
+except ImportError:
+    # Optional dependency, only required for parallel compression (numproc > 1)
+    h5py = None
     
 
 dtypes = {
@@ -52,28 +69,22 @@ def numVals(shape):
 def cascadeRounding(array):
     """Implement cascase rounding
     http://stackoverflow.com/questions/792460/how-to-round-floats-to-integers-while-preserving-their-sum
+
+    Values are rounded in increasing order, each to the difference between the
+    rounded running total and the total of the values already rounded
     """
 
+    array = np.asarray(array)
     sort_index = np.argsort(array)
-    integer_array = []
-
-    total_float = 0
-    total_int = 0
 
     # We place a hard limit on the total of the array, which keeps
     # the rounded values from exceeding the total of the array
-    limit = np.floor(sum(array))
-    
-    for idx in sort_index:
-        total_float += array[idx]
-        integer_array.append(min(round(total_float),limit)-total_int)
-        total_int += integer_array[-1]
+    limit = np.floor(np.cumsum(array)[-1]) if len(array) > 0 else 0.
 
-    rounded_array = np.zeros(len(array))
+    totals = np.minimum(np.round(np.cumsum(array[sort_index])), limit)
 
-    # Should make this a comprehension, but I couldn't comprehend it
-    for i in range(len(sort_index)):
-        rounded_array[sort_index[i]] = integer_array[i]
+    rounded_array = np.zeros(len(array))
+    rounded_array[sort_index] = np.diff(totals, prepend=0.)
 
     return rounded_array
 
@@ -103,213 +114,1404 @@ def chunk_shape_nD(varShape, valSize=4, chunkSize=4096, minDim=1):
     chunks accessed to read any kind of 1D or 2D subset is approximately
     equal, and the size of each chunk (uncompressed) is at least
     chunkSize, which is often a disk block size.
+
+    Files often have many variables of the same shape, so shapes are
+    remembered (see plan_chunks) and only calculated once.
     """
 
-    varShapema = ma.array(varShape)
+    return np.array(plan_chunks(tuple(int(n) for n in varShape), valSize, chunkSize, minDim), dtype=int)
+
+@functools.lru_cache(maxsize=4096)
+def plan_chunks(varShape, valSize, chunkSize, minDim):
+    """
+    Return the chunk shape of chunk_shape_nD as a tuple. varShape must be a
+    tuple. Results are cached, keyed on all the arguments
+    """
+
+    varShape = np.asarray(varShape, dtype=int)
     
-    chunkVals = min(chunkSize / float(valSize),numVals(varShapema)) # ideal number of values in a chunk
+    chunkVals = min(chunkSize / float(valSize),numVals(varShape)) # ideal number of values in a chunk
 
     # Make an ideal chunk shape array 
-    chunkShape = ma.array(calcChunkShape(chunkVals,varShapema),dtype=int)
+    chunkShape = calcChunkShape(chunkVals,varShape)
 
     # Short circuit for 1D arrays. Logic below unecessary & can have divide by zero
-    if len(varShapema) == 1: return chunkShape.filled(fill_value=1)
-
-    # And a copy where we'll store our final values
-    chunkShapeFinal = ma.masked_all(chunkShape.shape,dtype=int)
+    if len(varShape) == 1: return tuple(int(n) for n in chunkShape)
 
-    if chunkVals < numVals(np.minimum(varShapema,minDim)):
-        while chunkVals < numVals(np.minimum(varShapema,minDim)):
+    if chunkVals < numVals(np.minimum(varShape,minDim)):
+        while chunkVals < numVals(np.minimum(varShape,minDim)):
             minDim -= 1
         sys.stderr.write('Mindim too large for variable, reduced to : %d\n' % minDim)
 
+    # Dimensions which have been fixed at their final length, because the
+    # ideal length was less than minDim
+    fixed = np.zeros(len(varShape), dtype=bool)
     lastChunkCount = -1
-    
+
     while True:
 
-        # Loop over the axes in chunkShape, making sure they are at
-        # least minDim in length.
-        for i in range(len(chunkShape)):
-            if ma.is_masked(chunkShape[i]):
-                continue 
-            if (chunkShape[i] < minDim):
-                # Set the final chunk shape for this dimension
-                chunkShapeFinal[i] = min(minDim,varShapema[i])
-                # mask it out of the array of possible chunkShapes
-                chunkShape[i] = ma.masked
-
-        # Have we fixed any dimensions and filled them in chunkShapeFinal?
-        if chunkShapeFinal.count() > 0:
-            chunkCount = numVals(chunkShapeFinal[~chunkShapeFinal.mask])
-        else:
-            if (lastChunkCount == -1):
-                # Haven't modified initial guess, break out of
-                # this loop and accept chunkShape 
-                break
+        # Fix any dimensions shorter than minDim at minDim (or the whole dimension)
+        short = ~fixed & (chunkShape < minDim)
+        chunkShape[short] = np.minimum(minDim,varShape[short])
+        fixed |= short
 
-        if chunkCount != lastChunkCount and len(varShapema[~chunkShape.mask]) > 0:
-            # Recalculate chunkShape array, with reduced dimensions
-            chunkShape[~chunkShape.mask] = calcChunkShape(chunkVals/chunkCount,varShapema[~chunkShape.mask])
+        if not fixed.any(): 
+            # Haven't modified initial guess, accept chunkShape 
+            break
+
+        chunkCount = numVals(chunkShape[fixed])
+        if chunkCount != lastChunkCount and not fixed.all():
+            # Recalculate the rest of the chunk shape, with reduced dimensions
+            chunkShape[~fixed] = calcChunkShape(chunkVals/chunkCount,varShape[~fixed])
             lastChunkCount = chunkCount
         else:
             break
 
-    # This doesn't work when chunkShape has no masked values. Weird.
-    # chunkShapeFinal[chunkShapeFinal.mask] = chunkShape[~chunkShape.mask]
-    for i in range(len(chunkShapeFinal)):
-        if ma.is_masked(chunkShapeFinal[i]):
-            chunkShapeFinal[i] = chunkShape[i]
+    return tuple(int(n) for n in chunkShape)
 
-    return chunkShapeFinal.filled(fill_value=1)
+def chunk_shape_weighted(varShape, weights, valSize=4, chunkSize=4096, minDim=1):
+    """
+    Return a chunk shape for an nD variable in which the length of the chunk
+    along each dimension grows in proportion to weight, on a log scale, so
+    the chunk extends furthest along the dimensions with the largest weights
 
+    varShape  -- list of variable dimension sizes
+    weights   -- list of non-negative weights, one for each dimension
+    chunkSize -- minimum chunksize desired, in bytes (default 4096)
+    valSize   -- size of each data value, in bytes (default 4)
+    minDim    -- mimimum chunk dimension (if var dimension larger
+                 than this value, otherwise it is just var dimension)
 
-def nc2nc(filename_o, filename_d, zlib=True, complevel=5, shuffle=True, fletcher32=False,
-    clobber=False, verbose=False, classic=True, lsd_dict=None, vars=None, chunksize=4, buffersize=50, mindim=1,ignoreformat=False):
-    """convert a netcdf file (filename_o) to another netcdf file (filename_d)
-    The default format is 'NETCDF4_classic', but can be set to NETCDF4 if classic=False.
-    If the lsd_dict is not None, variable names corresponding to the keys of the dict
-    will be truncated to the decimal place specified by the values of the dict.
-    This improves compression by making it 'lossy'..
-    If vars is not None, only variable names in the list will be copied (plus all the
-    dimension variables). The zlib, complevel and shuffle keywords control
-    how the compression is done. buffersize is the size (in KB) of the buffer used to
-    copy the data from one file to another. mindim sets a minimum size for a dimension
-    of a chunk. In some cases very large variable dimensions will mean chunk sizes for
-    the smaller dimensions will be small, with a minimum of at least 1. This can lead to
-    slow access times.
+    A dimension which is shorter than its share of the chunk is covered
+    completely, and the rest of the chunk shared between the others.
+    Dimensions with zero weight have a length of 1, unless the chunk
+    covers all the other dimensions, when they grow equally.
+
+    >>> chunk_shape_weighted((1460,1080,1440), (1,0,0))
+    array([1024,    1,    1])
+    >>> chunk_shape_weighted((12,1080,1440), (1,0,0))
+    array([12,  9,  9])
+    >>> chunk_shape_weighted((1460,1080,1440), (0,1,1))
+    array([ 1, 32, 32])
     """
 
-    if os.path.isfile(filename_d) and not clobber:
-        sys.stderr.write('Output file already exists: %s. Use -o option to overwrite\n' % filename_d)
-        return False
+    varShape = np.asarray(varShape, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    chunkVals = min(chunkSize / float(valSize), numVals(varShape)) # ideal number of values in a chunk
+
+    chunkShape = np.ones(len(varShape))
+    free = (weights > 0) & (varShape > 1)
+
+    while numVals(chunkShape) < chunkVals:
+        if not free.any():
+            # The weighted dimensions are covered, so grow the others equally
+            free = chunkShape < varShape
+            if not free.any(): break
+            weights = np.where(free, 1., weights)
+        # Share the rest of the chunk between the free dimensions, as a power of their weight
+        scale = math.log(chunkVals / numVals(chunkShape[~free])) / weights[free].sum()
+        lengths = np.exp(weights[free]*scale)
+        full = lengths >= varShape[free]
+        if not full.any():
+            chunkShape[free] = np.maximum(lengths, 1.)
+            break
+        # Cover dimensions which are too short, and share what is left between the rest
+        index = np.flatnonzero(free)[full]
+        chunkShape[index] = varShape[index]
+        free[index] = False
+
+    chunkShape = np.minimum(np.maximum(np.round(chunkShape), np.minimum(minDim, varShape)), varShape)
+    return chunkShape.astype(int)
+
+def balanced_strategy(ndim):
+    """ Balanced access of all 1D and 2D subsets, using chunk_shape_nD """
+    return None, [(i,) for i in range(ndim)] + list(itertools.combinations(range(ndim), 2))
+
+def timeseries_strategy(ndim):
+    """ Reading the whole of the first (time) dimension at one point """
+    return [1.] + [0.]*(ndim-1), [(0,)]
+
+def spatial_strategy(ndim):
+    """ Reading the whole of the last two (horizontal) dimensions at one time """
+    nspatial = min(ndim, 2)
+    return [0.]*(ndim-nspatial) + [1.]*nspatial, [tuple(range(ndim-nspatial, ndim))]
+
+# Chunking strategies, selected with --chunking. Each is called with the number of
+# dimensions of a variable, and returns a weight for each dimension, for
+# chunk_shape_weighted (or None to use chunk_shape_nD), and the access patterns it
+# is designed for, each a tuple of the dimensions read in full at a single index of
+# the others. Add an entry here to make a new strategy available to --chunking
+chunk_strategies = {
+    'balanced' : balanced_strategy,
+    'timeseries' : timeseries_strategy,
+    'spatial' : spatial_strategy,
+}
+
+def strategy_weights(strategy, ndim):
+    """
+    Return the weights and access patterns of strategy, the name of one of
+    chunk_strategies or a list of weights, for a variable with ndim dimensions.
+    A list of weights applies to the last dimensions, any others have zero weight,
+    and the access pattern is reading the dimensions with non-zero weight in full
 
-    ncfile_o = Dataset(filename_o,'r')
+    >>> strategy_weights([1,0.5,0.5], 2)
+    ([0.5, 0.5], [(0, 1)])
+    """
+    if isinstance(strategy, str): return chunk_strategies[strategy](ndim)
+    weights = ([0.]*ndim + [float(weight) for weight in strategy])[-ndim:] if ndim > 0 else []
+    return weights, [tuple(i for i, weight in enumerate(weights) if weight > 0)]
 
-    if ncfile_o.file_format is "NETCDF4":
-        if ignoreformat:
-            warn('netCDF4 formatted file .. ignoring')
-        else:
-            raise FormatError('nc2nc is not tested to work with netCDF4 files, only netCDF4 Classic, and netCDF3. See --ignoreformat option to ignore warning')
-        
-    if classic:
-        ncfile_d = Dataset(filename_d,'w',clobber=clobber,format='NETCDF4_CLASSIC')
-    else:
-        ncfile_d = Dataset(filename_d,'w',clobber=clobber,format='NETCDF4')
-    mval = 1.e30 # missing value if unpackshort=True
+def chunk_shape(varShape, valSize=4, chunkSize=4096, minDim=1, strategy='balanced'):
+    """
+    Return the chunk shape for a variable of shape varShape chosen by strategy,
+    the name of one of chunk_strategies or a list of weights for each dimension
+    (see chunk_shape_weighted). The other arguments are as for chunk_shape_nD
+    """
+    weights, access = strategy_weights(strategy, len(varShape))
+    if weights is None:
+        return chunk_shape_nD(varShape, valSize=valSize, chunkSize=chunkSize, minDim=minDim)
+    return chunk_shape_weighted(varShape, weights, valSize=valSize, chunkSize=chunkSize, minDim=minDim)
+
+def predict_chunks(varShape, chunkShape, strategy='balanced'):
+    """
+    Return the average number of chunks of shape chunkShape touched by each of
+    the access patterns strategy is designed for, in a variable of shape varShape
+
+    >>> predict_chunks((1460,1080,1440), (1024,1,1), 'timeseries')
+    2.0
+    >>> predict_chunks((1460,1080,1440), (1024,1,1), 'spatial')
+    1555200.0
+    """
+    weights, access = strategy_weights(strategy, len(varShape))
+    touched = [chunks_touched([slice(0, n) if i in dims else slice(0, 1) for i, n in enumerate(varShape)], chunkShape)
+               for dims in access]
+    if len(touched) == 0: return 1.
+    return float(sum(touched))/len(touched)
+
+def chunking_type(value):
+    """
+    Convert a --chunking option, the name of one of chunk_strategies or a comma
+    separated list of weights for each dimension, to the strategy passed to nc2nc
+    """
+    if value in chunk_strategies: return value
+    try:
+        weights = tuple(float(weight) for weight in value.split(','))
+    except ValueError:
+        weights = []
+    if len(weights) == 0 or any(weight < 0 for weight in weights) or not any(weight > 0 for weight in weights):
+        raise argparse.ArgumentTypeError("chunking must be one of %s, or a comma separated list of "
+                                         "non-negative weights for each dimension" % ', '.join(sorted(chunk_strategies)))
+    return weights
+
+def buffer_shape(varShape, chunkShape, valSize=4, bufferSize=4096):
+    """
+    Return the shape of a copy buffer which is a whole multiple of chunkShape
+
+    varShape   -- list of variable dimension sizes
+    chunkShape -- list of chunk dimension sizes
+    valSize    -- size of each data value, in bytes (default 4)
+    bufferSize -- maximum size of the copy buffer, in bytes
+
+    The buffer is grown one chunk at a time starting from the last
+    (fastest varying) dimension, so the buffer is never larger than
+    bufferSize, unless a single chunk is larger than bufferSize, in
+    which case the buffer is one chunk. Buffer dimensions are limited
+    to the variable dimensions.
+    """
+
+    varShape = np.asarray(varShape, dtype=int)
+    # Zero length (unlimited) dimensions have a chunk length of at least one
+    chunkShape = np.maximum(np.minimum(np.asarray(chunkShape, dtype=int), varShape), 1)
+
+    # Number of chunks along each dimension, and the number of whole chunks
+    # that fit inside the copy buffer
+    nChunks = (varShape - 1)//chunkShape + 1
+    maxChunks = max(int(bufferSize // (numVals(chunkShape)*valSize)), 1)
+
+    steps = np.ones(len(varShape), dtype=int)
+    for i in reversed(range(len(varShape))):
+        steps[i] = max(min(nChunks[i], maxChunks // numVals(steps)), 1)
+        if steps[i] < nChunks[i]: break
+
+    return np.maximum(np.minimum(steps*chunkShape, varShape), 1)
+
+def hyperslabs(varShape, bufferShape):
+    """
+    Generate tuples of slices which step through a variable of shape
+    varShape in blocks of bufferShape
+
+    >>> list(hyperslabs((3,4),(2,4)))
+    [(slice(0, 2, None), slice(0, 4, None)), (slice(2, 3, None), slice(0, 4, None))]
+    """
+
+    varShape = np.asarray(varShape)
+    bufferShape = np.asarray(bufferShape)
+
+    # bufferSteps is the number of copies of bufferShape that fit along each axis
+    bufferSteps = (varShape-1)//bufferShape + 1
+
+    # Make an iterator out of all possible combinations of the bufferOffsets, which
+    # are just steps along each dimension
+    for index in np.ndindex(*bufferSteps):
+        index = np.asarray(index)*bufferShape
+        # min checks we don't go beyond the limits of the variable
+        yield tuple(slice(int(start),int(min(start+step,end)),None) 
+                    for start, step, end in zip(index, bufferShape, varShape))
+
+def chunks_touched(slices, chunkShape):
+    """
+    Return the number of chunks of shape chunkShape which intersect the
+    hyperslab defined by slices
+
+    >>> chunks_touched((slice(0,4),slice(2,6)),(2,4))
+    4
+    """
+    return numVals([(s.stop-1)//c - s.start//c + 1 for s, c in zip(slices, chunkShape)])
+
+def next_prime(n):
+    """
+    Return the smallest prime number greater than or equal to n
+
+    >>> next_prime(100)
+    101
+    """
+    n = max(int(n), 2)
+    while any(n % i == 0 for i in range(2, int(math.sqrt(n)) + 1)):
+        n += 1
+    return n
+
+def chunk_cache(varShape, bufferShape, chunkShape, valSize=4, cacheSize=None, preemption=0.75):
+    """
+    Return HDF5 chunk cache settings (size, nelems, preemption) for a variable
+    which is accessed in hyperslabs of bufferShape
+
+    varShape    -- list of variable dimension sizes
+    bufferShape -- list of copy buffer dimension sizes
+    chunkShape  -- list of chunk dimension sizes
+    valSize     -- size of each data value, in bytes (default 4)
+    cacheSize   -- size of the cache in bytes, the default is large enough
+                   to hold every chunk touched by one row of a hyperslab
+    preemption  -- HDF5 preemption policy, 0-1 (default 0.75)
+
+    HDF5 reads or writes all of each chunk a hyperslab touches before moving
+    to the next, so only chunks shared with the next hyperslab are read or
+    written again. These are the chunks touched by the last row of the
+    hyperslab along the dimension in which the hyperslabs advance, which is
+    the last dimension the copy buffer doesn't cover.
+
+    The number of hash table slots (nelems) is a prime number approximately
+    100 times the number of chunks which fit in the cache, as recommended by
+    the HDF5 documentation.
+    """
+
+    varShape = np.asarray(varShape, dtype=int)
+    chunkShape = np.maximum(np.minimum(np.asarray(chunkShape, dtype=int), varShape), 1)
+    bufferShape = np.asarray(bufferShape, dtype=int)
+
+    chunkBytes = numVals(chunkShape)*valSize
+
+    if cacheSize is None:
+        bufferShape = np.maximum(np.minimum(bufferShape, varShape), 1)
+        advancing = [i for i in range(len(varShape)) if bufferShape[i] < varShape[i]]
+        axis = advancing[-1] if advancing else 0
+        row = [slice(0, int(n)) for n in bufferShape]
+        row[axis] = slice(int(bufferShape[axis]) - 1, int(bufferShape[axis]))
+        cacheSize = chunks_touched(row, chunkShape)*chunkBytes
+
+    nelems = next_prime(min(100*max(cacheSize//chunkBytes, 1), 1000000))
+
+    return int(cacheSize), int(nelems), preemption
+
+def estimate_memory(ncfile, chunksize=4, buffersize=50, mindim=1, chunkcache=None, pipeline=0, chunking='balanced', numproc=1):
+    """
+    Return an estimate of the peak memory, in bytes, nc2nc uses to copy the
+    open Dataset ncfile with the same chunksize (KiB), buffersize (MiB),
+    mindim, chunkcache (MiB), pipeline and numproc options. The memory used
+    by the interpreter itself is not included.
+
+    Variables are copied one at a time, and the largest copy buffer is held
+    as a masked array (data and mask) and a filled copy of the data as it
+    is written. The input and output chunk caches of a variable are emptied
+    once it is copied, so only the largest pair is counted, but a cache is
+    never larger than the variable. With a pipeline the reader process also
+    holds up to pipeline buffers waiting to be written. With numproc greater
+    than one, up to direct_inflight chunks for each process are held as they
+    are passed to the pool, and again as they come back filtered.
+    """
 
-    # Copy buffer specified in MiB, so convert to bytes
     buffersize = buffersize*(1024**2)
-    # Chunk size specified in KiB, so convert to bytes
     chunksize = chunksize*1024
+    if chunkcache is not None: chunkcache = chunkcache*(1024**2)
+
+    maxbuffer = 0
+    caches = 0
+    maxchunk = 0
+    for ncvar in ncfile.variables.values():
+        if ncvar.shape == () or ncvar.dtype.char not in dtypes: continue
+        valSize = dtypes[ncvar.dtype.char]
+        varBytes = numVals(ncvar.shape)*valSize
+
+        chunksizes = chunk_shape(ncvar.shape,valSize=valSize,minDim=mindim,chunkSize=chunksize,strategy=chunking)
+        bufferChunk = buffer_shape(ncvar.shape,chunksizes,valSize=valSize,bufferSize=buffersize)
+        maxchunk = max(maxchunk, numVals(chunksizes)*valSize)
+        # Data, mask, and filled copy of the data
+        maxbuffer = max(maxbuffer, numVals(bufferChunk)*(2*valSize + 1))
+
+        cache = chunk_cache(ncvar.shape,bufferChunk,chunksizes,valSize=valSize)
+        varcaches = min(cache[0], varBytes)
+        if ncfile.data_model.startswith('NETCDF4') and ncvar.chunking() != 'contiguous':
+            cache = chunk_cache(ncvar.shape,bufferChunk,ncvar.chunking(),valSize=valSize)
+            varcaches += min(cache[0], varBytes)
+        caches = max(caches, varcaches)
+
+    # chunkcache limits the size of the caches of each variable
+    if chunkcache is not None: caches = min(caches, chunkcache)
+
+    if pipeline > 0:
+        # Buffers in the queue, and the one being read, are data and mask only
+        maxbuffer += (pipeline + 1)*maxbuffer//2
+
+    inflight = 0
+    if numproc > 1:
+        # Chunks on their way to the pool, and filtered chunks on their way back
+        inflight = 2*numproc*direct_inflight*maxchunk
+
+    return int(maxbuffer + caches + inflight)
+
+def fletcher32(data):
+    """
+    Return the HDF5 fletcher32 checksum of data (bytes), as computed
+    by H5_checksum_fletcher32
+    """
 
-    # create dimensions. Check for unlimited dim.
-    unlimdimname = False
-    unlimdim = None
-
-    # create global attributes.
-    if verbose: sys.stdout.write('copying global attributes ..\n')
-    #for attname in ncfile_o.ncattrs():
-    #    setattr(ncfile_d,attname,getattr(ncfile_o,attname))
-    ncfile_d.setncatts(ncfile_o.__dict__) 
-
-    # Copy dimensions
-    if verbose: sys.stdout.write('copying dimensions ..\n')
-    for dimname,dim in ncfile_o.dimensions.items():
-        if dim.isunlimited():
-            unlimdimname = dimname
-            unlimdim = dim
-            ncfile_d.createDimension(dimname,None)
-        else:
-            ncfile_d.createDimension(dimname,len(dim))
-
-    # create variables.
-    if vars is None:
-       varnames = ncfile_o.variables.keys()
-    else:
-       # variables to copy specified
-       varnames = vars
-       # add dimension variables
-       for dimname in ncfile_o.dimensions.keys():
-           if dimname in ncfile_o.variables.keys() and dimname not in varnames:
-               varnames.append(dimname)
-
-    for varname in varnames:
-        ncvar = ncfile_o.variables[varname]
-        if verbose: sys.stdout.write('copying variable %s\n' % varname)
-        # quantize data?
-        if lsd_dict is not None and varname in lsd_dict:
-            lsd = int(lsd_dict[varname])
-            if verbose: sys.stdout.write('truncating to least_significant_digit = %d\n'%lsd)
-        else:
-            lsd = None # no quantization.
-        datatype = ncvar.dtype
+    data = np.frombuffer(data, dtype=np.uint8)
 
-        # is there an unlimited dimension?
-        if unlimdimname and unlimdimname in ncvar.dimensions:
-            hasunlimdim = True
-        else:
-            hasunlimdim = False
+    # Sum big-endian 16 bit words in blocks of 360 words, reducing the sums
+    # to 16 bits after each block
+    words = data[:len(data)//2*2].view('>u2').astype(np.uint64)
+    blocks = [words[start:start+360] for start in range(0, len(words), 360)]
 
-        if hasattr(ncvar, '_FillValue'):
-            FillValue = ncvar._FillValue
-        else:
-            FillValue = None 
-
-        chunksizes = None
-        # check we have a mapping from the type to a number of bytes
-        if ncvar.dtype.char in dtypes: 
-            if verbose: sys.stdout.write('Variable shape: %s\n' % str(ncvar.shape))
-            if (ncvar.shape != ()): chunksizes=chunk_shape_nD(ncvar.shape,valSize=dtypes[ncvar.dtype.char],minDim=mindim,chunkSize=chunksize)
-            if verbose: sys.stdout.write('Chunk sizes: %s\n' % str(chunksizes))
+    # An odd trailing byte is summed as the high byte of a word
+    if len(data) % 2: blocks.append(np.array([int(data[-1]) << 8], dtype=np.uint64))
+
+    sum1 = sum2 = 0
+    for block in blocks:
+        sum2 = sum2 + len(block)*sum1 + int(np.cumsum(block).sum())
+        sum1 = sum1 + int(block.sum())
+        sum1 = (sum1 & 0xffff) + (sum1 >> 16)
+        sum2 = (sum2 & 0xffff) + (sum2 >> 16)
+
+    sum1 = (sum1 & 0xffff) + (sum1 >> 16)
+    sum2 = (sum2 & 0xffff) + (sum2 >> 16)
+
+    return (sum2 << 16) | sum1
+
+def shuffle_bytes(data, itemsize):
+    """
+    Return data (bytes) byte transposed as by the HDF5 shuffle filter, so the
+    first byte of every value comes first, then the second byte, and so on.
+    Any left over bytes are copied unaltered
+
+    >>> shuffle_bytes(b'abcdef', 2)
+    b'acebdf'
+    """
+    nbytes = len(data)//itemsize*itemsize
+    shuffled = np.frombuffer(data, dtype=np.uint8, count=nbytes).reshape(-1,itemsize).T
+    return shuffled.tobytes() + data[nbytes:]
+
+def filter_chunk(data, itemsize, filters):
+    """
+    Apply the HDF5 filter pipeline to the bytes of one chunk, and return the
+    bytes as they would be stored in the file
+
+    data     -- uncompressed chunk data (bytes)
+    itemsize -- size of each data value, in bytes
+    filters  -- list of (filter id, cd_values) tuples in pipeline order
+
+    Supports the deflate (1), shuffle (2) and fletcher32 (3) filters used by
+    netCDF4.
+    """
+
+    for filterid, values in filters:
+        if filterid == h5py.h5z.FILTER_DEFLATE:
+            data = zlibmodule.compress(data, values[0])
+        elif filterid == h5py.h5z.FILTER_SHUFFLE:
+            data = shuffle_bytes(data, itemsize)
+        elif filterid == h5py.h5z.FILTER_FLETCHER32:
+            data = data + struct.pack('<I', fletcher32(data))
         else:
-            sys.stderr.write("This datatype not supported: dtype : %s\n" % ncvar.dtype.char)
-            sys.exit(1)
+            raise FormatError('Unsupported HDF5 filter: %d' % filterid)
 
-        # Create the variable we will copy to
-        var = ncfile_d.createVariable(varname, datatype, ncvar.dimensions, fill_value=FillValue, least_significant_digit=lsd, zlib=zlib, complevel=complevel, shuffle=shuffle, fletcher32=fletcher32, chunksizes=chunksizes)
-        # fill variable attributes.
-        attdict = ncvar.__dict__
-        if '_FillValue' in attdict: del attdict['_FillValue']
-        var.setncatts(attdict)
+    return data
 
-        # fill variable with data.
+def _filter_chunk_star(args):
+    """Unpack the offset of a chunk and the arguments for filter_chunk, for use with
+    Pool.imap, and return the offset with the filtered chunk"""
+    offset, data, itemsize, filters = args
+    return offset, filter_chunk(data, itemsize, filters)
 
-        dimlim = np.asarray(ncvar.shape)
+# Number of chunks for each process which write_direct passes to the pool at once,
+# which bounds the chunks waiting to be filtered, and filtered but not yet written
+direct_inflight = 4
 
-        # bufferChunk is a multiple of the chunksize which is less than the size of copy buffer
-        if (ncvar.shape != ()): bufferChunk = chunk_shape_nD(ncvar.shape,valSize=dtypes[ncvar.dtype.char],chunkSize=buffersize)
+# Shortest time, in seconds, a transfer rate is reported for. Rates over shorter times,
+# such as the copy of a scalar variable, measure the timer rather than the copy
+rate_resolution = 1e-3
 
-        # Don't bother copying in steps if all our data fits inside the bufferChunk
-        if ncvar.shape == () or np.all(bufferChunk >= dimlim):
-            var[:] = ncvar[:]
+def transfer_rate(nbytes, seconds):
+    """
+    Return the rate nbytes were copied in seconds, in MB/s, or None if seconds is
+    too short to measure a rate
+    """
+    if seconds < rate_resolution: return None
+    return nbytes / seconds / 1e6
+
+# Deflate levels tried, each with and without shuffle, when the deflate level is auto
+trial_levels = (1, 2, 3, 5, 9)
+
+def trial_deflate(chunks, itemsize, level, shuffle):
+    """
+    Return the total size of chunks (a list of bytes) when deflated at level,
+    after shuffling if shuffle is True, and the time taken (in seconds)
+    """
+    start = time.perf_counter()
+    size = 0
+    for data in chunks:
+        if shuffle: data = shuffle_bytes(data, itemsize)
+        size += len(zlibmodule.compress(data, level))
+    return size, time.perf_counter() - start
+
+def choose_deflate(ncvar, chunkShape, shuffle=True, ntrials=4, tolerance=0.05, levels=trial_levels, seed=0):
+    """
+    Choose the deflate level and shuffle setting for ncvar (a netCDF4 Variable)
+    by deflating a reproducible sample of ntrials chunks, of shape chunkShape, at
+    each of levels, with and without shuffle. If shuffle is False only settings
+    without shuffle are tried. The cheapest setting, the lowest level and then no
+    shuffle, with a compression ratio within the fraction tolerance of the best
+    is chosen. Returns a dict of the level, shuffle and ratio chosen, and the
+    ratio and time of every setting tried (trials)
+    """
+
+    nchunks = numVals((np.asarray(ncvar.shape) - 1)//np.asarray(chunkShape) + 1)
+    ncvar.set_auto_maskandscale(False)
+    try:
+        chunks = [np.ascontiguousarray(ncvar[slices]).tobytes()
+                  for slices in sample_chunks(ncvar.shape, chunkShape, float(ntrials)/nchunks, seed)]
+    finally:
+        ncvar.set_auto_maskandscale(True)
+    nbytes = max(sum(len(data) for data in chunks), 1)
+
+    trials = []
+    for level in levels:
+        for trialshuffle in ([False, True] if shuffle else [False]):
+            size, elapsed = trial_deflate(chunks, ncvar.dtype.itemsize, level, trialshuffle)
+            trials.append({'level' : level, 'shuffle' : trialshuffle, 'ratio' : float(nbytes)/max(size, 1),
+                           'time' : elapsed})
+
+    # Trials are in order of increasing cost
+    best = max(trial['ratio'] for trial in trials)
+    chosen = [trial for trial in trials if trial['ratio'] >= best*(1. - tolerance)][0]
+
+    return {'level' : chosen['level'], 'shuffle' : chosen['shuffle'], 'ratio' : chosen['ratio'], 'trials' : trials}
+
+def write_direct(ncfile_o, filename_d, direct_vars, numproc, verbose=False, hashes=None, timings=None):
+    """
+    Copy variables from ncfile_o (an open netCDF4 Dataset) to the netCDF4 file
+    filename_d, which must already contain the variable definitions. The HDF5
+    filters are applied to each chunk by a pool of numproc processes, and the
+    filtered chunks are written with HDF5 direct chunk writes.
+
+    direct_vars -- list of (variable name, copy buffer shape) tuples
+    hashes      -- dict of hash objects, by variable name, which are updated
+                   with the values of each variable as they are read
+    timings     -- the time spent reading, and filtering and writing, each
+                   variable is added to timings['variables'][name]['read']
+                   and ['write']
+
+    Chunks are filled with the HDF5 fill value beyond the edge of the variable,
+    which is what the HDF5 library does, so the stored chunks are the same as
+    would be written by the netCDF library. Chunks are made from each copy
+    buffer as the pool takes them, and no more than direct_inflight chunks for
+    each process are in the pool, or waiting to be written, at once.
+    """
+
+    # Don't fork a process with open HDF5 files
+    pool = mp.get_context('spawn').Pool(processes=numproc)
+
+    # Chunks are made as the pool takes them, and at most window chunks are in
+    # the pool, or filtered and waiting to be written, at once. After an error stop
+    # is set, so the pool stops taking chunks
+    window = threading.Semaphore(numproc*direct_inflight)
+    stop = threading.Event()
+
+    def buffer_chunks(data, slices, chunkShape, fillvalue, dtype, itemsize, filters):
+        for offset in hyperslabs([s.stop-s.start for s in slices], chunkShape):
+            window.acquire()
+            if stop.is_set(): return
+            chunk = np.full(chunkShape, fillvalue, dtype=dtype)
+            block = data[offset]
+            chunk[tuple(slice(0,n) for n in block.shape)] = block
+            yield (tuple(s.start+o.start for s, o in zip(slices, offset)), chunk.tobytes(), itemsize, filters)
+
+    try:
+        with h5py.File(filename_d, 'r+') as ncfile_d:
+            for varname, bufferChunk in direct_vars:
+                if verbose: sys.stdout.write('parallel compression of variable %s\n' % varname)
+                ncvar = ncfile_o.variables[varname]
+                # Copy the values as they are stored, no masking or scaling
+                ncvar.set_auto_maskandscale(False)
+                dset = ncfile_d[varname]
+                plist = dset.id.get_create_plist()
+                filters = [plist.get_filter(i)[0:3:2] for i in range(plist.get_nfilters())]
+                chunkShape = np.asarray(dset.chunks)
+                itemsize = dset.dtype.itemsize
+
+                for slices in hyperslabs(ncvar.shape, bufferChunk):
+                    read_start = time.perf_counter()
+                    data = ncvar[slices]
+                    write_start = time.perf_counter()
+                    if hashes is not None and varname in hashes: update_digest(hashes[varname], slices, data)
+                    chunks = buffer_chunks(data, slices, chunkShape, dset.fillvalue, dset.dtype, itemsize, filters)
+                    for offset, filtered in pool.imap(_filter_chunk_star, chunks, chunksize=direct_inflight):
+                        dset.id.write_direct_chunk(offset, filtered)
+                        window.release()
+                    if timings is not None:
+                        varstats = timings['variables'][varname]
+                        varstats['read'] += write_start - read_start
+                        varstats['write'] += time.perf_counter() - write_start
+    except BaseException:
+        # The task handler of the pool may be waiting for the window in buffer_chunks,
+        # and must finish before the pool can be terminated
+        stop.set()
+        window.release()
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+def new_digest(ncvar, chunkShape):
+    """
+    Return the state of a digest of the values of ncvar, made from a digest
+    of each chunk of chunkShape, so it doesn't depend on the order or the
+    blocks in which the values are read. The chunk digests are combined in
+    chunk index order, after the data type and shape of the variable
+    """
+    shape = tuple(int(n) for n in ncvar.shape)
+    chunkShape = np.maximum(np.minimum(np.asarray(chunkShape, dtype=int), shape), 1)
+    nChunks = (np.asarray(shape, dtype=int) - 1)//chunkShape + 1
+    return {'header' : '%s %s' % (np.dtype(ncvar.dtype).str, shape),
+            'chunks' : chunkShape,
+            'digests' : np.zeros(tuple(int(n) for n in nChunks) + (16,), dtype=np.uint8)}
+
+def update_digest(digest, slices, data):
+    """
+    Add the digests of the chunks in data, the values of the hyperslab slices
+    as they are stored. The hyperslab must be made of whole chunks, apart
+    from at the end of the variable, as the copy buffers of nc2nc are
+    """
+    chunkShape = digest['chunks']
+    for offset in hyperslabs(np.shape(data), chunkShape):
+        index = tuple((s.start + o.start)//n for s, o, n in zip(slices, offset, chunkShape))
+        block = np.ascontiguousarray(ma.getdata(data[offset])).tobytes()
+        digest['digests'][index] = np.frombuffer(hashlib.blake2b(block, digest_size=16).digest(), dtype=np.uint8)
+
+def hexdigest(digest):
+    """
+    Return the hex digest of the variable from the state of its digest
+    """
+    return hashlib.blake2b(digest['header'].encode() + digest['digests'].tobytes(), digest_size=16).hexdigest()
+
+def verify_digests(filename, digests, verbose=False, buffersize=50):
+    """
+    Return True if the variables in filename have the digests recorded by
+    nc2nc, reading each variable in copy buffers of whole chunks no larger
+    than buffersize MiB. Stops at the first variable which differs
+
+    digests -- dict of {'digest' : hex digest} by variable name
+    """
+
+    ncfile = Dataset(filename,'r')
+    try:
+        for varname, entry in digests.items():
+            if varname not in ncfile.variables:
+                if verbose: sys.stdout.write('Variable %s is missing from %s\n' % (varname, filename))
+                return False
+            ncvar = ncfile.variables[varname]
+            ncvar.set_auto_maskandscale(False)
+            chunkShape = ncvar.chunking() if ncfile.data_model.startswith('NETCDF4') else 'contiguous'
+            if chunkShape == 'contiguous': chunkShape = ncvar.shape
+            digest = new_digest(ncvar, chunkShape)
+            bufferChunk = buffer_shape(ncvar.shape, digest['chunks'], valSize=ncvar.dtype.itemsize,
+                                       bufferSize=buffersize*1024**2)
+            for slices in hyperslabs(ncvar.shape, bufferChunk):
+                update_digest(digest, slices, ncvar[slices])
+            if hexdigest(digest) != entry['digest']:
+                if verbose: sys.stdout.write('Digest of variable %s in %s differs\n' % (varname, filename))
+                return False
+    finally:
+        ncfile.close()
+
+    return True
+
+def write_manifest(filename, digests):
+    """
+    Write digests, as filled in by nc2nc, to the JSON file filename
+    """
+    with open(filename, 'w') as f:
+        json.dump({'algorithm' : 'blake2b', 'variables' : digests}, f, indent=1, sort_keys=True)
+
+def read_manifest(filename):
+    """
+    Return the digests in the manifest filename, for use with verify_digests
+    """
+    with open(filename) as f:
+        return json.load(f)['variables']
+
+def release_cache(ncvar):
+    """
+    Empty, and shrink to nothing, the chunk cache of ncvar (a netCDF4 Variable) once
+    it has been copied, so only the caches of the variable being copied are held.
+    Chunks of an output variable still in the cache are deflated and written
+    """
+    ncvar.set_var_chunk_cache(0, 1, 1.)
+
+def read_hyperslabs(ncfile, copy_vars):
+    """
+    Generate (variable name, slices, data) for every copy buffer of every
+    variable in copy_vars, read from ncfile (an open netCDF4 Dataset)
+
+    copy_vars -- list of (variable name, copy buffer shape, chunk cache settings,
+                 raw) where raw is True to read values as they are stored, with
+                 no masking or scaling
+    """
+
+    for varname, bufferChunk, cache, raw in copy_vars:
+        ncvar = ncfile.variables[varname]
+        if raw: ncvar.set_auto_maskandscale(False)
+        if cache is not None: ncvar.set_var_chunk_cache(*cache)
+        for slices in hyperslabs(ncvar.shape, bufferChunk):
+            yield varname, slices, ncvar[slices]
+        if cache is not None: release_cache(ncvar)
+
+def _read_ahead(filename, copy_vars, queue):
+    """
+    Read copy buffers from filename and put them on queue. Runs in a separate
+    process. The last message is the time spent waiting for the queue to have
+    space, or an error message
+    """
+
+    try:
+        wait = 0.
+        ncfile = Dataset(filename,'r')
+        for varname, slices, data in read_hyperslabs(ncfile, copy_vars):
+            start = time.time()
+            queue.put(('data', varname, slices, data))
+            wait += time.time() - start
+        ncfile.close()
+        queue.put(('done', wait))
+    except Exception as e:
+        queue.put(('error', str(e)))
+
+def prefetch_hyperslabs(filename, copy_vars, inflight, waits):
+    """
+    Generate the same values as read_hyperslabs, but read by a separate
+    process which reads ahead at most inflight copy buffers. The time the
+    reader spent waiting for the writer, and the writer spent waiting for
+    the reader, are added to waits['read'] and waits['write']
+    """
+
+    # Don't fork a process with open HDF5 files
+    context = mp.get_context('spawn')
+    queue = context.Queue(maxsize=inflight)
+    reader = context.Process(target=_read_ahead, args=(filename, copy_vars, queue))
+    reader.start()
+
+    try:
+        while True:
+            start = time.time()
+            message = queue.get()
+            waits['write'] += time.time() - start
+            if message[0] == 'data':
+                yield message[1:]
+            elif message[0] == 'done':
+                waits['read'] += message[1]
+                break
+            else:
+                raise IOError('Error reading %s: %s' % (filename, message[1]))
+    finally:
+        # The reader may be blocked on a full queue if the writer failed
+        if reader.is_alive(): reader.terminate()
+        reader.join()
+
+def values_equal(a, b):
+    """
+    Return True if the arrays a and b have the same shape, mask and
+    unmasked values. NaNs compare equal to NaNs
+
+    >>> values_equal(np.array([1., np.nan]), np.array([1., np.nan]))
+    True
+    """
+
+    if np.shape(a) != np.shape(b): return False
+    mask = ma.getmaskarray(a)
+    if not np.array_equal(mask, ma.getmaskarray(b)): return False
+    a = ma.getdata(a)[~mask]
+    b = ma.getdata(b)[~mask]
+    if a.dtype.kind in 'fc' and b.dtype.kind in 'fc':
+        return np.array_equal(a, b, equal_nan=True)
+    return np.array_equal(a, b)
+
+def compare_groups(group_a, group_b, buffersize, path=''):
+    """
+    Return None if the variables in group_a and group_b (open netCDF4
+    Datasets or Groups), and all their sub-groups, contain the same values,
+    otherwise a description of the first difference found
+    """
+
+    if set(group_a.variables) != set(group_b.variables):
+        return 'Variables in %s differ' % (path or '/')
+    if set(group_a.groups) != set(group_b.groups):
+        return 'Groups in %s differ' % (path or '/')
+
+    for varname, var_a in group_a.variables.items():
+        var_b = group_b.variables[varname]
+        name = path + '/' + varname
+        if var_a.shape != var_b.shape:
+            return 'Shape of %s differs: %s %s' % (name, var_a.shape, var_b.shape)
+        # Compare packed values, but masked where there are fill or missing values
+        var_a.set_auto_scale(False)
+        var_b.set_auto_scale(False)
+        if var_a.shape == ():
+            if not values_equal(var_a[...], var_b[...]): return 'Values of %s differ' % name
+            continue
+        # Read whole chunks of the second (usually compressed) file
+        chunking = var_b.chunking() if group_b.data_model.startswith('NETCDF4') else 'contiguous'
+        if chunking == 'contiguous': chunking = [1]*len(var_b.shape)
+        valSize = dtypes.get(var_b.dtype.char, var_b.dtype.itemsize)
+        bufferChunk = buffer_shape(var_b.shape, chunking, valSize=valSize, bufferSize=buffersize)
+        for slices in hyperslabs(var_b.shape, bufferChunk):
+            if not values_equal(var_a[slices], var_b[slices]):
+                return 'Values of %s differ in %s' % (name, str(slices))
+
+    for groupname in group_a.groups:
+        difference = compare_groups(group_a.groups[groupname], group_b.groups[groupname], 
+                                    buffersize, path + '/' + groupname)
+        if difference is not None: return difference
+
+    return None
+
+def compare(filename_a, filename_b, buffersize=50, verbose=False):
+    """
+    Return True if the netCDF files filename_a and filename_b contain the
+    same variables and groups with the same values. Variables are read one
+    copy buffer (buffersize MiB) at a time, made of whole chunks of
+    filename_b, and the comparison stops at the first difference
+    """
+
+    ncfile_a = Dataset(filename_a,'r')
+    try:
+        ncfile_b = Dataset(filename_b,'r')
+        try:
+            difference = compare_groups(ncfile_a, ncfile_b, buffersize*(1024**2))
+        finally:
+            ncfile_b.close()
+    finally:
+        ncfile_a.close()
+
+    if difference is not None and verbose: 
+        sys.stdout.write('%s and %s differ: %s\n' % (filename_a, filename_b, difference))
+
+    return difference is None
+
+def sample_chunks(varShape, chunkShape, fraction, seed=0):
+    """
+    Return a list of tuples of slices for a reproducible random sample of
+    fraction of the chunks of shape chunkShape in a variable of shape
+    varShape. The first and last chunks, which are at the start and end
+    of the unlimited dimension (if any), are always included
+
+    >>> sample_chunks((4,4),(2,2),0.)
+    [(slice(0, 2, None), slice(0, 2, None)), (slice(2, 4, None), slice(2, 4, None))]
+    """
+
+    varShape = np.asarray(varShape, dtype=int)
+    chunkShape = np.maximum(np.minimum(np.asarray(chunkShape, dtype=int), varShape), 1)
+    nChunks = (varShape - 1)//chunkShape + 1
+    total = numVals(nChunks)
+    if total <= 0: return []
+
+    # The rest of the sample is chosen from the chunks between the first and last
+    sample = set([0, total - 1])
+    nsample = min(int(math.ceil(fraction*total)), total) - len(sample)
+    if nsample > 0:
+        sample.update(1 + int(i) for i in np.random.RandomState(seed).choice(total - 2, nsample, replace=False))
+
+    chunks = []
+    for i in sorted(sample):
+        start = np.asarray(np.unravel_index(i, nChunks))*chunkShape
+        chunks.append(tuple(slice(int(b), int(min(b+c, n)), None) for b, c, n in zip(start, chunkShape, varShape)))
+    return chunks
+
+def sample_groups(group_a, group_b, fraction, seed, counts, path=''):
+    """
+    Return None if a sample of fraction of the chunks of each variable in
+    group_b (an open netCDF4 Dataset or Group), and all its sub-groups, have
+    the same values in group_a, otherwise a description of the first
+    difference found. The number of values compared, and the total number
+    of values, are added to counts['compared'] and counts['total']
+    """
+
+    if set(group_a.variables) != set(group_b.variables):
+        return 'Variables in %s differ' % (path or '/')
+    if set(group_a.groups) != set(group_b.groups):
+        return 'Groups in %s differ' % (path or '/')
+
+    for varname, var_a in group_a.variables.items():
+        var_b = group_b.variables[varname]
+        name = path + '/' + varname
+        if var_a.shape != var_b.shape:
+            return 'Shape of %s differs: %s %s' % (name, var_a.shape, var_b.shape)
+        var_a.set_auto_scale(False)
+        var_b.set_auto_scale(False)
+        counts['total'] += numVals(var_b.shape)
+        if var_a.shape == ():
+            counts['compared'] += 1
+            if not values_equal(var_a[...], var_b[...]): return 'Values of %s differ' % name
+            continue
+        chunking = var_b.chunking() if group_b.data_model.startswith('NETCDF4') else 'contiguous'
+        if chunking == 'contiguous': chunking = chunk_shape_nD(var_b.shape)
+        # Each variable has a different, but reproducible, sample
+        for slices in sample_chunks(var_b.shape, chunking, fraction, (seed + zlibmodule.crc32(name.encode())) % 2**32):
+            counts['compared'] += numVals([s.stop - s.start for s in slices])
+            if not values_equal(var_a[slices], var_b[slices]):
+                return 'Values of %s differ in %s' % (name, str(slices))
+
+    for groupname in group_a.groups:
+        difference = sample_groups(group_a.groups[groupname], group_b.groups[groupname], 
+                                   fraction, seed, counts, path + '/' + groupname)
+        if difference is not None: return difference
+
+    return None
+
+def compare_sample(filename_a, filename_b, fraction, seed=0, verbose=False):
+    """
+    Compare a reproducible random sample of fraction of the chunks of each
+    variable in filename_b with the same region of filename_a. Returns
+    (equal, compared, total), where equal is True if no differences were
+    found, and compared is the number of values which were compared out of
+    total values
+    """
+
+    counts = {'compared' : 0, 'total' : 0}
+    ncfile_a = Dataset(filename_a,'r')
+    try:
+        ncfile_b = Dataset(filename_b,'r')
+        try:
+            difference = sample_groups(ncfile_a, ncfile_b, fraction, seed, counts)
+        finally:
+            ncfile_b.close()
+    finally:
+        ncfile_a.close()
+
+    if verbose:
+        if difference is not None:
+            sys.stdout.write('%s and %s differ: %s\n' % (filename_a, filename_b, difference))
         else:
+            sys.stdout.write('Sample of %s is the same as %s: %d of %d values (%.1f%%)\n' % 
+                             (filename_b, filename_a, counts['compared'], counts['total'],
+                              100.*counts['compared']/max(counts['total'], 1)))
 
-            # Make sure our chunk size is no larger than the dimension in that direction
-            for ind, chunk in enumerate(bufferChunk):
-                if chunk > dimlim[ind]: bufferChunk[ind] = dimlim[ind]
-    
-            if verbose: sys.stdout.write('Buffer chunk : %s\n' % str(bufferChunk))
+    return difference is None, counts['compared'], counts['total']
 
-            # bufferSteps is the number of copies of bufferChunk that fit along each axis
-            bufferSteps = (dimlim-1)//bufferChunk + 1
-    
-            # Make an iterator out of all possible combinations of the bufferOffsets, which
-            # are just steps along each dimension
-            for index in np.ndindex(*bufferSteps):
-                index *= bufferChunk
-                slices = []
-                # Make up slices of size bufferChunk
-                for start, step, end in zip(index, bufferChunk, dimlim):
-                    # min checks we don't go beyond the limits of the variable
-                    slices.append(slice(start,min(start+step,end),None))
-                # Copy the data
-                var[slices] = ncvar[slices] 
+def dlevel_type(value):
+    """
+    Convert a --dlevel option, a deflate level from 0 to 9 or auto, to the
+    complevel passed to nc2nc
+    """
+    if value == 'auto': return value
+    try:
+        level = int(value)
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 9:
+        raise argparse.ArgumentTypeError("dlevel must be auto, or 0-9")
+    return level
+
+def verify_type(value):
+    """
+    Convert a --verify option, full or sample:FRACTION, to the fraction of
+    chunks to compare, where 1 is a full comparison
+    """
+    if value == 'full': return 1.
+    try:
+        kind, fraction = value.split(':')
+        fraction = float(fraction)
+    except ValueError:
+        raise argparse.ArgumentTypeError("verify must be full or sample:FRACTION")
+    if kind != 'sample' or not 0. < fraction <= 1.:
+        raise argparse.ArgumentTypeError("verify must be full or sample:FRACTION, with 0 < FRACTION <= 1")
+    return fraction
+
+def schema_fingerprint(ncfile, options):
+    """
+    Return a digest of the schema of ncfile (an open netCDF4 Dataset): its data model,
+    dimensions, and the name, type, dimensions, shape, chunking and attribute names of
+    each variable, and of options (a dict which can be written as JSON). Files with the
+    same fingerprint are copied with the same plan
+    """
+    chunked = ncfile.data_model.startswith('NETCDF4')
+    schema = {
+        'format' : ncfile.data_model,
+        'dimensions' : [(dimname, len(dim), dim.isunlimited()) for dimname, dim in ncfile.dimensions.items()],
+        'variables' : [(varname, str(ncvar.dtype), ncvar.dimensions, ncvar.shape,
+                        ncvar.chunking() if chunked else None, sorted(ncvar.ncattrs()))
+                       for varname, ncvar in ncfile.variables.items()],
+        'options' : options,
+    }
+    return hashlib.blake2b(json.dumps(schema, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+class PlanCache(object):
+    """ Copy plans, keyed on schema fingerprint, stored in a SQLite database
+        which can be shared by several processes and runs
+    """
+
+    def __init__(self, path):
+        # Wait for other processes writing to the cache
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS plans (
+                                   fingerprint TEXT PRIMARY KEY,
+                                   plan TEXT)""")
+        self.connection.commit()
+
+    def get(self, fingerprint):
+        """ Return the plan for fingerprint, or None if it is not in the cache
+        """
+        row = self.connection.execute("SELECT plan FROM plans WHERE fingerprint=?", (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, fingerprint, plan):
+        """ Store plan for fingerprint
+        """
+        self.connection.execute("INSERT OR REPLACE INTO plans VALUES (?,?)", (fingerprint, json.dumps(plan)))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+# Copy plans of the files copied by this process, keyed on schema fingerprint. The
+# oldest plan is discarded when there are more than max_plans
+plans = {}
+max_plans = 1000
+
+def plan_variable(ncfile, ncvar, chunksize, buffersize, mindim=1, chunking='balanced', verbose=False):
+    """
+    Return the plan for copying ncvar, a variable of ncfile (an open netCDF4 Dataset):
+    a dict of the chunk shape (chunks), copy buffer shape (buffer), output and input
+    chunk cache settings (cache and incache), and the number of chunks each read of the
+    access pattern of the chunking strategy touches (touched). All are None for scalar
+    variables. chunksize and buffersize are in bytes
+    """
+
+    varplan = {'chunks' : None, 'buffer' : None, 'cache' : None, 'incache' : None, 'touched' : None}
+    valSize = dtypes[ncvar.dtype.char]
+    if verbose: sys.stdout.write('Variable shape: %s\n' % str(ncvar.shape))
+    if ncvar.shape == ():
+        if verbose: sys.stdout.write('Chunk sizes: None\n')
+        return varplan
+
+    chunksizes = chunk_shape(ncvar.shape,valSize=valSize,minDim=mindim,chunkSize=chunksize,strategy=chunking)
+    if verbose: sys.stdout.write('Chunk sizes: %s\n' % str(chunksizes))
+    varplan['chunks'] = [int(n) for n in chunksizes]
+    varplan['touched'] = predict_chunks(ncvar.shape,chunksizes,chunking)
+    if verbose:
+        sys.stdout.write('Chunks touched per read: %s\n' % ', '.join('%s %g' % (name, predict_chunks(ncvar.shape,chunksizes,name))
+                                                                     for name in sorted(chunk_strategies)))
+
+    # bufferChunk is a whole multiple of the chunksizes which is less than the size
+    # of copy buffer, so every output chunk is written (and deflated) exactly once
+    bufferChunk = buffer_shape(ncvar.shape,chunksizes,valSize=valSize,bufferSize=buffersize)
+    varplan['buffer'] = [int(n) for n in bufferChunk]
+
+    # Size the chunk caches to hold all the chunks touched by one copy buffer. Every
+    # output chunk is written exactly once, so fully written chunks are preempted first
+    varplan['cache'] = list(chunk_cache(ncvar.shape,bufferChunk,chunksizes,valSize=valSize,preemption=1.))
+    if verbose: sys.stdout.write('Output chunk cache (size, nelems, preemption): %s\n' % str(tuple(varplan['cache'])))
+    # netCDF3 and contiguous netCDF4 input variables have no chunk cache
+    if ncfile.data_model.startswith('NETCDF4') and ncvar.chunking() != 'contiguous':
+        varplan['incache'] = list(chunk_cache(ncvar.shape,bufferChunk,ncvar.chunking(),valSize=valSize))
+        if verbose: sys.stdout.write('Input chunk cache (size, nelems, preemption): %s\n' % str(tuple(varplan['incache'])))
+
+    return varplan
+
+def limit_caches(plan, cacheSize):
+    """
+    Scale down the output and input chunk caches of each variable in plan, a dict of
+    plan_variable results by variable name, so the caches of a variable total no more
+    than cacheSize bytes. Caches are emptied once their variable is copied, so only
+    the caches of one variable are held at a time
+    """
+    for varplan in plan.values():
+        caches = [varplan[key] for key in ('cache', 'incache') if varplan[key] is not None]
+        total = sum(cache[0] for cache in caches)
+        if total <= cacheSize: continue
+        for cache in caches:
+            cache[0] = int(cache[0]*cacheSize//total)
+
+def nc2nc(filename_o, filename_d, zlib=True, complevel=5, shuffle=True, fletcher32=False,
+    clobber=False, verbose=False, classic=True, lsd_dict=None, vars=None, chunksize=4, buffersize=50, mindim=1,ignoreformat=False,
+    chunkcache=None, numproc=1, pipeline=0, digests=None, manifest=None, stats=None, tolerance=0.05, decisions=None,
+    chunking='balanced', plancache=None):
+    """
+    Copy the netCDF file filename_o to filename_d, compressing and rechunking
+    the variables. Returns False, without copying, if filename_d exists and
+    clobber is False, otherwise True. Both files are closed if the copy fails.
+
+    zlib         -- deflate the variables
+    complevel    -- deflate level, or 'auto' to choose the level and shuffle of
+                    each variable with choose_deflate
+    shuffle      -- shuffle the bytes of values before deflating
+    fletcher32   -- add a checksum to each chunk
+    clobber      -- overwrite filename_d if it exists
+    verbose      -- print the plan and progress of the copy
+    classic      -- write NETCDF4_CLASSIC format, otherwise NETCDF4
+    lsd_dict     -- least significant digit to quantize (lossy) each variable
+                    to, by variable name
+    vars         -- names of the variables to copy, with the dimension
+                    variables (default all)
+    chunksize    -- size of each chunk, in KiB
+    buffersize   -- size of the copy buffer, in MiB
+    mindim       -- minimum length of each dimension of a chunk
+    ignoreformat -- copy NETCDF4 format input, with a warning
+    chunkcache   -- limit on the combined size of the input and output chunk
+                    caches of each variable, in MiB (default is to fit the
+                    chunks one row of a copy buffer touches)
+    numproc      -- number of processes which deflate the chunks of each
+                    variable, written with direct chunk writes (requires h5py)
+    pipeline     -- number of copy buffers a separate process reads ahead
+    digests      -- dict filled with the digest of each variable which is not
+                    quantized, for verify_digests
+    manifest     -- JSON file the digests are also written to
+    stats        -- dict filled with the time spent opening the files and
+                    copying metadata (open), planning (plan), and flushing and
+                    closing the output (sync), the chunks, reading and writing
+                    time and chunks touched of each variable (variables), the
+                    bytes in and out, total time, rate (MB/s), CPU times,
+                    the high-water mark of the resident set size of the whole
+                    process (maxrss, KB) and where the plan came from
+                    (plan_cache: 'memory', 'disk' or None)
+    tolerance    -- with complevel 'auto', fraction of the best compression
+                    ratio the cheapest setting chosen must be within
+    decisions    -- dict of the level and shuffle chosen for each variable,
+                    used for variables already in it
+    chunking     -- chunking strategy, the name of one of chunk_strategies or a
+                    list of weights for each dimension
+    plancache    -- path of a PlanCache which stores copy plans between runs
+
+    The copy plan of a file (its chunk shapes, copy buffers, chunk caches and
+    deflate choices) is kept in memory, keyed on its schema_fingerprint and
+    the options, and reused for later files with the same fingerprint.
+    """
+
+    if os.path.isfile(filename_d) and not clobber:
+        sys.stderr.write('Output file already exists: %s. Use -o option to overwrite\n' % filename_d)
+        return False
+
+    if numproc > 1 and h5py is None:
+        raise ImportError('h5py is required for parallel compression (numproc > 1)')
+
+    # Variables which are copied after the file is defined, and those which are
+    # compressed in parallel and written after the file is closed
+    copy_vars = []
+    direct_vars = []
+
+    # Digests of the chunks of variables for which digests are computed
+    if manifest is not None and digests is None: digests = {}
+    hashes = {}
+
+    # Time spent in each stage, and for each variable
+    timer = time.perf_counter
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    time_start = timer()
+    timings = {'plan' : 0., 'sync' : 0., 'variables' : {}}
+
+    if complevel == 'auto' and decisions is None: decisions = {}
+
+    ncfile_o = Dataset(filename_o,'r')
+    # Both files are closed if the copy fails, as nc2nc is called from long lived
+    # nccompress worker processes
+    ncfile_d = None
+    try:
+        if ncfile_o.file_format is "NETCDF4":
+            if ignoreformat:
+                warn('netCDF4 formatted file .. ignoring')
+            else:
+                raise FormatError('nc2nc is not tested to work with netCDF4 files, only netCDF4 Classic, and netCDF3. See --ignoreformat option to ignore warning')
+        
+        if classic:
+            ncfile_d = Dataset(filename_d,'w',clobber=clobber,format='NETCDF4_CLASSIC')
+        else:
+            ncfile_d = Dataset(filename_d,'w',clobber=clobber,format='NETCDF4')
+        mval = 1.e30 # missing value if unpackshort=True
+
+        # Copy buffer specified in MiB, so convert to bytes
+        buffersize = buffersize*(1024**2)
+        # Chunk size specified in KiB, so convert to bytes
+        chunksize = chunksize*1024
+        # Chunk cache specified in MiB, so convert to bytes
+        if chunkcache is not None: chunkcache = chunkcache*(1024**2)
+
+        # create dimensions. Check for unlimited dim.
+        unlimdimname = False
+        unlimdim = None
+
+        # create global attributes.
+        if verbose: sys.stdout.write('copying global attributes ..\n')
+        #for attname in ncfile_o.ncattrs():
+        #    setattr(ncfile_d,attname,getattr(ncfile_o,attname))
+        ncfile_d.setncatts(ncfile_o.__dict__) 
+
+        # Copy dimensions
+        if verbose: sys.stdout.write('copying dimensions ..\n')
+        for dimname,dim in ncfile_o.dimensions.items():
+            if dim.isunlimited():
+                unlimdimname = dimname
+                unlimdim = dim
+                ncfile_d.createDimension(dimname,None)
+            else:
+                ncfile_d.createDimension(dimname,len(dim))
+
+        # create variables.
+        if vars is None:
+           varnames = ncfile_o.variables.keys()
+        else:
+           # variables to copy specified
+           varnames = vars
+           # add dimension variables
+           for dimname in ncfile_o.dimensions.keys():
+               if dimname in ncfile_o.variables.keys() and dimname not in varnames:
+                   varnames.append(dimname)
+
+        # Reuse the plan of a file with the same schema copied with the same options
+        plan_start = timer()
+        fingerprint = schema_fingerprint(ncfile_o, {
+            'vars' : sorted(varnames), 'chunksize' : chunksize, 'buffersize' : buffersize, 'mindim' : mindim,
+            'chunkcache' : chunkcache, 'chunking' : chunking, 'zlib' : zlib, 'complevel' : complevel,
+            'shuffle' : shuffle, 'tolerance' : tolerance})
+        plan = plans.get(fingerprint)
+        timings['plan_cache'] = None if plan is None else 'memory'
+        if plan is None and plancache is not None:
+            cache = PlanCache(plancache)
+            plan = cache.get(fingerprint)
+            cache.close()
+            if plan is not None: timings['plan_cache'] = 'disk'
+        if verbose and plan is not None:
+            sys.stdout.write('Using plan from %s cache: %s\n' % (timings['plan_cache'], fingerprint))
+        if plan is None: plan = {}
+        # The plan is stored if it is new, or has been added to
+        planchanged = timings['plan_cache'] != 'memory'
+        timings['plan'] += timer() - plan_start
+
+        # Plan every variable first, so the chunk caches can be limited before copying
+        for varname in varnames:
+            ncvar = ncfile_o.variables[varname]
+            varstats = timings['variables'][varname] = {'plan' : 0., 'read' : 0., 'write' : 0., 
+                                                         'bytes' : numVals(ncvar.shape)*np.dtype(ncvar.dtype).itemsize}
+            plan_start = timer()
+
+            # check we have a mapping from the type to a number of bytes
+            if ncvar.dtype.char not in dtypes: 
+                # Raise rather than exit, as nc2nc is called directly from nccompress worker processes
+                raise FormatError("This datatype not supported: dtype : %s" % ncvar.dtype.char)
+
+            if varname not in plan:
+                if verbose: sys.stdout.write('planning variable %s\n' % varname)
+                plan[varname] = plan_variable(ncfile_o, ncvar, chunksize, buffersize, mindim, chunking, verbose)
+                planchanged = True
+
+            varstats['plan'] += timer() - plan_start
+
+        if chunkcache is not None: limit_caches(plan, chunkcache)
+
+        for varname in varnames:
+            ncvar = ncfile_o.variables[varname]
+            if verbose: sys.stdout.write('copying variable %s\n' % varname)
+            # quantize data?
+            if lsd_dict is not None and varname in lsd_dict:
+                lsd = int(lsd_dict[varname])
+                if verbose: sys.stdout.write('truncating to least_significant_digit = %d\n'%lsd)
+            else:
+                lsd = None # no quantization.
+            datatype = ncvar.dtype
+
+            # is there an unlimited dimension?
+            if unlimdimname and unlimdimname in ncvar.dimensions:
+                hasunlimdim = True
+            else:
+                hasunlimdim = False
+
+            if hasattr(ncvar, '_FillValue'):
+                FillValue = ncvar._FillValue
+            else:
+                FillValue = None 
+
+            varstats = timings['variables'][varname]
+            plan_start = timer()
+
+            varplan = plan[varname]
+            chunksizes = varplan['chunks']
+            if varplan['touched'] is not None: varstats['touched'] = varplan['touched']
+
+            varlevel, varshuffle = complevel, shuffle
+            if complevel == 'auto':
+                # Variables which can't be sampled use the cheapest level
+                varlevel = trial_levels[0]
+                if varname in decisions:
+                    varlevel, varshuffle = decisions[varname]['level'], decisions[varname]['shuffle']
+                elif zlib and chunksizes is not None and ncvar.dtype.char != 'S' and numVals(ncvar.shape) > 0:
+                    # Choices passed in decisions are not part of the plan, only those from trials
+                    if 'deflate' not in varplan:
+                        varplan['deflate'] = choose_deflate(ncvar, chunksizes, shuffle, tolerance=tolerance)
+                        planchanged = True
+                    decisions[varname] = varplan['deflate']
+                    varlevel, varshuffle = decisions[varname]['level'], decisions[varname]['shuffle']
+                if verbose: sys.stdout.write('Deflate level: %d shuffle: %s\n' % (varlevel, varshuffle))
+                varstats['level'] = varlevel
+                varstats['shuffle'] = varshuffle
+
+            varstats['plan'] += timer() - plan_start
+            varstats['chunks'] = None if chunksizes is None else [int(n) for n in chunksizes]
+
+            # Create the variable we will copy to
+            var = ncfile_d.createVariable(varname, datatype, ncvar.dimensions, fill_value=FillValue, least_significant_digit=lsd, zlib=zlib, complevel=varlevel, shuffle=varshuffle, fletcher32=fletcher32, chunksizes=chunksizes)
+            # fill variable attributes.
+            attdict = ncvar.__dict__
+            if '_FillValue' in attdict: del attdict['_FillValue']
+            var.setncatts(attdict)
+
+            # fill variable with data.
+
+            dimlim = np.asarray(ncvar.shape)
+            incache = varplan['incache']
+            if (ncvar.shape != ()):
+                bufferChunk = np.asarray(varplan['buffer'])
+                var.set_var_chunk_cache(*varplan['cache'])
+
+            timings['plan'] += varstats['plan']
+
+            if digests is not None and lsd is None:
+                hashes[varname] = new_digest(ncvar, () if chunksizes is None else chunksizes)
+
+            # Variables with an unlimited dimension cannot be extended with direct chunk
+            # writes, and quantization is applied by the netCDF library, so these are
+            # always copied through the library
+            if (numproc > 1 and zlib and chunksizes is not None and not hasunlimdim and
+                lsd is None and ncvar.dtype.char != 'S' and numVals(ncvar.shape) > 0):
+                direct_vars.append((varname, bufferChunk))
+            elif ncvar.shape == ():
+                if lsd is None:
+                    ncvar.set_auto_maskandscale(False)
+                    var.set_auto_maskandscale(False)
+                var[:] = ncvar[:]
+                if varname in hashes: update_digest(hashes[varname], (), ncvar[...])
+            else:
+                # Copy values as they are stored, unless they are quantized when written
+                if lsd is None: var.set_auto_maskandscale(False)
+                copy_vars.append((varname, bufferChunk, incache, lsd is None))
+
+                if verbose and not np.all(bufferChunk >= dimlim):
+                    sys.stdout.write('Buffer chunk : %s\n' % str(bufferChunk))
+                    touched = [chunks_touched(slices, chunksizes) for slices in hyperslabs(dimlim, bufferChunk)]
+                    if len(touched) > 0:
+                        sys.stdout.write('Writes: %d, chunks per write: %d-%d, chunks written: %d of %d\n' % 
+                                         (len(touched), min(touched), max(touched), sum(touched),
+                                          numVals((dimlim-1)//chunksizes + 1)))
+
+        if planchanged:
+            plan_start = timer()
+            plans.pop(fingerprint, None)
+            plans[fingerprint] = plan
+            while len(plans) > max_plans: del plans[next(iter(plans))]
+            if plancache is not None:
+                cache = PlanCache(plancache)
+                cache.put(fingerprint, plan)
+                cache.close()
+            timings['plan'] += timer() - plan_start
+
+        # fill variables with data.
+        if pipeline > 0:
+            waits = {'read' : 0., 'write' : 0.}
+            slabs = prefetch_hyperslabs(filename_o, copy_vars, pipeline, waits)
+        else:
+            slabs = read_hyperslabs(ncfile_o, copy_vars)
+
+        # Everything up to copying the data is opening the files and copying the metadata
+        timings['open'] = timer() - time_start - timings['plan']
+
+        # Time reading each copy buffer (or waiting for the reader), and writing it.
+        # The cache of each variable is emptied as soon as it has been copied, and
+        # the time to write the chunks left in it is part of writing the variable
+        read_start = timer()
+        current = None
+        for varname, slices, data in slabs:
+            write_start = timer()
+            timings['variables'][varname]['read'] += write_start - read_start
+            if varname != current:
+                if current is not None:
+                    release_cache(ncfile_d.variables[current])
+                    timings['variables'][current]['write'] += timer() - write_start
+                    write_start = timer()
+                current = varname
+            ncfile_d.variables[varname][slices] = data
+            if varname in hashes: update_digest(hashes[varname], slices, data)
+            read_start = timer()
+            timings['variables'][varname]['write'] += read_start - write_start
+        if current is not None:
+            write_start = timer()
+            release_cache(ncfile_d.variables[current])
+            timings['variables'][current]['write'] += timer() - write_start
+
+        if pipeline > 0 and verbose:
+            sys.stdout.write('Pipeline waits: reader %.3f s, writer %.3f s\n' % (waits['read'], waits['write']))
+
+        sync_start = timer()
 
         ncfile_d.sync() # flush data to disk
 
-    # close files.
-    ncfile_o.close()
-    ncfile_d.close()
+        ncfile_d.close()
+
+        timings['sync'] += timer() - sync_start
+
+        if len(direct_vars) > 0:
+            write_direct(ncfile_o, filename_d, direct_vars, numproc, verbose, hashes, timings)
+    except BaseException:
+        if ncfile_d is not None and ncfile_d.isopen(): ncfile_d.close()
+        raise
+    finally:
+        ncfile_o.close()
+
+    if stats is not None:
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        stats.update(timings)
+        stats['total'] = timer() - time_start
+        stats['bytes_in'] = sum(varstats['bytes'] for varstats in timings['variables'].values())
+        stats['bytes_out'] = os.path.getsize(filename_d)
+        stats['rate'] = transfer_rate(stats['bytes_in'], stats['total'])
+        for varstats in timings['variables'].values():
+            varstats['rate'] = transfer_rate(varstats['bytes'], varstats['read'] + varstats['write'])
+        stats['utime'] = usage_end.ru_utime - usage_start.ru_utime
+        stats['stime'] = usage_end.ru_stime - usage_start.ru_stime
+        # High-water mark of this process, not only of this copy
+        stats['maxrss'] = usage_end.ru_maxrss
+
+    if digests is not None:
+        for varname, digest in hashes.items():
+            digests[varname] = {'digest' : hexdigest(digest)}
+        if manifest is not None: write_manifest(manifest, digests)
+
+    return True
 
 def parse_args(arglist):
     """
@@ -339,17 +1541,26 @@ def parse_args(arglist):
         return ivalue
 
     parser = argparse.ArgumentParser(description="Make a copy of a netCDF file with automatic chunk sizing")
-    parser.add_argument("-d","--dlevel", help="Set deflate level. Valid values 0-9 (default=5)", type=int, default=5, choices=range(0,10), metavar='{1-9}')
+    parser.add_argument("-d","--dlevel", help="Set deflate level. Valid values 0-9, or auto to choose the level and shuffle for each variable by compressing a sample of its chunks (default=5)", type=dlevel_type, default=5, metavar='{0-9,auto}')
+    parser.add_argument("--tolerance", help="With --dlevel auto, choose the cheapest setting with a compression ratio within this percentage of the best (default=5)", type=float, default=5.)
+    parser.add_argument("--decisions", help="With --dlevel auto, apply the level and shuffle in this JSON file to variables of the same name, and write the choices made to it")
     parser.add_argument("-m","--mindim", help="Minimum dimension of chunk. Valid values 1-dimsize", type=positive_int, default=1)
+    parser.add_argument("--chunking", help="Chunking strategy: balanced for any 1D or 2D subset, timeseries for the whole of the first dimension at a point, spatial for the whole of the last two dimensions at one time, or a comma separated weight for each of the last dimensions (default=balanced)", type=chunking_type, default='balanced')
+    parser.add_argument("--plan-cache", help="Store the chunking and copy buffer plan of each file in this SQLite file, and reuse it for files with the same variables, dimensions and options", dest='plancache', default=None)
     parser.add_argument("-s","--chunksize", help="Set chunksize - total size of one chunk in KiB (default=64)", type=int, default=64)
     parser.add_argument("-b","--buffersize", help="Set size of copy buffer in MiB (default=500)", type=int, default=500)
+    parser.add_argument("-cc","--chunkcache", help="Limit the size of the HDF5 input and output chunk caches of each variable in MiB (default is to fit the chunks one row of the copy buffer touches)", type=int, default=None)
     parser.add_argument("-n","--noshuffle", help="Don't shuffle on deflation (default is to shuffle)", action='store_true')
+    parser.add_argument("-np","--numproc", help="Compress the chunks of each variable with this number of processes, requires h5py (default=1)", type=positive_int, default=1)
+    parser.add_argument("-pl","--pipeline", help="Read ahead up to this number of copy buffers in a separate process while compressing (default=0, no read ahead)", type=int, default=0)
     parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
     parser.add_argument("-c","--classic", help="use NETCDF4_CLASSIC output instead of NETCDF4 (default true)", action='store_false')
     parser.add_argument("-f","--fletcher32", help="Activate Fletcher32 checksum", action='store_true')
     parser.add_argument("-va","--vars", help="Specify variables to copy (default is to copy all)", action='append')
     parser.add_argument("-q","--quantize", help="Truncate data in variable to a given decimal precision, e.g. -q speed=2 -q temp=0 causes variable speed to be truncated to a precision of 0.01 and temp to a precision of 1", action=DictAction)
     parser.add_argument("-o","--overwrite", help="Write output file even if already it exists (default is to not overwrite)", action='store_true')
+    parser.add_argument("--verify", help="Check the output against the original: full compares all the data, sample:FRACTION compares a random sample of that fraction of the chunks of each variable", type=verify_type, default=None)
+    parser.add_argument("--manifest", help="Write a digest of each variable, computed as it is copied, to this JSON file")
     parser.add_argument("-i","--ignoreformat", help="Ignore warnings about netCDF4 formatted file: BE CAREFUL! (default false)", action='store_true')
     parser.add_argument("origin", help="netCDF file to be compressed")
     parser.add_argument("destination", help="netCDF output file")
@@ -359,14 +1570,38 @@ def parse_args(arglist):
 def main(args):
     
     zlib=False
-    if args.dlevel > 0: zlib=True
+    if args.dlevel == 'auto' or args.dlevel > 0: zlib=True
  
     verbose = args.verbose
 
+    decisions = None
+    if args.decisions is not None:
+        decisions = {}
+        if os.path.exists(args.decisions):
+            with open(args.decisions) as f:
+                decisions = json.load(f)
+
     # copy the data from origin to destination
     nc2nc(args.origin, args.destination, zlib=zlib, complevel=args.dlevel, shuffle=not args.noshuffle,
         fletcher32=args.fletcher32, clobber=args.overwrite, lsd_dict=args.quantize,
-        verbose=verbose, vars=args.vars, classic=args.classic, chunksize=args.chunksize, buffersize=args.buffersize, ignoreformat=args.ignoreformat)
+        verbose=verbose, vars=args.vars, classic=args.classic, chunksize=args.chunksize, buffersize=args.buffersize, ignoreformat=args.ignoreformat,
+        chunkcache=args.chunkcache, numproc=args.numproc, pipeline=args.pipeline, manifest=args.manifest,
+        tolerance=args.tolerance/100., decisions=decisions, chunking=args.chunking,
+        plancache=args.plancache)
+
+    if decisions is not None:
+        with open(args.decisions, 'w') as f:
+            json.dump(decisions, f, indent=1, sort_keys=True)
+
+    if args.verify is not None:
+        if args.verify < 1.:
+            equal, compared, total = compare_sample(args.origin, args.destination, args.verify, verbose=verbose)
+            sys.stdout.write('Verified %d of %d values (%.1f%%)\n' % (compared, total, 100.*compared/max(total, 1)))
+        else:
+            equal = compare(args.origin, args.destination, verbose=verbose)
+        if not equal:
+            sys.stderr.write('%s is not the same as %s\n' % (args.destination, args.origin))
+            sys.exit(1)
                 
 def main_parse_args(arglist):
     """
@@ -25,13 +25,22 @@ import netCDF4 as nc
 import argparse
 import re
 from warnings import warn
-from shutil import move, which
+from shutil import move
 from collections import defaultdict
 import math
 import operator
 import numpy as np
 import numpy.ma as ma
 import multiprocessing as mp
+import queue
+import resource
+import time
+import heapq
+import collections
+import json
+import hashlib
+from nccompress import nc2nc
+from nccompress.ncfind import sniff_format, probe_file, stat_key, ScanIndex
 
 if (sys.version_info > (3, 0)):
      # Python 3 code in this block
@@ -40,21 +49,19 @@ else:
      # Python 2 code in this block
      netcdf4exception = IOError
 
-# A couple of hard-wired executable paths that might need changing
-
-# Need to use system time command explicitly, otherwise get crippled bash version
-timecmd='/usr/bin/time'
+# A hard-wired executable path that might need changing
 nccopy='nccopy'
-nc2nc='nc2nc'
-cdocmd='cdo'
-
-cdofound = None
 
-result_list=[]
     
 def is_netCDF(ncfile):
     """ Test to see if ncfile is a valid netCDF file
     """
+    # Check the magic number, so only HDF5 files need to be opened
+    format = sniff_format(ncfile)
+    if format is None:
+        return (False, None)
+    if format.startswith("NETCDF3"):
+        return (format, False)
     try:
         tmp = nc.Dataset(ncfile)
         format = tmp.file_format
@@ -84,75 +91,46 @@ def is_compressed(ncfile):
 
     return compressed
         
-def are_equal(infile,outfile,verbose):
-    """ Run cdo diffn on the input and output netCDF files to ensure
-        they are identical
+def are_equal(infile,outfile,verbose,buffersize=50):
+    """ Compare the variables in the input and output netCDF files, in this
+        process, to ensure they are identical
+    """
+    try:
+        return nc2nc.compare(infile, outfile, buffersize=buffersize, verbose=verbose)
+    except netcdf4exception as e:
+        if verbose: print("Problem comparing two netCDF files: {} {}\n Exception: {}".format(infile, outfile, e))
+        return False
+
+def run_nc2nc(infile,outfile,level,shuffle,verbose,chunksize,buffersize,chunkcache=None,digests=None,stats=None,
+              tolerance=0.05,chunking='balanced',plancache=None):
+    """ Compress infile to outfile by calling nc2nc directly in this process,
+        avoiding the cost of starting a new python interpreter for each file.
+        Returns a list of elapsed, system and user times (in seconds) and the
+        high-water mark of the resident set size of this worker process (in KB),
+        which may have been reached by an earlier file. If digests is a dict it is filled 
+        with the digest of each variable, computed as it is copied. If stats
+        is a dict it is filled with the time taken by each stage of the copy,
+        and for each variable, by nc2nc. If level is 'auto' nc2nc chooses the
+        level and shuffle of each variable, within tolerance of the best ratio,
+        and they are recorded with the stats of each variable. chunking is the
+        chunking strategy passed to nc2nc. Copy plans are reused for files with
+        the same schema, and also stored in the file plancache if it is not None
     """
-    global cdofound
-    
-    if cdofound is None:
-        # None if executable not found
-        exepath = which(cdocmd)
-        if exepath is None:
-            cdofound = False
-        else:
-            cdofound = True
-
-    if cdofound:
-        cmd = [cdocmd,'diffn']
-        cmd.append(infile)
-        cmd.append(outfile)
-        if verbose: print (' '.join(cmd))
-        output = ''
-        try:
-            output = subprocess.check_output(cmd,stderr=subprocess.STDOUT)
-        except Exception as e:
-            if verbose: print("Problem comparing two netCDF files: {}\n Exception: {}".format(" ".join(cmd), e.output))
-            return False
-        return True
-    else:
-        print("cdo not found in PATH. File checks and paranoid mode disabled")
-        return None
 
-def nc2nc_cmd(infile,outfile,level,shuffle,verbose,chunksize,buffersize,timing):
-
-    cmd = []
-    if timing:
-        # The format string for the time command
-        #   %e     (Not in tcsh.) Elapsed real time (in seconds).
-        #   %S     Total number of CPU-seconds that the process spent in kernel mode.
-        #   %U     Total number of CPU-seconds that the process spent in user mode.
-        #   %M     Maximum resident set size of the process during its lifetime, in Kbytes.
-        fmt = "%e %S %U %M"
-        cmd.extend([timecmd,'-f',fmt])
-    cmd.extend([nc2nc,'-d',str(level)])
-    if (not shuffle): cmd.append('-n')
-    # if verbose: cmd.append('-v')
-    if chunksize:
-        cmd.append('-s')
-        # All command line options have to be a string
-        cmd.append(str(chunksize))
-    if buffersize:
-        cmd.append('-b')
-        # All command line options have to be a string
-        cmd.append(str(buffersize))
-    cmd.append(infile)
-    cmd.append(outfile)
+    if stats is None: stats = {}
 
-    return cmd
+    # The output is only written if it doesn't exist, run_compress has already decided
+    # whether an existing output is kept or deleted
+    if not nc2nc.nc2nc(infile, outfile, zlib=(level == 'auto' or level > 0), complevel=level, shuffle=shuffle,
+                       chunksize=chunksize, buffersize=buffersize, chunkcache=chunkcache, digests=digests,
+                       stats=stats, tolerance=tolerance, chunking=chunking, plancache=plancache):
+        raise IOError("Output file already exists: {}".format(outfile))
 
-def nccopy_cmd(infile,outfile,level,shuffle,verbose,buffersize,timing):
-
-    cmd = []
-    if timing:
-        # The format string for the time command
-        #   %e     (Not in tcsh.) Elapsed real time (in seconds).
-        #   %S     Total number of CPU-seconds that the process spent in kernel mode.
-        #   %U     Total number of CPU-seconds that the process spent in user mode.
-        #   %M     Maximum resident set size of the process during its lifetime, in Kbytes.
-        fmt = "%e %S %U %M"
-        cmd.extend([timecmd,'-f',fmt])
-    cmd.extend([nccopy,'-d',str(level)])
+    return [stats['total'], stats['stime'], stats['utime'], stats['maxrss']]
+
+def nccopy_cmd(infile,outfile,level,shuffle,verbose,buffersize):
+
+    cmd = [nccopy,'-d',str(level)]
     if shuffle: cmd.append('-s')
     if buffersize:
         cmd.append('-m')
@@ -162,6 +140,92 @@ def nccopy_cmd(infile,outfile,level,shuffle,verbose,buffersize,timing):
 
     return cmd
 
+def run_nccopy(infile,outfile,level,shuffle,verbose,buffersize,stats=None):
+    """ Compress infile to outfile with nccopy. Returns the same list of times 
+        as run_nc2nc, measured with getrusage for child processes. If stats is 
+        a dict it is filled with the total time, and the bytes in and out
+    """
+
+    if stats is None: stats = {}
+
+    cmd = nccopy_cmd(infile,outfile,level,shuffle,verbose,buffersize)
+    if verbose: print (' '.join(cmd))
+
+    usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    time_start = time.perf_counter()
+
+    subprocess.check_output(cmd,stderr=subprocess.STDOUT)
+
+    usage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats['total'] = time.perf_counter() - time_start
+    stats['bytes_in'] = os.path.getsize(infile)
+    stats['bytes_out'] = os.path.getsize(outfile)
+    stats['rate'] = nc2nc.transfer_rate(stats['bytes_in'], stats['total'])
+    stats['utime'] = usage_end.ru_utime - usage_start.ru_utime
+    stats['stime'] = usage_end.ru_stime - usage_start.ru_stime
+    # High-water mark of the largest child process of this worker, not only this one
+    stats['maxrss'] = usage_end.ru_maxrss
+
+    return [stats['total'], stats['stime'], stats['utime'], stats['maxrss']]
+
+# nccopy can't choose a deflate level for each variable, so files it compresses
+# with --dlevel auto use this level
+nccopy_auto_level = 5
+
+# Name of the journal, in the temporary directory, which records the progress
+# of each file so an interrupted run can be resumed without checking the data
+journal_name = '.nccompress_journal'
+
+def read_journal(journal):
+    """ Return a dict of the last record in journal for each file. A record that was
+        only partly written when a run was interrupted is ignored
+    """
+    records = {}
+    if not os.path.isfile(journal): return records
+    with open(journal) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['file']] = record
+    return records
+
+def write_journal(journal, state, step):
+    """ Append a record of step (started, written, verified or committed) for the
+        file in state to journal, and make sure it is on disk before returning. The
+        record includes the fraction of the output which has been checked against
+        the original (1 for a full check). Nothing is recorded if journal is None
+    """
+    if journal is None: return
+    record = {
+        'file' : os.path.basename(state['infile']), 
+        'state' : step, 
+        'key' : state['key'],
+        'comp_size' : state.get('comp_size'),
+        'checked' : state.get('checked', 0.),
+    }
+    # Records are written with a single call to write on a file opened for
+    # appending, so records from different processes are not interleaved
+    fd = os.open(journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_file(path):
+    """ Make sure the contents of path are on disk
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Suffix of the manifest, beside each compressed file, of the digests of its variables
+manifest_suffix = '.digests.json'
+
 def check_and_overwrite(state,verbose,maxcompress):
 
     # Serious. We're going to blow away the original file with
@@ -178,13 +242,21 @@ def check_and_overwrite(state,verbose,maxcompress):
         if verbose: print("Overwriting {0}".format(state['infile']))
         try:
             move(state['outfile'],state['infile'])
+            if os.path.isfile(state['outfile'] + manifest_suffix):
+                move(state['outfile'] + manifest_suffix, state['infile'] + manifest_suffix)
         except Exception as e:
             state['error'] = "Failed to overwrite original file"
         else:
             state['error'] = False
 
 def run_compress(infile,outfile,level=5,shuffle=True,verbose=False,chunksize=64,buffersize=500,paranoid=False,
-                 overwrite=False,nccopy=False,maxcompress=10,timing=False):
+                 overwrite=False,nccopy=False,maxcompress=10,timing=False,chunkcache=None,force=False,entry=None,
+                 journal=None,record=None,manifest=False,sample=None,tolerance=0.05,chunking='balanced',
+                 plancache=None,copybuffer=None):
+
+    # Copy buffer in MiB for nc2nc, which is reduced from buffersize to fit a memory
+    # budget. nccopy is always given buffersize
+    if copybuffer is None: copybuffer = buffersize
 
     # Initialise state container
     state = {
@@ -196,17 +268,72 @@ def run_compress(infile,outfile,level=5,shuffle=True,verbose=False,chunksize=64,
         'shuffle' : shuffle, 
         'paranoid' : paranoid,
         'overwrite' : overwrite,
+        'engine' : None,
+        'stats' : {},
+        'format' : None,
+        'compressed' : None,
+        'key' : None,
+        'skipped' : False,
         'error' : False,
     } 
 
+    # Make sure we're dealing with a netCDF file. entry is the record for this file
+    # from a ScanIndex, if the file hasn't changed it is not opened
+    (state['format'], state['compressed'], state['key']) = probe_file(infile, entry)
+
+    if not state['format']:
+        if verbose: print('Not a netCDF file: ' + infile)
+        state['skipped'] = "Not a netCDF file"
+        return state
+
+    # Check to see if the input file is already compressed
+    if state['compressed']:
+        if force:
+            if verbose: sys.stdout.write("Already compressed %s but forcing overwrite\n" % infile)
+        else:
+            if verbose: print('Already compressed skipping ...')
+            state['skipped'] = "Already compressed"
+            return state
+
+    if state['format'] == 'NETCDF4' and not nccopy:
+        sys.stderr.write("Cannot compress {} with nc2nc as it is NETCDF4 format, switching to nccopy\n".format(infile))
+        state['engine_reason'] = "NETCDF4 format requires nccopy"
+        nccopy = True
+
+    if nccopy and level == 'auto':
+        level = nccopy_auto_level
+        state['dlevel'] = level
+
+    if verbose: sys.stdout.write( "Compressing %s, deflate level = %s, shuffle is on: %s\n" % (infile,level,shuffle) )
+
+    # Output has been completely written (and checked at least as thoroughly as this
+    # run asks, if verified is True) by this or a previous run
+    written = False
+    verified = False
+    checked = 1. if paranoid else (sample or 0.)
+
     # Check to see if the output file already exists ...
-    if os.path.isfile(outfile):
+    if os.path.isfile(outfile) and record is not None:
+        # record is the last entry in the journal for this file from a previous run.
+        # The output is only kept if it was completely written from the same input
+        if (record['state'] in ('written', 'verified', 'committed') and record['key'] == list(state['key']) 
+            and record['comp_size'] == os.path.getsize(outfile)):
+            if verbose: sys.stdout.write("Output file %s was completed by a previous run: skipping\n" % outfile)
+            state['output'] = "Output file {} exists: skipping".format(outfile)
+            written = True
+            # Records from before the checks were journalled haven't been checked
+            state['checked'] = record.get('checked', 0.)
+            verified = state['checked'] >= checked
+        else:
+            if verbose: sys.stdout.write("Output file %s was not completed by a previous run: deleting\n" % outfile)
+            os.unlink(outfile)
+    elif os.path.isfile(outfile):
         # Ok, we're going to be paranoid here, because this could be a left over
         # half compressed file from a previous run. We do not want to copy that
         # over our data
 
         # Note to self: might need to wrap this in a try/except block for debugging
-        identical_files = are_equal(infile, outfile, verbose)
+        identical_files = are_equal(infile, outfile, verbose, copybuffer)
 
         if identical_files:
             if verbose: sys.stdout.write("Output file %s exists: skipping\n" % outfile)
@@ -218,62 +345,221 @@ def run_compress(infile,outfile,level=5,shuffle=True,verbose=False,chunksize=64,
                 check_and_overwrite(state,verbose,maxcompress)
             return state
         else:
-            if identical_files is None:
-                sys.stdout.write("Output file %s exists, but cannot determine if it is same as the input %s\n" % (outfile,infile))
-            else:
-                sys.stdout.write("Output file %s exists, but is not the same as the input %s\n" % (outfile,infile))
+            sys.stdout.write("Output file %s exists, but is not the same as the input %s\n" % (outfile,infile))
             sys.stdout.write("Deleting output and recompressing\n")
             # Delete compressed file, will continue and compress afresh
             os.unlink(outfile)
 
-    if nccopy:
-        cmd = nccopy_cmd(infile,outfile,level,shuffle,verbose,buffersize,timing)
-    else:
-        cmd = nc2nc_cmd(infile,outfile,level,shuffle,verbose,chunksize,buffersize,timing)
+    digests = None
 
-    output = ''
-    if verbose: print (' '.join(cmd))
-    try:
-        output = subprocess.check_output(cmd,stderr=subprocess.STDOUT)
-    except Exception as e:
-        state['error'] = "Compression failed: " + str(e)
-    else:
-        state['times'] =  output.split()
-        state['comp_size'] = os.path.getsize(outfile)
-        if paranoid and not are_equal(infile,outfile,verbose):
+    if not written:
+        write_journal(journal, state, 'started')
+
+        if nccopy:
+            state['engine'] = 'nccopy'
+            try:
+                times = run_nccopy(infile,outfile,level,shuffle,verbose,buffersize,state['stats'])
+            except Exception as e:
+                state['error'] = "Compression failed: " + str(e)
+                return state
+            if timing: state['times'] = times
+        else:
+            state['engine'] = 'nc2nc'
+            # Digests of the variables computed as they are copied, so the output can
+            # be checked without reading the original again
+            if paranoid or manifest: digests = {}
+            try:
+                times = run_nc2nc(infile,outfile,level,shuffle,verbose,chunksize,copybuffer,chunkcache,digests,state['stats'],tolerance,chunking,plancache)
+            except Exception as e:
+                state['error'] = "Compression failed: " + str(e)
+                return state
+            if timing: state['times'] = times
+            if manifest: nc2nc.write_manifest(outfile + manifest_suffix, digests)
+
+    state['comp_size'] = os.path.getsize(outfile)
+
+    if not written and journal is not None:
+        # The output must be on disk before it is recorded as written
+        sync_file(outfile)
+        write_journal(journal, state, 'written')
+
+    if paranoid and not verified:
+        if digests is not None:
+            identical_files = nc2nc.verify_digests(outfile, digests, verbose, copybuffer)
+        else:
+            identical_files = are_equal(infile,outfile,verbose,copybuffer)
+        if not identical_files:
+            sys.stdout.write("%s is not the same as %s \n" % (infile,outfile))
+            state['error'] = "Compressed file is not the same as original"
+            return state
+        state['checked'] = 1.
+        write_journal(journal, state, 'verified')
+    elif sample is not None and not verified:
+        # Compare a random sample of the chunks of each variable with the original
+        identical_files, compared, total = nc2nc.compare_sample(infile,outfile,sample,verbose=verbose)
+        state['verified_values'] = (compared, total)
+        if not identical_files:
             sys.stdout.write("%s is not the same as %s \n" % (infile,outfile))
             state['error'] = "Compressed file is not the same as original"
-        elif overwrite:
-            # Perform checks on compressed data, return result in state. Need to make
-            # this into an object ...
-            check_and_overwrite(state,verbose,maxcompress)
+            return state
+        state['checked'] = sample
+        write_journal(journal, state, 'verified')
+
+    if overwrite:
+        # Perform checks on compressed data, return result in state. Need to make
+        # this into an object ...
+        check_and_overwrite(state,verbose,maxcompress)
+        if not state['error']: write_journal(journal, state, 'committed')
+    elif not (written and verified and record['state'] == 'committed'):
+        write_journal(journal, state, 'committed')
+
+    return state
 
+def timed_compress(*args):
+    """ Call run_compress with args, and add the wall clock time taken to the returned state
+    """
+    start = time.time()
+    state = run_compress(*args)
+    state['elapsed'] = time.time() - start
     return state
 
-def log_result(result):
-    # Not strictly required, but makes it explicit
-    global result_list
-    result_list.append(result)
+# Cost models used to order files when scheduling largest first. Each is called with the
+# size of the file in bytes and the deflate level, and returns the relative cost of
+# compressing the file. Add an entry here to make a new model available to --cost
+cost_models = {
+    'size' : lambda size, level: size,
+    'level' : lambda size, level: size * (1 + (nc2nc.trial_levels[0] if level == 'auto' else level)),
+}
+
+def makespan(durations, numproc):
+    """ Return the time to run tasks with durations, in the order given, on numproc
+        processes, where each task is started on the first process to become free
+    """
+    free = [0.] * numproc
+    for duration in durations:
+        heapq.heappush(free, heapq.heappop(free) + duration)
+    return max(free)
+
+def calibrate_costs(costs, elapsed):
+    """ Return the seconds taken per unit of cost, from elapsed, the wall clock time taken
+        to compress each file by name, and costs, the cost of each file. Returns None if
+        no file with a cost was compressed
+    """
+    total = sum(costs[infile] for infile in elapsed)
+    if total <= 0: return None
+    return sum(elapsed.values()) / total
+
+def predict_schedule(tasks, costs, numproc, rate=1.):
+    """ Return the predicted makespan of tasks, (order, infile) in submission order, 
+        and of the same tasks in directory order, from the costs used to schedule them. 
+        The costs are converted to seconds by rate, the seconds per unit of cost
+    """
+    predicted = makespan([costs[infile]*rate for (order, infile) in tasks], numproc)
+    walk = makespan([costs[infile]*rate for (order, infile) in sorted(tasks)], numproc)
+    return predicted, walk
+
+def report_schedule(prediction, schedule, cost, wallclock):
+    """ Print the makespans from predict_schedule, in seconds, and the actual wall 
+        clock time. prediction is None if no files were compressed
+    """
+    print("Schedule: {}, cost model: {}".format(schedule, cost))
+    if prediction is not None:
+        predicted, walk = prediction
+        print("    Predicted makespan: {:.2f} s (directory order: {:.2f} s)".format(predicted, walk))
+        if walk > 0:
+            print("    Predicted saving over directory order: {:.1f}%".format(100.*(1. - predicted/walk)))
+    print("    Actual makespan: {:.2f} s".format(wallclock))
+
+# Fraction of the available memory used as the memory budget for compressing files
+# in parallel, if a budget is not specified
+memory_fraction = 0.8
+
+def available_memory():
+    """ Return the memory available to start new processes, in bytes, or None if this
+        can't be found
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def plan_memory(infile, budget, chunksize, buffersize, chunkcache, verbose=False, force=False, entry=None, 
+                chunking='balanced', nccopy=False):
+    """ Return (memory, buffersize), the estimated peak memory in bytes to compress infile,
+        and the copy buffer size in MiB nc2nc should use. Only the header of infile is 
+        read. For files nc2nc compresses the memory is from nc2nc.estimate_memory, and 
+        the buffer size is halved, in whole MiB, until the estimate fits in budget or 
+        the buffer is 1 MiB. Files compressed with nccopy (if nccopy is set, or they are 
+        NETCDF4 format) hold a copy buffer of buffersize MiB, or all the data if that is 
+        smaller. Files that won't be compressed need no memory. entry is the record for 
+        infile from a ScanIndex, if any, and chunking the chunking strategy
+    """
 
-def compress_files(path, files, tmpdir, overwrite, maxcompress, level, shuffle, force, clean, 
-                   verbose, chunksize, buffersize, nccopy, paranoid, numproc, timing):
+    if entry is not None:
+        try:
+            unchanged = entry[0] == stat_key(os.stat(infile))
+        except OSError:
+            return 0, buffersize
+        if unchanged and (not entry[1] or (entry[2] and not force)): return 0, buffersize
 
-    total_size_new = 0
-    total_size_old = 0
-    total_files = 0
-    skippedlist = []
-    jobs = []
+    if not sniff_format(infile): return 0, buffersize
 
-    global result_list
-    result_list[:] = []
+    try:
+        ncfile = nc.Dataset(infile)
+    except netcdf4exception:
+        return 0, buffersize
 
-    pool = mp.Pool(processes=numproc,maxtasksperchild=50)
+    try:
+        variables = list(ncfile.variables.values())
+        if (not force and ncfile.data_model.startswith('NETCDF4') and 
+            any(ncvar.filters()['complevel'] > 0 for ncvar in variables)):
+            return 0, buffersize
+
+        if nccopy or ncfile.file_format == 'NETCDF4':
+            data = sum(nc2nc.numVals(ncvar.shape)*np.dtype(ncvar.dtype).itemsize for ncvar in variables)
+            return min(data, buffersize*1024**2), buffersize
+
+        memory = nc2nc.estimate_memory(ncfile, chunksize, buffersize, chunkcache=chunkcache, chunking=chunking)
+        while memory > budget and buffersize > 1:
+            buffersize = buffersize // 2
+            memory = nc2nc.estimate_memory(ncfile, chunksize, buffersize, chunkcache=chunkcache, chunking=chunking)
+    finally:
+        ncfile.close()
+
+    if verbose and memory > budget: 
+        sys.stdout.write("Estimated memory to compress %s is %d MiB, more than the memory budget\n" % (infile, memory//1024**2))
+
+    return memory, buffersize
+
+def temporary_directory(path, tmpdir):
+    """ Return the temporary directory for compressed copies of files in path. A 
+        relative tmpdir is inside path. An absolute tmpdir is shared by all directories,
+        so each directory has its own subdirectory of it, named after the directory
+        and a digest of its absolute path, and files with the same name in different
+        directories don't overwrite each other
+    """
+    if not os.path.isabs(tmpdir): return os.path.join(path,tmpdir)
+    source = os.path.abspath(path)
+    digest = hashlib.blake2b(source.encode(), digest_size=4).hexdigest()
+    return os.path.join(tmpdir, '{}.{}'.format(os.path.basename(source) or 'root', digest))
+
+def prepare_directory(path, tmpdir, clean):
+    """ Create the temporary directory for compressed copies of files in path,
+        and return it. If clean is set, remove any files in it
+    """
 
     # Create our temporary directory
-    outdir = os.path.join(path,tmpdir)
+    outdir = temporary_directory(path, tmpdir)
     if not os.path.isdir(outdir):
         # Don't try and catch errors, let program stop if there is a problem
-        os.mkdir(outdir)
+        os.makedirs(outdir)
 
     if clean:
         # Choose to clean all the files out of the tmp directory. We could
@@ -291,61 +577,176 @@ def compress_files(path, files, tmpdir, overwrite, maxcompress, level, shuffle,
             except Exception as e:
                 print(e)
 
-    for file in files:
+    return outdir
 
-        infile = os.path.join(path,file)
-        outfile = os.path.join(outdir,file)
+def new_summary(path, outdir):
+    """ Return a container for the results of compressing the files in directory path
+    """
+    return {
+        'path' : path,
+        'outdir' : outdir,
+        'journal' : os.path.join(outdir, journal_name),
+        'records' : read_journal(os.path.join(outdir, journal_name)),
+        'pending' : 0,
+        'submitted' : False,
+        'total_size_new' : 0,
+        'total_size_old' : 0,
+        'total_files' : 0,
+        'verify_compared' : 0,
+        'verify_total' : 0,
+        'skippedlist' : [],
+    }
+
+def format_rate(rate):
+    """ Return rate, in MB/s, for printing, or a placeholder if rate is None as the
+        time was too short to measure it
+    """
+    if rate is None: return "- MB/s"
+    return "{:.1f} MB/s".format(rate)
 
-        # Make sure we're dealing with a netCDF file
-        (ncformat, compressed) = is_netCDF(infile)
-        if ncformat:
-            if ncformat == 'NETCDF4' and not nccopy:
-                sys.stderr.write("Cannot compress {} with nc2nc as it is NETCDF4 format, switching to nccopy\n".format(infile))
-                nccopy = True
-            if verbose: sys.stdout.write( "Compressing %s, deflate level = %s, shuffle is on: %s\n" % (infile,level,shuffle) )
+def add_result(summary, result, verbose, timing):
+    """ Add the result of compressing one file to the summary for its directory
+    """
+
+    # print result
+    infile = result['infile']
+
+    if result.get('skipped'):
+        # Not a netCDF file, or already compressed
+        return
+
+    if result['error']:
+        sys.stdout.write("Error with %s :: %s \n" % (infile, result['error']))
+        summary['skippedlist'].append(infile)
+        # Go to next file .. we won't count this one in our summary stats
+        return
+
+    summary['total_size_new'] += result['comp_size']
+    summary['total_size_old'] += result['orig_size']
+    summary['total_files'] += 1
+    if 'verified_values' in result:
+        summary['verify_compared'] += result['verified_values'][0]
+        summary['verify_total'] += result['verified_values'][1]
+
+    if verbose:
+        if timing:
+            print("{} d = {} Shuffle: {:d} {} s {} s {} s Worker peak mem: {} KB {} B {:0.4}".format(
+                os.path.basename(infile), result['dlevel'], result['shuffle'], 
+                result['times'][0], result['times'][1], result['times'][2],
+                result['times'][3], result['comp_size'], float(result['orig_size'])/float(result['comp_size'])))
+            stats = result.get('stats', {})
+            if 'open' in stats:
+                # Breakdown of the time nc2nc took by stage, and by variable
+                print("    open {:.3f} s plan {:.3f} s sync {:.3f} s {}".format(
+                    stats['open'], stats['plan'], stats['sync'], format_rate(stats.get('rate'))))
+                for varname, varstats in stats['variables'].items():
+                    print("    {}: read {:.3f} s write {:.3f} s {}".format(
+                        varname, varstats['read'], varstats['write'], format_rate(varstats.get('rate'))))
+                    if 'level' in varstats:
+                        print("        d = {} Shuffle: {:d}".format(varstats['level'], varstats['shuffle']))
         else:
-            if verbose: print('Not a netCDF file: ' + infile)
-            continue
+            print("{} d = {} Shuffle: {:d} {} B {:0.4}".format(
+                os.path.basename(infile), result['dlevel'], result['shuffle'], result['comp_size'], float(result['orig_size'])/float(result['comp_size'])))
 
-        # Check to see if the input file is already compressed
-        if compressed:
-            if force:
-                if verbose: sys.stdout.write("Already compressed %s but forcing overwrite\n" % infile)
-            else:
-                if verbose: print('Already compressed skipping ...')
-                continue
+def report_record(result):
+    """ Return the record in the run report of the result of compressing one file
+    """
+    stats = result.get('stats') or {}
+    record = {
+        'type' : 'file',
+        'path' : result['infile'],
+        'engine' : result.get('engine'),
+        'dlevel' : result.get('dlevel'),
+        'shuffle' : result.get('shuffle'),
+        'orig_size' : result.get('orig_size'),
+        'comp_size' : result.get('comp_size'),
+        'ratio' : None,
+        'chunking' : None,
+        'plan_cache' : stats.get('plan_cache'),
+        'timings' : dict((key, stats[key]) for key in ('total','open','plan','sync','rate','utime','stime','maxrss') if key in stats),
+        'error' : result['error'] or None,
+        'skipped' : result.get('skipped') or None,
+    }
+    if record['orig_size'] and record['comp_size']:
+        record['ratio'] = float(record['orig_size'])/record['comp_size']
+    if 'variables' in stats:
+        record['chunking'] = dict((varname, varstats['chunks']) for varname, varstats in stats['variables'].items())
+        # Chunks predicted to be touched by each read of the access pattern of the chunking strategy
+        record['touched'] = dict((varname, varstats['touched']) for varname, varstats in stats['variables'].items()
+                                 if 'touched' in varstats)
+        record['timings']['variables'] = dict((varname, {'read' : varstats['read'], 'write' : varstats['write'], 'rate' : varstats.get('rate')})
+                                              for varname, varstats in stats['variables'].items())
+        # Deflate level and shuffle chosen for each variable with --dlevel auto
+        deflate = dict((varname, {'dlevel' : varstats['level'], 'shuffle' : varstats['shuffle']})
+                       for varname, varstats in stats['variables'].items() if 'level' in varstats)
+        if deflate: record['deflate'] = deflate
+    return record
+
+# Period, in seconds, over which the rate of compression shown in the progress is measured
+progress_window = 300.
+
+def new_progress(interval, stream=sys.stderr):
+    """ Return a container for the progress of a run, which is shown on stream at most
+        every interval seconds. On a terminal the progress is updated in place,
+        otherwise a line is written each time
+    """
+    return {
+        'stream' : stream,
+        'tty' : stream.isatty(),
+        'interval' : interval,
+        'start' : time.time(),
+        'shown' : 0.,
+        'files_found' : 0,
+        'bytes_found' : 0,
+        'files_done' : 0,
+        'bytes_done' : 0,
+        'size_old' : 0,
+        'size_new' : 0,
+        'window' : collections.deque(),
+    }
+
+def show_progress(progress, final=False):
+    """ Show files and bytes done, the rate of compression over the last progress_window
+        seconds, compression ratio and estimated time remaining, if interval seconds
+        have passed since it was last shown
+    """
 
-        # Try compressing the data
-        pool.apply_async(run_compress, args=(infile,outfile,level,shuffle,verbose,chunksize,buffersize,paranoid,overwrite,nccopy,maxcompress,timing), callback=log_result)
+    now = time.time()
+    if not final and now - progress['shown'] < progress['interval']: return
+    progress['shown'] = now
 
-    pool.close()
-    pool.join()
+    # Rate of the files finished in the window
+    window = progress['window']
+    while len(window) > 0 and now - window[0][0] > progress_window: window.popleft()
+    rate = sum(size for (finished, size) in window) / max(min(now - progress['start'], progress_window), 1e-9)
 
-    for result in result_list:
+    remaining = progress['bytes_found'] - progress['bytes_done']
+    if rate > 0 and not final:
+        eta = "ETA {:.0f} s".format(remaining / rate)
+    elif final:
+        eta = "Elapsed {:.0f} s".format(now - progress['start'])
+    else:
+        eta = "ETA unknown"
 
-        # print result
-        infile = result['infile']
-        outfile = result['outfile']
+    ratio = float(progress['size_old'])/progress['size_new'] if progress['size_new'] > 0 else 0.
 
-        if result['error']:
-            sys.stdout.write("Error with %s :: %s \n" % (infile, result['error']))
-            skippedlist.append(infile)
-            # Go to next file .. we won't count this one in our summary stats
-            continue
+    line = "Files {}/{} Bytes {:.1f}/{:.1f} MB {:.1f} MB/s Ratio {:.2f} {}".format(
+        progress['files_done'], progress['files_found'], progress['bytes_done']/1e6,
+        progress['bytes_found']/1e6, rate/1e6, ratio, eta)
 
-        total_size_new += result['comp_size']
-        total_size_old += result['orig_size']
-        total_files = total_files + 1
+    if progress['tty']:
+        progress['stream'].write("\r" + line + ("\n" if final else ""))
+    else:
+        progress['stream'].write(line + "\n")
+    progress['stream'].flush()
+
+def finish_directory(summary, overwrite):
+    """ Print the summary for a directory once all its files are compressed, and
+        remove the temporary directory if the originals have been overwritten
+    """
 
-        if verbose:
-            if timing:
-                print("{} d = {} Shuffle: {:d} {} s {} s {} s Mem: {} KB {} B {:0.4}".format(
-                    file, level, shuffle, 
-                    result['times'][0], result['times'][1], result['times'][2],
-                    result['times'][3], result['comp_size'], float(result['orig_size'])/float(result['comp_size'])))
-            else:
-                print("{} d = {} Shuffle: {:d} {} B {:0.4}".format(
-                    file, level, shuffle, result['comp_size'], float(result['orig_size'])/float(result['comp_size'])))
+    total_size_old = summary['total_size_old']
+    total_size_new = summary['total_size_new']
 
     # Make a nice human readable number from the total amount of space we've saved
     total_space_saved = float(total_size_old-total_size_new)
@@ -356,21 +757,270 @@ def compress_files(path, files, tmpdir, overwrite, maxcompress, level, shuffle,
         
     units = ['B','KB','MB','GB','TB']
 
-    if total_files > 0:
-        print("Directory: {0}".format(path))
-        print("    Number files compressed: {0}".format(total_files))
+    if summary['total_files'] > 0:
+        print("Directory: {0}".format(summary['path']))
+        print("    Number files compressed: {0}".format(summary['total_files']))
         print("    Total space saved: {0:.2f} {1}".format(total_space_saved,units[power]))
         print("    Average compression ratio: {0:.2f}".format(float(total_size_old)/total_size_new))
-    if len(skippedlist) > 0:
+        if summary['verify_total'] > 0:
+            print("    Values verified by sampling: {0} of {1} ({2:.1f}%)".format(summary['verify_compared'],
+                  summary['verify_total'], 100.*summary['verify_compared']/summary['verify_total']))
+    if len(summary['skippedlist']) > 0:
         print("    Following files not properly compressed or suspiciously high compression ratio:")
-        print (", ".join(skippedlist))
+        print (", ".join(summary['skippedlist']))
 
     if overwrite:
+        # All the originals have been overwritten, so the journal is no longer needed
+        if len(summary['skippedlist']) == 0 and os.path.isfile(summary['journal']):
+            os.remove(summary['journal'])
         try:
-            os.rmdir(outdir)
+            os.rmdir(summary['outdir'])
         except OSError:
-            print("Failed to remove temporary directory {}".format(outdir))
+            print("Failed to remove temporary directory {}".format(summary['outdir']))
+
+def compress_files(directories, tmpdir, overwrite, maxcompress, level, shuffle, force, clean, 
+                   verbose, chunksize, buffersize, nccopy, paranoid, numproc, timing, chunkcache=None, index=None,
+                   schedule='walk', cost='size', maxmemory=None, manifest=False, sample=None, report=None, 
+                   progress=None, tolerance=0.05, chunking='balanced', plancache=None):
+    """ Compress files in directories, an iterable of (path, list of files in path).
+        All files from all directories are compressed by a single pool of numproc
+        processes. The summary for each directory is printed as soon as the last
+        file in that directory has been compressed. 
+
+        If schedule is 'walk' files are submitted as the directories are found. If
+        schedule is 'largest' all the files are found first, and submitted in order 
+        of decreasing cost, from one of the cost_models, so the largest files don't
+        hold up the end of the run
+
+        If maxmemory (bytes) is set, a file is only submitted when the estimated
+        memory to compress it, plus that of the files already submitted, fits in
+        maxmemory. The copy buffer is reduced for files which won't fit on their own
+
+        If report is an open file, a JSON record of the result of each file is written
+        to it as soon as the file is finished, followed by a summary of the whole run
+
+        If progress, from new_progress, is given the progress of the run is shown as 
+        files are finished, and while waiting for files to finish
+
+        If level is 'auto' the deflate level and shuffle of each variable are chosen
+        by nc2nc, the cheapest within the fraction tolerance of the best ratio
+
+        chunking is the chunking strategy used by nc2nc, the name of one of 
+        nc2nc.chunk_strategies or a list of weights for each dimension
+
+        nc2nc reuses the chunking and copy buffer plan of a file for later files,
+        in the same process, with the same schema. If plancache is set plans are
+        also shared between processes, and runs, in that SQLite file. The number
+        of files which reused a plan is in the report summary (plan_cache_hits)
+    """
+
+    pool = mp.Pool(processes=numproc,maxtasksperchild=50)
+
+    # Results are passed back from the pool by callbacks, which are called in
+    # another thread, and processed in this thread
+    results = queue.Queue()
+
+    # The summary for the directory of each file in progress
+    summaries = {}
+
+    # Files waiting to be submitted, and the estimated memory needed for each file
+    # which has been submitted
+    waiting = collections.deque()
+    inflight = {}
+    estimates = {}
+
+    # Totals for all directories, for the run report, and the size of each file
+    totals = {'type' : 'summary', 'files' : 0, 'compressed' : 0, 'skipped' : 0, 'errors' : 0,
+              'total_size_old' : 0, 'total_size_new' : 0, 'plan_cache_hits' : 0}
+    sizes = {}
+
+    # Cost of each file, in order to schedule and report on the schedule, and the time
+    # taken to compress each file which was compressed
+    costs = {}
+    tasks = []
+    elapsed = {}
+
+    def process_result(result):
+        infile = result['infile']
+        summary = summaries.pop(infile)
+        inflight.pop(infile, None)
+        add_result(summary, result, verbose, timing)
+
+        if report is not None:
+            report.write(json.dumps(report_record(result)) + '\n')
+            report.flush()
+
+        totals['files'] += 1
+        if result['error']:
+            totals['errors'] += 1
+        elif result['skipped']:
+            totals['skipped'] += 1
+        else:
+            totals['compressed'] += 1
+            totals['total_size_old'] += result['orig_size']
+            totals['total_size_new'] += result['comp_size']
+            if (result.get('stats') or {}).get('plan_cache') is not None: totals['plan_cache_hits'] += 1
+            if result.get('elapsed') is not None: elapsed[infile] = result['elapsed']
+
+        if progress is not None:
+            progress['files_done'] += 1
+            progress['bytes_done'] += sizes[infile]
+            if not result['error'] and not result['skipped']:
+                progress['size_old'] += result['orig_size']
+                progress['size_new'] += result['comp_size']
+                progress['window'].append((time.time(), sizes[infile]))
+            show_progress(progress)
+
+        if index is not None:
+            if overwrite and not result['error'] and not result['skipped']:
+                # The original has been replaced with the compressed copy. Both nc2nc and
+                # nccopy write netCDF4 classic unless the original was netCDF4
+                index.update(infile, 'NETCDF4' if result['format'] == 'NETCDF4' else 'NETCDF4_CLASSIC', level == 'auto' or level > 0)
+            elif result.get('key') is not None:
+                # Record the result of probing the file
+                index.record(infile, result['key'], result['format'], result['compressed'])
+
+        summary['pending'] -= 1
+        if summary['submitted'] and summary['pending'] == 0:
+            finish_directory(summary, overwrite)
+
+    def submit():
+        # Submit waiting files while their estimated memory fits in the budget. A file is
+        # always submitted when nothing else is running
+        while len(waiting) > 0:
+            (infile, outfile) = waiting[0]
+
+            # Files are probed by the workers. Only the index, and the header of the file to
+            # estimate its memory with a memory budget, are read here
+            entry = None if index is None else index.entry(infile)
+
+            taskbuffer = buffersize
+            if maxmemory is not None:
+                if infile not in estimates:
+                    estimates[infile] = plan_memory(infile, maxmemory, chunksize, buffersize, chunkcache, verbose, force, entry,
+                                                    chunking, nccopy)
+                memory, taskbuffer = estimates[infile]
+                if len(inflight) > 0 and sum(inflight.values()) + memory > maxmemory: break
+                if verbose and not nccopy and taskbuffer != buffersize:
+                    sys.stdout.write("Reducing copy buffer for %s to %d MiB to fit memory budget\n" % (infile, taskbuffer))
+                inflight[infile] = memory
+                del estimates[infile]
+
+            waiting.popleft()
+
+            # Journal, and the record of this file from a previous run
+            summary = summaries[infile]
+            record = summary['records'].pop(os.path.basename(infile), None)
+
+            # Try compressing the data
+            pool.apply_async(timed_compress, args=(infile,outfile,level,shuffle,verbose,chunksize,buffersize,paranoid,overwrite,nccopy,maxcompress,timing,chunkcache,force,entry,summary['journal'],record,manifest,sample,tolerance,chunking,plancache,taskbuffer),
+                             callback=results.put,
+                             error_callback=lambda e, infile=infile, outfile=outfile: results.put(error_state(infile, outfile, e)))
+
+    starttime = time.time()
+
+    # A directory found more than once must only be cleaned once, before any files
+    # have been compressed into it, and each file is only compressed once
+    cleaned = set()
+    found = set()
+
+    for path, files in directories:
+
+        unique = []
+        for file in files:
+            infile = os.path.realpath(os.path.join(path,file))
+            if infile in found:
+                if verbose: print("{} has already been found: skipping".format(os.path.join(path,file)))
+                continue
+            found.add(infile)
+            unique.append(file)
+        if len(files) > 0 and len(unique) == 0: continue
+
+        outdir = prepare_directory(path, tmpdir, clean and temporary_directory(path, tmpdir) not in cleaned)
+        cleaned.add(outdir)
+        summary = new_summary(path, outdir)
+
+        for file in unique:
+
+            infile = os.path.join(path,file)
+            outfile = os.path.join(outdir,file)
+
+            summaries[infile] = summary
+            summary['pending'] += 1
+            sizes[infile] = os.path.getsize(infile)
+            costs[infile] = cost_models[cost](sizes[infile], level)
+            tasks.append((len(tasks), infile, outfile))
+
+            if progress is not None:
+                progress['files_found'] += 1
+                progress['bytes_found'] += sizes[infile]
+
+            if schedule == 'walk': waiting.append((infile, outfile))
 
+        summary['submitted'] = True
+        if summary['pending'] == 0:
+            finish_directory(summary, overwrite)
+
+        submit()
+
+        # Process any results which have already arrived
+        while True:
+            try:
+                process_result(results.get_nowait())
+            except queue.Empty:
+                break
+
+    if schedule == 'largest':
+        # Longest processing time first: sort is stable, so files of the same cost
+        # are submitted in directory order
+        tasks.sort(key=lambda task: costs[task[1]], reverse=True)
+        for (order, infile, outfile) in tasks:
+            waiting.append((infile, outfile))
+
+    submit()
+    while len(summaries) > 0:
+        if progress is None:
+            process_result(results.get())
+        else:
+            # Keep showing progress while waiting for files to finish
+            try:
+                process_result(results.get(timeout=max(progress['interval'], 0.1)))
+            except queue.Empty:
+                show_progress(progress)
+        submit()
+
+    pool.close()
+    pool.join()
+
+    if progress is not None: show_progress(progress, final=True)
+
+    if verbose or schedule != 'walk':
+        # Predicted from the costs used to order the files, converted to seconds with the
+        # time the files took to compress. Skipped files, and files which couldn't be
+        # compressed, are left out
+        prediction = None
+        rate = calibrate_costs(costs, elapsed)
+        if rate is not None:
+            prediction = predict_schedule([(order, infile) for (order, infile, outfile) in tasks if infile in elapsed], costs, numproc, rate)
+        report_schedule(prediction, schedule, cost, time.time() - starttime)
+
+    if report is not None:
+        totals['ratio'] = None
+        if totals['total_size_new'] > 0:
+            totals['ratio'] = float(totals['total_size_old'])/totals['total_size_new']
+        totals['elapsed'] = time.time() - starttime
+        report.write(json.dumps(totals) + '\n')
+        report.flush()
+
+def error_state(infile, outfile, exception):
+    """ Return the state of a file for which run_compress raised an exception
+    """
+    return {
+        'infile' : infile, 
+        'outfile' : outfile, 
+        'skipped' : False,
+        'error' : "Compression failed: " + str(exception),
+    }
 
 def parse_args(arglist):
     """
@@ -383,18 +1033,30 @@ def parse_args(arglist):
             raise argparse.ArgumentTypeError("Minimum maxcompression is 0")
         return x
 
+    def maxmemory_type(x):
+        if x == 'auto': return x
+        x = int(x)
+        if x < 0:
+            raise argparse.ArgumentTypeError("Maximum memory must be auto, or a number of MiB (0 for no limit)")
+        return x
+
     parser = argparse.ArgumentParser(description="Run nc2nc (or nccopy) on a number of netCDF files")
-    parser.add_argument("-d","--dlevel", help="Set deflate level. Valid values 0-9 (default=5)", type=int, default=5, choices=range(0,10), metavar='{1-9}')
+    parser.add_argument("-d","--dlevel", help="Set deflate level. Valid values 0-9, or auto to choose the level and shuffle for each variable by compressing a sample of its chunks, nc2nc only (default=5)", type=nc2nc.dlevel_type, default=5, metavar='{0-9,auto}')
+    parser.add_argument("--tolerance", help="With --dlevel auto, choose the cheapest setting with a compression ratio within this percentage of the best (default=5)", type=float, default=5.)
     # parser.add_argument("-l","--limited", help="Change unlimited dimension to fixed size (default is to not squash unlimited)", action='store_true')
     parser.add_argument("-n","--noshuffle", help="Don't shuffle on deflation (default is to shuffle)", action='store_true')
     parser.add_argument("-s","--chunksize", help="Set chunksize - total size of one chunk in KiB (default=64), nc2nc only", type=int, default=64)
     parser.add_argument("-b","--buffersize", help="Set size of copy buffer in MiB (default=500), nc2nc only", type=int, default=500)
+    parser.add_argument("--chunking", help="Chunking strategy: balanced for any 1D or 2D subset, timeseries for the whole of the first dimension at a point, spatial for the whole of the last two dimensions at one time, or a comma separated weight for each of the last dimensions (default=balanced), nc2nc only", type=nc2nc.chunking_type, default='balanced')
+    parser.add_argument("-cc","--chunkcache", help="Limit the size of the HDF5 input and output chunk caches of each variable in MiB (default is to fit the chunks one row of the copy buffer touches), nc2nc only", type=int, default=None)
+    parser.add_argument("--plan-cache", help="Store the chunking and copy buffer plan of each file in this SQLite file, and reuse it in this and later runs for files with the same variables, dimensions and options, nc2nc only", dest='plancache', default=None)
     parser.add_argument("-t","--tmpdir", help="Specify temporary directory to save compressed files", default='tmp.nc_compress')
     parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
     parser.add_argument("-r","--recursive", help="Recursively descend directories compressing all netCDF files (default False)", action='store_true')
     parser.add_argument("-o","--overwrite", help="Overwrite original files with compressed versions (default is to not overwrite)", action='store_true')
     parser.add_argument("-m","--maxcompress", help="Set a maximum compression as a paranoid check on success of nccopy (default is 10, set to zero for no check)", default=10,type=maxcompression_type)
-    parser.add_argument("-p","--paranoid", help="Paranoid check : run nco ndiff on the resulting file ensure no data has been altered", action='store_true')
+    parser.add_argument("-p","--paranoid", help="Paranoid check : compare the data in the resulting file with the original to ensure no data has been altered", action='store_true')
+    parser.add_argument("--verify", help="Check compressed files against the originals: full is the same as --paranoid, sample:FRACTION compares a random sample of that fraction of the chunks of each variable", type=nc2nc.verify_type, default=None)
     parser.add_argument("-f","--force", help="Force compression, even if input file is already compressed (default False)", action='store_true')
     parser.add_argument("-c","--clean", help="Clean tmpdir by removing existing compressed files before starting (default False)", action='store_true')
     parser.add_argument("-pa","--parallel", help="Compress files in parallel", action='store_true')
@@ -402,26 +1064,26 @@ def parse_args(arglist):
     parser.add_argument("-ff","--fromfile", help="Read files to be compressed from a text file")
     parser.add_argument("--nccopy", help="Use nccopy instead of nc2nc (default False)", action='store_true')
     parser.add_argument("--timing", help="Collect timing statistics when compressing each file (default False)", action='store_true')
+    parser.add_argument("--schedule", help="Order in which files are compressed: walk submits files as directories are found, largest finds all files first and compresses the most costly first (default walk)", choices=['walk','largest'], default='walk')
+    parser.add_argument("--cost", help="Cost model used to order files with --schedule largest: size in bytes, or size scaled by deflate level (default size)", choices=sorted(cost_models), default='size')
+    parser.add_argument("--max-memory", help="Only compress files in parallel while their estimated memory use fits in this many MiB, reducing the copy buffer of files that won't fit on their own. auto is {:d}%% of available memory, 0 is no limit (default 0)".format(int(memory_fraction*100)), type=maxmemory_type, default=0)
+    parser.add_argument("--manifest", help="Write a manifest of the digests of the variables in each file compressed by nc2nc, beside the compressed file (default False)", action='store_true')
+    parser.add_argument("--progress", help="Show files and bytes done, rate, compression ratio and estimated time remaining as files are compressed (default False)", action='store_true')
+    parser.add_argument("--progress-interval", help="Seconds between progress updates (default 1 on a terminal, otherwise 60)", type=float, default=None)
+    parser.add_argument("--report", help="Write a JSON record of the result of each file to this file as it is finished, followed by a summary of the run (JSON Lines)")
+    parser.add_argument("--index", help="Index file (SQLite), shared with ncfind, recording the format and compression of each file. Unchanged files are not opened, and files which are compressed and overwritten are recorded")
     parser.add_argument("inputs", help="netCDF files or directories (-r must be specified to recursively descend directories). Can accept piped arguments.", nargs='*', default=sys.stdin)
 
     return parser.parse_args(arglist)
 
-def main(args):
-    
-    # We won't make users specify parallel if they've specified a number of processors
-    if args.numproc: args.parallel = True
-
-    if args.parallel:
-        if args.numproc is not None:
-            numproc = args.numproc
-        else:
-            numproc = mp.cpu_count()
+def find_directories(args):
+    """ Generate (path, list of files in path) for all the inputs given in args.
+        Directories are returned as they are found, files that were specified
+        directly are grouped by directory and returned last
+    """
 
     filedict = defaultdict(list)
 
-    if args.fromfile:
-        args.inputs = open(args.fromfile)
-
     # Loop over all the inputs from the command line. These can be either file globs
     # or directory names. In either case we'll group them by directory
     for ncinput in args.inputs:
@@ -449,22 +1111,7 @@ def main(args):
                     break
                 else:
                     # Compress all the files in this directory
-                    compress_files(root,
-                                   files,
-                                   args.tmpdir,
-                                   args.overwrite,
-                                   args.maxcompress,
-                                   args.dlevel,
-                                   not args.noshuffle,
-                                   args.force,
-                                   args.clean,
-                                   args.verbose,
-                                   args.chunksize,
-                                   args.buffersize,
-                                   args.nccopy,
-                                   args.paranoid,
-                                   numproc,
-                                   args.timing)
+                    yield root, files
                     # Note we've traversed this directory but set directory to an empty list
                     filedict[root] = []
         else:
@@ -472,31 +1119,86 @@ def main(args):
             if (root == ''): root = "./"
             filedict[root].append(file)
 
-    if args.fromfile:
-        args.inputs.close()
-
     # Files that were specified directly on the command line are compressed by directory.
     # We only create a temporary directory once, and can then clean up after ourselves.
     # Also makes it easier to run some checks to ensure compression is ok, as all the files
     # are named the same, just in a separate temporary sub directory.
     for directory in filedict:
         if len(filedict[directory]) == 0: continue
-        compress_files(directory,
-                       filedict[directory],
-                       args.tmpdir,
-                       args.overwrite,
-                       args.maxcompress,
-                       args.dlevel,
-                       not args.noshuffle,
-                       args.force,
-                       args.clean,
-                       args.verbose,
-                       args.chunksize,
-                       args.buffersize,
-                       args.nccopy,
-                       args.paranoid,
-                       numproc,
-                       args.timing)
+        yield directory, filedict[directory]
+
+def main(args):
+    
+    # We won't make users specify parallel if they've specified a number of processors
+    if args.numproc: args.parallel = True
+
+    if args.parallel:
+        if args.numproc is not None:
+            numproc = args.numproc
+        else:
+            numproc = mp.cpu_count()
+
+    # A full check is the same as paranoid mode
+    sample = args.verify
+    if sample is not None and sample >= 1.:
+        args.paranoid = True
+        sample = None
+
+    maxmemory = None
+    if args.max_memory == 'auto':
+        available = available_memory()
+        if available is not None: maxmemory = int(available*memory_fraction)
+    elif args.max_memory > 0:
+        maxmemory = args.max_memory*(1024**2)
+
+    index = None
+    if args.index: index = ScanIndex(args.index)
+
+    report = None
+    if args.report: report = open(args.report, 'w')
+
+    progress = None
+    if args.progress:
+        interval = args.progress_interval
+        if interval is None: interval = 1. if sys.stderr.isatty() else 60.
+        progress = new_progress(interval)
+
+    if args.fromfile:
+        args.inputs = open(args.fromfile)
+
+    compress_files(find_directories(args),
+                   args.tmpdir,
+                   args.overwrite,
+                   args.maxcompress,
+                   args.dlevel,
+                   not args.noshuffle,
+                   args.force,
+                   args.clean,
+                   args.verbose,
+                   args.chunksize,
+                   args.buffersize,
+                   args.nccopy,
+                   args.paranoid,
+                   numproc,
+                   args.timing,
+                   args.chunkcache,
+                   index,
+                   args.schedule,
+                   args.cost,
+                   maxmemory,
+                   args.manifest,
+                   sample,
+                   report,
+                   progress,
+                   args.tolerance/100.,
+                   args.chunking,
+                   args.plancache)
+
+    if args.fromfile:
+        args.inputs.close()
+
+    if index is not None: index.close()
+    if report is not None: report.close()
 
                 
 def main_parse_args(arglist):
@@ -7,11 +7,12 @@ import argparse
 import re
 from warnings import warn
 from shutil import move
-from collections import defaultdict
 import math
 import operator
 import numpy as np
 import numpy.ma as ma
+import sqlite3
+import multiprocessing as mp
 
 if (sys.version_info > (3, 0)):
      # Python 3 code in this block
@@ -22,20 +23,248 @@ else:
 
 # A couple of hard-wired executable paths that might need changing
 
+# Magic numbers at the start of netCDF3 files, and the file_format they correspond to
+netcdf3_magic = {
+    b'CDF\x01' : 'NETCDF3_CLASSIC',
+    b'CDF\x02' : 'NETCDF3_64BIT_OFFSET',
+    b'CDF\x05' : 'NETCDF3_64BIT_DATA',
+}
+
+# netCDF4 files are HDF5 files. The HDF5 signature is found at the start of the
+# superblock, which is at offset 0, 512, 1024, 2048 ... bytes in the file
+hdf5_signature = b'\x89HDF\r\n\x1a\n'
+
+def sniff_format(ncfile):
+    """ Identify the format of ncfile from the first bytes of the file, without
+        opening it with the netCDF library. Returns one of the netCDF3 file_format
+        names, 'HDF5' for a file which may be netCDF4, or None if ncfile
+        cannot be a netCDF file
+    """
+    try:
+        with open(ncfile, 'rb') as fh:
+            magic = fh.read(len(hdf5_signature))
+            if magic[:4] in netcdf3_magic:
+                return netcdf3_magic[magic[:4]]
+            offset = 0
+            size = os.fstat(fh.fileno()).st_size
+            while offset + len(hdf5_signature) <= size:
+                if magic == hdf5_signature:
+                    return 'HDF5'
+                offset = max(512, offset*2)
+                fh.seek(offset)
+                magic = fh.read(len(hdf5_signature))
+    except (IOError, OSError):
+        pass
+    return None
+
+def probe_netCDF(ncfile):
+    """ Return the file_format of ncfile, and whether it is compressed. The
+        format is None if ncfile is not a netCDF file
+    """
+    format = sniff_format(ncfile)
+    if format is None:
+        return None, False
+    if format.startswith('NETCDF3'):
+        # netCDF3 files cannot be compressed, no need to open them
+        return format, False
+    try:
+        with nc.Dataset(ncfile) as fh:
+            format = fh.file_format
+            iscompressed = is_compressed(fh)
+    except netcdf4exception:
+        return None, False
+    return format, iscompressed
+
 def is_netCDF_compressed(ncfile):
     """ Test to see if ncfile is a valid netCDF file
     """
-    isnetCDF=False
-    iscompressed=False
+    format, iscompressed = probe_netCDF(ncfile)
+    return format is not None, iscompressed
+
+def stat_key(stat):
+    """ Return the (size, mtime, inode) tuple used to detect changed files
+    """
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def probe_file(path, entry=None):
+    """ Return (format, compressed, key) for path, where key is the
+        (size, mtime, inode) of the file. entry is (key, format, compressed)
+        from a ScanIndex, and if the key of the file has not changed the
+        file is not probed. key is None if the file cannot be read
+    """
     try:
-        fh = nc.Dataset(ncfile)
-        isnetCDF=True
-        iscompressed = is_compressed(fh)
-        fh.close
-    except netcdf4exception:
-        # Don't do anything
+        key = stat_key(os.stat(path))
+    except OSError:
+        return None, False, None
+    if entry is not None and entry[0] == key:
+        return entry[1], entry[2], key
+    format, compressed = probe_netCDF(path)
+    return format, compressed, key
+
+def _probe_file_star(args):
+    """ Unpack arguments for probe_file, for use with Pool.imap
+    """
+    return probe_file(*args)
+
+def scan_directory(path, sort=False):
+    """ Return (path, files, subdirectories) for the directory path, using
+        os.scandir. Symbolic links to directories are not included in the
+        subdirectories, as os.walk does not follow them
+    """
+    files = []
+    dirs = []
+    try:
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink(): dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+            except OSError:
+                continue
+    except OSError:
+        # Unreadable directories are ignored, as they are by os.walk
         pass
-    return isnetCDF, iscompressed
+    if sort:
+        files.sort()
+        dirs.sort()
+    return path, files, [os.path.join(path, dir) for dir in dirs]
+
+def walk(top, recursive=True, pool=None, sort=False):
+    """ Generate (directory, files, subdirectories) for top and, if recursive, all
+        the directories below it, in the same order as os.walk. If pool (a
+        multiprocessing Pool) is given, directories are scanned in parallel
+        ahead of the directory being returned
+    """
+    def submit(path):
+        if pool is None: return path
+        return pool.apply_async(scan_directory, (path, sort))
+
+    def result(pending):
+        if pool is None: return scan_directory(pending, sort)
+        return pending.get()
+
+    # A stack of directories to visit, last in first out gives the same order as os.walk
+    stack = [submit(top)]
+    while len(stack) > 0:
+        root, files, dirs = result(stack.pop())
+        yield root, files, dirs
+        if recursive: stack.extend(submit(dir) for dir in reversed(dirs))
+
+def _finish_batch(tasks, results, index):
+    """ Record the results of probing a batch of files in index, and return
+        (path, format, compressed) for each
+    """
+    classified = []
+    for (path, entry), (format, compressed, key) in zip(tasks, results):
+        if index is not None and key is not None and (entry is None or entry[0] != key):
+            index.record(path, key, format, compressed)
+        classified.append((path, format, compressed))
+    return classified
+
+def classify_files(filepaths, index=None, pool=None, batchsize=16, maxpending=2):
+    """ Generate (path, format, compressed) for each of filepaths, in the same
+        order. index (a ScanIndex) is consulted and updated if given. If pool
+        (a multiprocessing Pool) is given, files are probed in parallel in
+        batches of batchsize, with up to maxpending batches in progress
+    """
+    if pool is None:
+        for path in filepaths:
+            tasks = [(path, None if index is None else index.entry(path))]
+            for result in _finish_batch(tasks, map(_probe_file_star, tasks), index): yield result
+        return
+
+    batches = []
+    tasks = []
+    for path in filepaths:
+        tasks.append((path, None if index is None else index.entry(path)))
+        if len(tasks) < batchsize: continue
+        batches.append((tasks, pool.map_async(_probe_file_star, tasks)))
+        tasks = []
+        # Return results in order, as soon as the oldest batch is finished
+        while len(batches) > maxpending or (len(batches) > 0 and batches[0][1].ready()):
+            done, results = batches.pop(0)
+            for result in _finish_batch(done, results.get(), index): yield result
+
+    batches.append((tasks, pool.map_async(_probe_file_star, tasks)))
+    for done, results in batches:
+        for result in _finish_batch(done, results.get(), index): yield result
+
+class ScanIndex(object):
+    """ Persistent index of the format and compression state of files, stored
+        in a SQLite database. Files are only probed again if their size,
+        modification time or inode have changed since they were indexed
+    """
+
+    # Number of updates between commits to the database
+    commit_interval = 1000
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                                   path TEXT PRIMARY KEY,
+                                   size INTEGER,
+                                   mtime INTEGER,
+                                   inode INTEGER,
+                                   format TEXT,
+                                   compressed INTEGER)""")
+        self.uncommitted = 0
+
+    def entry(self, path):
+        """ Return (key, format, compressed) recorded for path, where key is
+            (size, mtime, inode), or None if path is not in the index
+        """
+        row = self.connection.execute(
+            "SELECT size, mtime, inode, format, compressed FROM files WHERE path=?",
+            (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        return tuple(row[0:3]), row[3], bool(row[4])
+
+    def lookup(self, path, stat=None):
+        """ Return (format, compressed) for path, or None if path is not
+            in the index or has changed since it was indexed
+        """
+        if stat is None: stat = os.stat(path)
+        entry = self.entry(path)
+        if entry is None or entry[0] != stat_key(stat):
+            return None
+        return entry[1], entry[2]
+
+    def record(self, path, key, format, compressed):
+        """ Record the format and compression state of path, where key is
+            (size, mtime, inode) of the file when it was probed
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)",
+            (os.path.abspath(path),) + tuple(key) + (format, int(compressed)))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.commit()
+
+    def update(self, path, format, compressed, stat=None):
+        """ Record the format and compression state of path
+        """
+        if stat is None: stat = os.stat(path)
+        self.record(path, stat_key(stat), format, compressed)
+
+    def probe(self, path):
+        """ Return (format, compressed) for path from the index, probing and
+            indexing the file if it has changed
+        """
+        entry = self.entry(path)
+        format, compressed, key = probe_file(path, entry)
+        if key is not None and (entry is None or entry[0] != key):
+            self.record(path, key, format, compressed)
+        return format, compressed
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
 
 def is_compressed(handle):
     """ Test if netcdfile is compressed
@@ -74,28 +303,21 @@ def parse_args(arglist):
     group.add_argument("-u","--uncompressed", help="Find only uncompressed netCDF files (default False)", action='store_true')
     group.add_argument("-c","--compressed", help="Find only compressed netCDF files (default False)", action='store_true')
 
+    parser.add_argument("-j","--jobs", help="Number of processes used to scan directories and probe files in parallel (default=1)", type=int, default=1)
+    parser.add_argument("-s","--sort", help="Sort files and directories by name within each directory (default is directory order)", action='store_true')
+    parser.add_argument("-0","--null", help="Separate output file names with a NUL character instead of a newline", action='store_true')
+    parser.add_argument("-i","--index", help="Index file (SQLite) recording the format and compression of each file, files are only opened if they have changed since they were indexed")
     parser.add_argument("inputs", help="netCDF files or directories (-r must be specified to recursively descend directories). Can accept piped arguments.", nargs='*', default=sys.stdin)
 
     return parser.parse_args(arglist)
     
-def find_files(args):
-    
-    # verbose=args.verbose
-
-    findcompressed = args.compressed
-    finduncompressed = args.uncompressed
-
-    found_files = []
-
-    # If neither are specified make them both true, find any kind of netCDF file
-    if not finduncompressed and not findcompressed:
-        findcompressed = True
-        finduncompressed = True
-
-    filedict = defaultdict(list)
+def input_files(args, pool=None):
+    """ Generate the paths of all the files in the inputs given in args,
+        descending into directories if args.recursive is set
+    """
 
     # Loop over all the inputs from the command line. These can be either file globs
-    # or directory names. In either case we'll group them by directory
+    # or directory names
     for ncinput in args.inputs:
         # If we pipe files to stdin they may have a trailing newline, so we
         # need to strip it out
@@ -104,56 +326,72 @@ def find_files(args):
             sys.stderr.write("Input does not exist: {} .. skipping\n".format(ncinput))
             continue
         if os.path.isdir(ncinput):
-            # os.walk will return the entire directory structure
-            for root, dirs, files in os.walk(ncinput,topdown=True):
-                # Ignore emtpy directories, and our own temp directory, in case we
-                # re-run on same tree
-                if len(files) == 0: continue
-                # if root.endswith(args.tmpdir): continue
+            for root, files, dirs in walk(ncinput, args.recursive, pool, args.sort):
+                for file in files:
+                    yield os.path.join(root,file)
                 # Only descend into subdirs if we've set the recursive flag
-                if (root != ncinput and not args.recursive):
+                if (not args.recursive and len(dirs) > 0):
                     sys.stderr.write("Skipping subdirectories :: --recursive option not specified\n")
-                    break
-                else:
-                    # Group by directory
-                    filedict[root].extend(files)
         else:
             (root,file) = os.path.split(ncinput)
             if (root == ''): root = "./"
-            filedict[root].append(file)
+            yield os.path.join(root,file)
 
-    ncompressed = 0
-    nuncompressed = 0
+def iter_files(args):
+    """ Generate the paths of netCDF files found in the inputs given in args,
+        as soon as each file has been classified
+    """
     
-    if len(filedict) == 0:
+    # verbose=args.verbose
+
+    findcompressed = args.compressed
+    finduncompressed = args.uncompressed
+
+    # If neither are specified make them both true, find any kind of netCDF file
+    if not finduncompressed and not findcompressed:
+        findcompressed = True
+        finduncompressed = True
+
+    index = None
+    if args.index: index = ScanIndex(args.index)
+
+    # Worker processes to scan directories and probe files
+    pool = None
+    if args.jobs > 1: pool = mp.Pool(processes=args.jobs)
+
+    nfiles = 0
+
+    try:
+        for filepath, format, iscompressed in classify_files(input_files(args, pool), index, pool, maxpending=2*args.jobs):
+            nfiles += 1
+            if format is not None:
+                if iscompressed:
+                    if findcompressed: yield filepath
+                else:
+                    if finduncompressed: yield filepath
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if index is not None: index.close()
+
+    if nfiles == 0:
         sys.stderr.write("No files found to process\n")
-    else:
-        # We only create a temporary directory once,
-        # and can then clean up after ourselves. Also makes it easier to run some checks to
-        # ensure compression is ok, as all the files are named the same, just in a separate
-        # temporary sub directory.
-        for directory in filedict:
-            if len(filedict[directory]) == 0: continue
-            for file in filedict[directory]:
-                filepath = os.path.join(directory,file)
-                isnetCDF, iscompressed =  is_netCDF_compressed(filepath)
-                if isnetCDF:
-                    if iscompressed:
-                        ncompressed += 1
-                        if findcompressed: found_files.append(filepath)
-                    else:
-                        nuncompressed += 1
-                        if finduncompressed: found_files.append(filepath)
-
-    return found_files
+
+def find_files(args):
+    """ Return a list of the paths of netCDF files found in the inputs given in args
+    """
+    return list(iter_files(args))
 
 def main(args):
 
-    found_files = find_files(args)
+    # Separate file names with NUL, so any file name can be safely read by e.g. xargs -0
+    separator = "\0" if args.null else "\n"
 
-    if found_files:
-        for file in found_files:
-            sys.stdout.write(file+"\n")
+    for file in iter_files(args):
+        sys.stdout.write(file+separator)
+        # Flush so the file can be processed by the next program in a pipeline immediately
+        sys.stdout.flush()
                 
 def main_parse_args(arglist):
     """
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2015 ARC Centre of Excellence for Climate Systems Science
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+import os
+import io
+import json
+import shutil
+
+from benchmarks import datasets, run
+
+workdir = 'benchmarks_tmp'
+
+def setup_module(module):
+    if os.path.exists(workdir): shutil.rmtree(workdir)
+    os.makedirs(workdir)
+
+def teardown_module(module):
+    shutil.rmtree(workdir)
+
+def test_make_dataset():
+
+    for name in ('masked', 'record', 'manyvars'):
+        datasets.make_named(name, workdir, scale=0.2)
+
+    with Dataset(os.path.join(workdir, 'masked.nc')) as ncfile:
+        masked = ncfile.variables['masked'][:]
+        assert masked.shape == (12, 18, 36)
+        assert 0 < masked.mask.sum() < masked.size
+    with Dataset(os.path.join(workdir, 'record.nc')) as ncfile:
+        assert ncfile.dimensions['time'].isunlimited()
+    with Dataset(os.path.join(workdir, 'manyvars.nc')) as ncfile:
+        assert len([name for name in ncfile.variables if name.startswith('var')]) == 100
+
+    # The same seed always makes the same data
+    assert_array_equal(datasets.make_field((2, 10, 20), 'noisy', 3), datasets.make_field((2, 10, 20), 'noisy', 3))
+
+    files = datasets.make_tree(os.path.join(workdir, 'tree'), nfiles=6, ndirs=3)
+    assert len(files) == 6
+    assert len(os.listdir(os.path.join(workdir, 'tree'))) == 3
+
+def test_run_and_compare():
+
+    output = os.path.join(workdir, 'results.json')
+    assert run.main_parse_args(['run', '--datasets', 'smooth', 'tree', '--scale', '0.2', '--tree-files', '4',
+                                '-d', '1', '5', '--repeat', '1', '--no-nccopy', '--workdir', workdir,
+                                '-o', output]) == 0
+
+    with open(output) as f:
+        record = json.load(f)
+    assert 'commit' in record['environment']
+    results = record['results']
+    assert len([result for result in results if result['bench'] == 'nc2nc']) == 2
+    assert len([result for result in results if result['bench'] == 'nccompress']) == 2
+    for result in results:
+        assert result['elapsed'] > 0.
+        assert result['ratio'] > 1.
+
+    # A run compared with itself has no regressions, but one twice as slow does
+    stream = io.StringIO()
+    assert run.compare(record, record, stream=stream) == []
+    slower = json.loads(json.dumps(record))
+    for result in slower['results']: result['elapsed'] *= 2
+    assert len(run.compare(record, slower, stream=stream)) == len(results)
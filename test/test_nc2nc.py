@@ -16,10 +16,15 @@ limitations under the License.
 
 import pytest
 import imp
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 from numpy import array, arange, dtype
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 import os
+import json
+import argparse
+import faulthandler
+import numpy as np
+import numpy.ma as ma
 from utils import make_simple_netcdf_file, remove_ncfiles
 from nccompress import nc2nc
 
@@ -70,6 +75,462 @@ def test_chunk_shape_nD():
     # silently ignore and use the variable dimensions
     assert_array_equal( nc2nc.chunk_shape_nD((1,5,5,5),4,4096,12), [1,5,5,5])
 
+# The masked array implementation of chunk_shape_nD (and the loop in cascadeRounding)
+# which was replaced, to check the current implementation gives identical chunk shapes
+
+def legacy_cascadeRounding(array):
+
+    sort_index = np.argsort(array)
+    integer_array = []
+
+    total_float = 0
+    total_int = 0
+
+    limit = np.floor(sum(array))
+    
+    for idx in sort_index:
+        total_float += array[idx]
+        integer_array.append(min(round(total_float),limit)-total_int)
+        total_int += integer_array[-1]
+
+    rounded_array = np.zeros(len(array))
+
+    for i in range(len(sort_index)):
+        rounded_array[sort_index[i]] = integer_array[i]
+
+    return rounded_array
+
+def legacy_calcChunkShape(chunkVol, varShape):
+
+    return np.array(legacy_cascadeRounding(np.asarray(varShape) * (chunkVol / float(nc2nc.numVals(varShape))) ** (1./len(varShape))),dtype="int")
+
+def legacy_chunk_shape_nD(varShape, valSize=4, chunkSize=4096, minDim=1):
+
+    varShapema = ma.array(varShape)
+    
+    chunkVals = min(chunkSize / float(valSize),nc2nc.numVals(varShapema))
+
+    chunkShape = ma.array(legacy_calcChunkShape(chunkVals,varShapema),dtype=int)
+
+    if len(varShapema) == 1: return chunkShape.filled(fill_value=1)
+
+    chunkShapeFinal = ma.masked_all(chunkShape.shape,dtype=int)
+
+    if chunkVals < nc2nc.numVals(np.minimum(varShapema,minDim)):
+        while chunkVals < nc2nc.numVals(np.minimum(varShapema,minDim)):
+            minDim -= 1
+
+    lastChunkCount = -1
+    
+    while True:
+
+        for i in range(len(chunkShape)):
+            if ma.is_masked(chunkShape[i]):
+                continue 
+            if (chunkShape[i] < minDim):
+                chunkShapeFinal[i] = min(minDim,varShapema[i])
+                chunkShape[i] = ma.masked
+
+        if chunkShapeFinal.count() > 0:
+            chunkCount = nc2nc.numVals(chunkShapeFinal[~chunkShapeFinal.mask])
+        else:
+            if (lastChunkCount == -1):
+                break
+
+        if chunkCount != lastChunkCount and len(varShapema[~chunkShape.mask]) > 0:
+            chunkShape[~chunkShape.mask] = legacy_calcChunkShape(chunkVals/chunkCount,varShapema[~chunkShape.mask])
+            lastChunkCount = chunkCount
+        else:
+            break
+
+    for i in range(len(chunkShapeFinal)):
+        if ma.is_masked(chunkShapeFinal[i]):
+            chunkShapeFinal[i] = chunkShape[i]
+
+    return chunkShapeFinal.filled(fill_value=1)
+
+def test_chunk_shape_nD_legacy():
+
+    rng = np.random.RandomState(42)
+    for i in range(200):
+        array = rng.uniform(0, 100, rng.randint(1, 6))
+        assert_array_equal(nc2nc.cascadeRounding(array), legacy_cascadeRounding(array))
+
+    for i in range(2000):
+        ndim = rng.randint(1, 6)
+        # Dimension lengths from 1 to about 5000, most of them short
+        shape = tuple(int(n) for n in np.exp(rng.uniform(0, 8.5, ndim)))
+        valSize = int(rng.choice([1, 2, 4, 8]))
+        chunkSize = int(rng.choice([1024, 4096, 65536, 1024**2]))
+        minDim = int(rng.choice([1, 2, 5, 10]))
+        chunks = nc2nc.chunk_shape_nD(shape, valSize, chunkSize, minDim)
+        assert_array_equal(chunks, legacy_chunk_shape_nD(shape, valSize, chunkSize, minDim), 
+                           err_msg='shape %s valSize %d chunkSize %d minDim %d' % (shape, valSize, chunkSize, minDim))
+        assert chunks.dtype == int
+
+    # Shapes are only planned once, and callers get their own copy to modify
+    nc2nc.plan_chunks.cache_clear()
+    chunks = nc2nc.chunk_shape_nD((1,50,1080,1440), 4, 4096, 2)
+    chunks[0] = 100
+    assert_array_equal(nc2nc.chunk_shape_nD([1,50,1080,1440], 4, 4096, 2), [1,2,20,25])
+    assert nc2nc.plan_chunks.cache_info().hits == 1
+
+def test_chunk_strategies():
+    shape = (1460,1080,1440)
+    # Balanced is the same as chunk_shape_nD
+    assert_array_equal(nc2nc.chunk_shape(shape,4,4096,strategy='balanced'), nc2nc.chunk_shape_nD(shape,4,4096))
+    assert_array_equal(nc2nc.chunk_shape(shape,4,4096,strategy='timeseries'), [1024,1,1])
+    assert_array_equal(nc2nc.chunk_shape(shape,4,4096,strategy='spatial'), [1,32,32])
+    assert_array_equal(nc2nc.chunk_shape(shape,4,4096,strategy=(1,1,0)), [32,32,1])
+    assert_array_equal(nc2nc.chunk_shape(shape,4,4096,minDim=2,strategy='spatial'), [2,32,32])
+    # Weights apply to the last dimensions
+    assert_array_equal(nc2nc.chunk_shape((1080,1440),4,4096,strategy=(1,0,1)), [1,1024])
+    for strategy in ['balanced','timeseries','spatial',(2,1,1)]:
+        for shape in [(1460,1080,1440),(12,90,180),(7,13,17),(600,)]:
+            chunks = nc2nc.chunk_shape(shape,4,65536,strategy=strategy)
+            assert all((chunks >= 1) & (chunks <= shape))
+
+    # Each strategy touches the fewest chunks for its own access pattern
+    for strategy in ['timeseries','spatial']:
+        chunks = nc2nc.chunk_shape(shape,4,4096,strategy=strategy)
+        for other in ['balanced','timeseries','spatial']:
+            assert nc2nc.predict_chunks(shape,chunks,strategy) <= nc2nc.predict_chunks(shape,nc2nc.chunk_shape(shape,4,4096,strategy=other),strategy)
+    assert nc2nc.predict_chunks((120,600),(20,100),'balanced') == (6 + 6 + 36)/3.
+
+    assert nc2nc.chunking_type('spatial') == 'spatial'
+    assert nc2nc.chunking_type('1,0.5') == (1.,0.5)
+    for value in ['cube','0,0','1,-1','1,a']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            nc2nc.chunking_type(value)
+
+    stats = {}
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.spatial.nc',chunksize=4,clobber=True,chunking=(1,0),stats=stats)
+    with Dataset('simple_xy.spatial.nc') as ncfile:
+        assert ncfile.variables['data'].chunking() == [120,9]
+    assert stats['variables']['data']['touched'] == 1.
+    assert nc2nc.compare('simple_xy.nc','simple_xy.spatial.nc')
+
+def test_buffer_shape():
+    # Whole variable fits in buffer
+    assert_array_equal( nc2nc.buffer_shape((120,600),(20,100),4,1024**2), [120,600])
+    # Buffer is a whole multiple of the chunk shape, filled from the last dimension
+    assert_array_equal( nc2nc.buffer_shape((120,600),(20,100),4,100000), [40,600])
+    assert_array_equal( nc2nc.buffer_shape((120,600),(20,100),4,10000), [20,100])
+    assert_array_equal( nc2nc.buffer_shape((120,600),(20,100),4,20000), [20,200])
+    # Buffer smaller than a chunk is one chunk
+    assert_array_equal( nc2nc.buffer_shape((120,600),(20,100),4,10), [20,100])
+    # Partial chunks at the end of dimensions
+    assert_array_equal( nc2nc.buffer_shape((10,1080,1440),(1,101,133),4,500*1024**2), [10,1080,1440])
+    for shape in [(1,50,108,144),(36,108,144),(7,13,17)]:
+        chunks = nc2nc.chunk_shape_nD(shape,4,4096)
+        for buffersize in [4096,65536,1024**2]:
+            buffer = nc2nc.buffer_shape(shape,chunks,4,buffersize)
+            # Buffer is within budget, and every buffer edge is on a chunk edge
+            assert nc2nc.numVals(buffer)*4 <= max(buffersize,nc2nc.numVals(chunks)*4)
+            assert all((buffer % chunks == 0) | (buffer == shape))
+            touched = [nc2nc.chunks_touched(s,chunks) for s in nc2nc.hyperslabs(shape,buffer)]
+            assert sum(touched) == nc2nc.numVals((array(shape)-1)//chunks + 1)
+
+def test_chunk_cache():
+    assert nc2nc.next_prime(2) == 2
+    assert nc2nc.next_prime(1000) == 1009
+    # Cache holds the chunks touched by the last row of a buffer, along the
+    # dimension in which the buffers advance
+    assert nc2nc.chunk_cache((120,600),(40,600),(20,100),4,preemption=1.) == (48000,601,1.)
+    assert nc2nc.chunk_cache((120,600),(30,600),(20,100),4) == (48000,601,0.75)
+    assert nc2nc.chunk_cache((120,600),(40,600),(30,250),4) == (90000,307,0.75)
+    assert nc2nc.chunk_cache((10,120,600),(1,40,600),(1,20,100),4) == (48000,601,0.75)
+    # or the first row, if the buffer is the whole variable
+    assert nc2nc.chunk_cache((120,600),(120,600),(20,100),4) == (48000,601,0.75)
+    # Cache size can be overridden
+    assert nc2nc.chunk_cache((120,600),(40,600),(20,100),4,cacheSize=8000) == (8000,101,0.75)
+
+def test_limit_caches():
+    plan = {'a' : {'cache' : [48000,601,1.], 'incache' : [16000,201,0.75]},
+            'b' : {'cache' : [16000,201,1.], 'incache' : None},
+            'c' : {'cache' : None, 'incache' : None}}
+    # Each variable is limited on its own, not the total of all the variables
+    nc2nc.limit_caches(plan, 64000)
+    assert (plan['a']['cache'][0], plan['a']['incache'][0], plan['b']['cache'][0]) == (48000,16000,16000)
+    # The caches of a variable are limited in proportion to their size
+    nc2nc.limit_caches(plan, 40000)
+    assert (plan['a']['cache'][0], plan['a']['incache'][0], plan['b']['cache'][0]) == (30000,10000,16000)
+    # Many variables each keep caches up to the limit
+    plan = dict((str(i), {'cache' : [16000,201,1.], 'incache' : [16000,201,0.75]}) for i in range(100))
+    nc2nc.limit_caches(plan, 32000)
+    assert all(varplan['cache'][0] == 16000 for varplan in plan.values())
+
+def test_transfer_rate():
+
+    assert nc2nc.transfer_rate(2e6, 0.5) == 4.
+    # Too short to measure, such as the copy of a scalar variable
+    assert nc2nc.transfer_rate(4, 0.) is None
+    assert nc2nc.transfer_rate(4, nc2nc.rate_resolution/2) is None
+
+def test_estimate_memory():
+
+    ncfile = Dataset('simple_xy.nc')
+    # Whole variable (120 x 600 float32) fits in the buffer, as data, mask and filled copy,
+    # and the output chunk cache is no larger than the variable
+    memory = nc2nc.estimate_memory(ncfile, chunksize=4, buffersize=50)
+    assert memory > 120*600*9
+    assert memory <= 120*600*(9 + 4)
+    assert nc2nc.estimate_memory(ncfile, chunksize=4, buffersize=0) < memory
+    assert nc2nc.estimate_memory(ncfile, chunksize=4, buffersize=50, pipeline=2) > memory
+    # Chunks passed to and from the pool of compression processes
+    assert (nc2nc.estimate_memory(ncfile, chunksize=4, buffersize=50, numproc=2) - memory ==
+            2*2*nc2nc.direct_inflight*nc2nc.numVals(nc2nc.chunk_shape_nD((120,600),4,4096))*4)
+    ncfile.close()
+
+def test_release_cache():
+
+    # Chunked variables, which have input chunk caches
+    estimates = []
+    for nvars in (1, 4):
+        with Dataset('simple_xy.manyvars.nc','w',format='NETCDF4_CLASSIC') as ncfile:
+            ncfile.createDimension('x',120)
+            ncfile.createDimension('y',600)
+            for i in range(nvars):
+                ncfile.createVariable('data%d' % i,'f4',('x','y'),zlib=True,chunksizes=(20,100))[:] = arange(120*600).reshape(120,600)
+        with Dataset('simple_xy.manyvars.nc') as ncfile:
+            estimates.append(nc2nc.estimate_memory(ncfile, chunksize=4, buffersize=50))
+    # Only the caches of the variable being copied are held
+    assert estimates[0] == estimates[1]
+
+    with Dataset('simple_xy.manyvars.nc') as ncfile:
+        copy_vars = [('data%d' % i, (40,600), (96000,1201,0.75), True) for i in range(4)]
+        for varname, slices, data in nc2nc.read_hyperslabs(ncfile, copy_vars):
+            assert ncfile.variables[varname].get_var_chunk_cache()[0] == 96000
+        for i in range(4):
+            assert ncfile.variables['data%d' % i].get_var_chunk_cache()[0] == 0
+
+    nc2nc.nc2nc('simple_xy.manyvars.nc','simple_xy.manyvars2nc.nc',chunksize=4,buffersize=0,clobber=True)
+    assert nc2nc.compare('simple_xy.manyvars.nc','simple_xy.manyvars2nc.nc')
+
+def test_compare():
+
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.compare.nc',chunksize=4,buffersize=0,clobber=True)
+    assert nc2nc.compare('simple_xy.nc','simple_xy.compare.nc')
+    assert nc2nc.compare('simple_xy.nc','simple_xy.compare.nc',buffersize=0)
+
+    # Fill values and NaNs in the same places are the same
+    for filename in ['simple_xy.nc','simple_xy.compare.nc']:
+        ncfile = Dataset(filename,'a')
+        ncfile.variables['data'][0,0] = default_fillvals['f4']
+        ncfile.variables['data'][1,0] = float('nan')
+        ncfile.close()
+    assert nc2nc.compare('simple_xy.nc','simple_xy.compare.nc')
+
+    ncfile = Dataset('simple_xy.compare.nc','a')
+    ncfile.variables['data'][119,599] = -1.
+    ncfile.close()
+    assert not nc2nc.compare('simple_xy.nc','simple_xy.compare.nc',buffersize=0,verbose=True)
+
+    # Restore the original for other tests
+    make_simple_netcdf_file(ncfiles)
+
+def test_sample_chunks():
+
+    chunks = nc2nc.sample_chunks((120,600),(20,100),0.25,seed=1)
+    assert chunks == nc2nc.sample_chunks((120,600),(20,100),0.25,seed=1)
+    assert len(chunks) == 9
+    # First and last chunks are always included
+    assert chunks[0] == (slice(0,20),slice(0,100))
+    assert chunks[-1] == (slice(100,120),slice(500,600))
+    assert len(nc2nc.sample_chunks((120,600),(20,100),1.)) == 36
+    assert nc2nc.sample_chunks((0,600),(1,100),1.) == []
+
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.sample.nc',chunksize=4,clobber=True)
+    equal, compared, total = nc2nc.compare_sample('simple_xy.nc','simple_xy.sample.nc',0.1)
+    assert equal
+    assert total == 120*600
+    assert 0.1*total <= compared < 0.2*total
+
+    # A difference in the last chunk is always found
+    ncfile = Dataset('simple_xy.sample.nc','a')
+    ncfile.variables['data'][119,599] = -1.
+    ncfile.close()
+    assert not nc2nc.compare_sample('simple_xy.nc','simple_xy.sample.nc',0.01,verbose=True)[0]
+
+def test_stats():
+
+    stats = {}
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.stats.nc',chunksize=4,buffersize=0,clobber=True,stats=stats)
+    for stage in ['open','plan','sync','total','utime','stime']:
+        assert stats[stage] >= 0.
+    assert stats['open'] + stats['plan'] + stats['sync'] <= stats['total']
+    assert stats['bytes_in'] == 120*600*4
+    assert stats['bytes_out'] == os.path.getsize('simple_xy.stats.nc')
+    assert stats['variables']['data']['bytes'] == 120*600*4
+    assert stats['variables']['data']['read'] > 0.
+    assert stats['variables']['data']['write'] > 0.
+    assert stats['maxrss'] > 0
+
+def test_digests():
+
+    digests = {}
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.digests.nc',chunksize=4,buffersize=0,clobber=True,
+                digests=digests,manifest='simple_xy.digests.json')
+    assert list(digests) == ['data']
+    assert list(digests['data']) == ['digest']
+    assert nc2nc.read_manifest('simple_xy.digests.json') == digests
+    assert nc2nc.verify_digests('simple_xy.digests.nc', digests)
+    assert nc2nc.verify_digests('simple_xy.digests.nc', digests, buffersize=0)
+
+    # Digests are independent of the copy buffer, which is one chunk above
+    other = {}
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.digests.nc',chunksize=4,buffersize=50,clobber=True,digests=other)
+    assert other == digests
+
+    ncfile = Dataset('simple_xy.digests.nc','a')
+    ncfile.variables['data'][119,599] = -1.
+    ncfile.close()
+    assert not nc2nc.verify_digests('simple_xy.digests.nc', digests, verbose=True)
+    os.remove('simple_xy.digests.json')
+
+def test_choose_deflate():
+
+    ncfile = Dataset('simple_xy.nc')
+    ncvar = ncfile.variables['data']
+    chunks = nc2nc.chunk_shape_nD(ncvar.shape,4,4096)
+
+    decision = nc2nc.choose_deflate(ncvar, chunks, tolerance=0.)
+    assert len(decision['trials']) == 2*len(nc2nc.trial_levels)
+    assert decision['ratio'] == max(trial['ratio'] for trial in decision['trials'])
+    # Any ratio is good enough, so the cheapest setting is chosen
+    decision = nc2nc.choose_deflate(ncvar, chunks, tolerance=1.)
+    assert (decision['level'], decision['shuffle']) == (nc2nc.trial_levels[0], False)
+    decision = nc2nc.choose_deflate(ncvar, chunks, shuffle=False, tolerance=0.)
+    assert not any(trial['shuffle'] for trial in decision['trials'])
+    ncfile.close()
+
+    # Decisions are recorded, and applied to variables already decided
+    decisions = {}
+    stats = {}
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.auto.nc',complevel='auto',clobber=True,decisions=decisions,stats=stats)
+    with Dataset('simple_xy.auto.nc') as ncfile:
+        filters = ncfile.variables['data'].filters()
+    assert filters['complevel'] == decisions['data']['level'] == stats['variables']['data']['level']
+    assert filters['shuffle'] == decisions['data']['shuffle']
+    assert nc2nc.compare('simple_xy.nc','simple_xy.auto.nc')
+
+    with open('simple_xy.decisions.json','w') as f:
+        json.dump({'data' : {'level' : 9, 'shuffle' : False}}, f)
+    nc2nc.main_parse_args(['-o','-d','auto','--decisions','simple_xy.decisions.json','simple_xy.nc','simple_xy.auto.nc'])
+    with Dataset('simple_xy.auto.nc') as ncfile:
+        filters = ncfile.variables['data'].filters()
+    assert (filters['complevel'], filters['shuffle']) == (9, False)
+    os.remove('simple_xy.decisions.json')
+
+def test_plan_cache():
+
+    with Dataset('simple_xy.nc') as ncfile:
+        fingerprint = nc2nc.schema_fingerprint(ncfile, {'chunksize' : 4})
+        assert nc2nc.schema_fingerprint(ncfile, {'chunksize' : 4}) == fingerprint
+        assert nc2nc.schema_fingerprint(ncfile, {'chunksize' : 8}) != fingerprint
+    with Dataset('simple_xy_noclassic.nc') as ncfile:
+        assert nc2nc.schema_fingerprint(ncfile, {'chunksize' : 4}) != fingerprint
+
+    # The plan of the first file is reused for the second, in memory
+    nc2nc.plans.clear()
+    stats = {}
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.plan1.nc',complevel='auto',clobber=True,stats=stats)
+    assert stats['plan_cache'] is None
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.plan2.nc',complevel='auto',clobber=True,stats=stats)
+    assert stats['plan_cache'] == 'memory'
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.plan2.nc',chunksize=8,clobber=True,stats=stats)
+    assert stats['plan_cache'] is None
+    for filename in ['simple_xy.plan1.nc','simple_xy.plan2.nc']:
+        assert nc2nc.compare('simple_xy.nc',filename)
+
+    # and from disk by another process, or run
+    if os.path.exists('simple_xy.plans.db'): os.remove('simple_xy.plans.db')
+    nc2nc.plans.clear()
+    nc2nc.main_parse_args(['-o','-d','auto','--plan-cache','simple_xy.plans.db','simple_xy.nc','simple_xy.plan2.nc'])
+    nc2nc.plans.clear()
+    nc2nc.nc2nc('simple_xy.nc','simple_xy.plan2.nc',complevel='auto',chunksize=64,buffersize=500,clobber=True,
+                stats=stats,plancache='simple_xy.plans.db')
+    assert stats['plan_cache'] == 'disk'
+    with Dataset('simple_xy.plan2.nc') as ncfile:
+        assert ncfile.variables['data'].filters()['complevel'] == stats['variables']['data']['level']
+    assert nc2nc.compare('simple_xy.nc','simple_xy.plan2.nc')
+    os.remove('simple_xy.plans.db')
+
+def test_fletcher32():
+    # Values worked through by hand following H5_checksum_fletcher32
+    assert nc2nc.fletcher32(b'') == 0
+    assert nc2nc.fletcher32(b'ab') == 0x61626162
+    assert nc2nc.fletcher32(b'abc') == 0x25c5c462
+    # Chunks written by the library and by direct chunk writes must match
+    h5py = pytest.importorskip('h5py')
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.fletcher32.nc', clobber=True, fletcher32=True)
+    with h5py.File(ncfiles[0]+'2nc.fletcher32.nc','r') as f:
+        dset = f['data']
+        chunk = dset[tuple(slice(0,c) for c in dset.chunks)]
+        plist = dset.id.get_create_plist()
+        filters = [plist.get_filter(i)[0:3:2] for i in range(plist.get_nfilters())]
+        stored = dset.id.read_direct_chunk((0,0))[1]
+    assert nc2nc.filter_chunk(chunk.tobytes(), 4, filters) == stored
+
+def test_nc2nc_parallel():
+    h5py = pytest.importorskip('h5py')
+    serial = {}
+    parallel = {}
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.serial.nc', clobber=True, buffersize=0, digests=serial)
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.parallel.nc', clobber=True, buffersize=0, numproc=2, digests=parallel)
+    assert serial == parallel
+    stats = {}
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.parallel.nc', clobber=True, buffersize=0, numproc=2, stats=stats)
+    assert stats['variables']['data']['write'] > 0.
+    assert nc2nc.verify_digests(ncfiles[0]+'2nc.parallel.nc', parallel)
+    with h5py.File(ncfiles[0]+'2nc.serial.nc','r') as f, h5py.File(ncfiles[0]+'2nc.parallel.nc','r') as g:
+        assert f['data'].id.get_num_chunks() == g['data'].id.get_num_chunks()
+        for i in range(f['data'].id.get_num_chunks()):
+            offset = f['data'].id.get_chunk_info(i).chunk_offset
+            assert f['data'].id.read_direct_chunk(offset) == g['data'].id.read_direct_chunk(offset)
+    ds = Dataset(ncfiles[0]+'2nc.parallel.nc')
+    assert ds.data_model == 'NETCDF4_CLASSIC'
+    assert ds.variables['data'].getncattr('Unhidden') == 'test'
+    ds.close()
+
+def test_nc2nc_parallel_error(monkeypatch):
+    h5py = pytest.importorskip('h5py')
+
+    class FailingID(object):
+        def __init__(self, id): self._id = id
+        def __getattr__(self, name): return getattr(self._id, name)
+        def write_direct_chunk(self, offset, data): raise IOError('write failed')
+
+    class FailingDataset(object):
+        def __init__(self, dset): self._dset = dset
+        def __getattr__(self, name): return getattr(self._dset, name)
+        @property
+        def id(self): return FailingID(self._dset.id)
+
+    class FailingFile(h5py.File):
+        def __getitem__(self, name): return FailingDataset(super(FailingFile, self).__getitem__(name))
+
+    monkeypatch.setattr(nc2nc.h5py, 'File', FailingFile)
+    # More chunks in one copy buffer than are allowed in the pool at once. Exit,
+    # showing where, rather than hang
+    faulthandler.dump_traceback_later(120, exit=True)
+    try:
+        with pytest.raises(IOError):
+            nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.error.nc', clobber=True, chunksize=4, buffersize=1, numproc=2)
+    finally:
+        faulthandler.cancel_dump_traceback_later()
+
+def test_nc2nc_error(monkeypatch):
+
+    if not os.path.isdir('/proc/self/fd'): pytest.skip('Open files can only be counted on Linux')
+    def fail(*args): raise IOError('read failed')
+    monkeypatch.setattr(nc2nc, 'read_hyperslabs', fail)
+    nopen = len(os.listdir('/proc/self/fd'))
+    with pytest.raises(IOError):
+        nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.error.nc', clobber=True)
+    # Both files are closed
+    assert len(os.listdir('/proc/self/fd')) == nopen
+
 def test_nc2nc():
 
     # Compress the file we just made
@@ -96,6 +557,25 @@ def test_nc2nc():
     # test copy buffer
     nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.nc', clobber=True,verbose=False, buffersize=10)
 
+    # test copy buffer smaller than the variable, copied one chunk at a time
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.buffer.nc', clobber=True,verbose=True, buffersize=0)
+    ds = Dataset(ncfiles[0]+'2nc.buffer.nc')
+    ds_o = Dataset(ncfiles[0])
+    assert_array_equal(ds.variables['data'][:], ds_o.variables['data'][:])
+    ds.close()
+    ds_o.close()
+
+    # test reading ahead in a separate process
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.pipeline.nc', clobber=True,verbose=True, buffersize=0, pipeline=2)
+    ds = Dataset(ncfiles[0]+'2nc.pipeline.nc')
+    ds_o = Dataset(ncfiles[0])
+    assert_array_equal(ds.variables['data'][:], ds_o.variables['data'][:])
+    ds.close()
+    ds_o.close()
+
+    # test setting the chunk cache size
+    nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc.nc', clobber=True,verbose=True, buffersize=0, chunkcache=1)
+
     # quantise the variable to 1 dp
     nc2nc.nc2nc(ncfiles[0], ncfiles[0]+'2nc_quantised.nc', clobber=True, lsd_dict = {'data':1})
 
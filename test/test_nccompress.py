@@ -13,16 +13,21 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import pytest
 import imp
 from netCDF4 import Dataset
 from numpy import array, arange, dtype
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 import sys
 import os
+import shutil
+import json
+import io
+import time
 from utils import make_simple_netcdf_file, remove_ncfiles, which
 import pdb
 
-from nccompress import nccompress
+from nccompress import nccompress, nc2nc
 
 verbose = True
 
@@ -41,6 +46,24 @@ def teardown_module(module):
     if verbose: print ("teardown_module   module:%s" % module.__name__)
     remove_ncfiles(verbose)
 
+@pytest.fixture
+def tree(request):
+    """ Path of a directory named after the test, which is removed after the test
+    """
+    tree = os.path.abspath(request.node.name.replace('test_', 'nccompress_', 1))
+    if os.path.exists(tree): shutil.rmtree(tree)
+    yield tree
+    if os.path.exists(tree): shutil.rmtree(tree)
+
+def make_tree(tree, files=('f1.nc', 'f2.nc')):
+    """ Copy the netCDF4 classic test file to each of files, relative to tree. nc2nc
+        only compresses classic files
+    """
+    for file in files:
+        path = os.path.join(tree, file)
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        shutil.copy('simple_xy.nc', path)
+
 def test_are_equal():
     assert nccompress.are_equal('simple_xy.nc','simple_xy.nc',verbose=True)
 
@@ -64,8 +87,8 @@ def test_run_compress():
     assert retdict['shuffle']
     assert nccompress.are_equal('simple_xy_noclassic.nc','simple_xy_noclassic.run_nccopy.nc',verbose=True)
 
-    # This requires nc2nc to be in the path. If nccompress/nc2nc.py has changed this will not be reflect
-    # any change until installation. This is a test for nccompres to correctly call nc2nc
+    # nc2nc is called in-process, so this tests the current nccompress/nc2nc.py rather
+    # than an installed nc2nc executable
     retdict = nccompress.run_compress('simple_xy.nc','simple_xy.run_nc2nc.nc',level=3,verbose=True,shuffle=True,nccopy=False,timing=False)
     print(retdict)
     assert (retdict['orig_size']/retdict['comp_size'] >= 5.)
@@ -76,6 +99,72 @@ def test_run_compress():
 
     assert nccompress.are_equal('simple_xy.run_nc2nc.nc','simple_xy.run_nccopy.nc',verbose=True)
 
+def test_run_nc2nc():
+
+    times = nccompress.run_nc2nc('simple_xy.nc','simple_xy.run_nc2nc_inprocess.nc',3,True,False,64,500)
+    assert len(times) == 4
+    assert times[0] >= 0.
+    assert nccompress.is_compressed('simple_xy.run_nc2nc_inprocess.nc')
+    # The output is not overwritten
+    with pytest.raises(IOError, match='Output file already exists'):
+        nccompress.run_nc2nc('simple_xy.nc','simple_xy.run_nc2nc_inprocess.nc',3,True,False,64,500)
+
+    retdict = nccompress.run_compress('simple_xy.nc','simple_xy.run_nc2nc_timing.nc',level=3,verbose=False,shuffle=True,nccopy=False,timing=True)
+    assert retdict['engine'] == 'nc2nc'
+    assert not retdict['error']
+    assert retdict['times'][0] >= 0.
+    assert retdict['stats']['variables']['data']['write'] > 0.
+    assert retdict['stats']['bytes_out'] == retdict['comp_size']
+
+def test_run_compress_skipped():
+
+    # Files are probed in run_compress, and skipped if they can't be compressed
+    retdict = nccompress.run_compress('tmp.txt','tmp.run_compress_skipped.txt')
+    assert retdict['skipped'] == 'Not a netCDF file'
+    assert not retdict['error']
+    assert not os.path.exists('tmp.run_compress_skipped.txt')
+
+    nccompress.run_compress('simple_xy.nc','simple_xy.run_compress_skipped.nc',level=3)
+    retdict = nccompress.run_compress('simple_xy.run_compress_skipped.nc','simple_xy.run_compress_skipped2.nc')
+    assert retdict['skipped'] == 'Already compressed'
+    assert retdict['format'] == 'NETCDF4_CLASSIC'
+    assert retdict['compressed']
+    assert not os.path.exists('simple_xy.run_compress_skipped2.nc')
+
+    retdict = nccompress.run_compress('simple_xy.run_compress_skipped.nc','simple_xy.run_compress_skipped2.nc',level=3,force=True)
+    assert not retdict['skipped']
+    assert not retdict['error']
+
+def test_run_compress_manifest():
+
+    shutil.copy('simple_xy.nc','simple_xy.manifest.nc')
+    # Paranoid check uses the digests computed while compressing
+    retdict = nccompress.run_compress('simple_xy.manifest.nc','simple_xy.manifest.tmp.nc',level=3,paranoid=True,
+                                      overwrite=True,maxcompress=0,manifest=True)
+    assert not retdict['error']
+    assert not os.path.exists('simple_xy.manifest.tmp.nc' + nccompress.manifest_suffix)
+    digests = nc2nc.read_manifest('simple_xy.manifest.nc' + nccompress.manifest_suffix)
+    assert nc2nc.verify_digests('simple_xy.manifest.nc', digests)
+    os.remove('simple_xy.manifest.nc' + nccompress.manifest_suffix)
+
+def test_run_compress_sample():
+
+    retdict = nccompress.run_compress('simple_xy.nc','simple_xy.sample.tmp.nc',level=3,sample=0.1)
+    assert not retdict['error']
+    compared, total = retdict['verified_values']
+    assert total == 120*600
+    assert 0 < compared < total
+
+def test_run_compress_auto():
+
+    retdict = nccompress.run_compress('simple_xy.nc','simple_xy.auto.tmp.nc',level='auto',timing=True)
+    assert not retdict['error']
+    assert retdict['dlevel'] == 'auto'
+    record = nccompress.report_record(retdict)
+    assert record['deflate']['data']['dlevel'] in nc2nc.trial_levels
+    assert nccompress.parse_args(['-d','auto','simple_xy.nc']).dlevel == 'auto'
+    assert nccompress.parse_args(['--chunking','1,0','simple_xy.nc']).chunking == (1.,0.)
+
 def test_is_netCDF():
     assert nccompress.is_netCDF('simple_xy.nc')
     assert nccompress.is_netCDF('simple_xy.run_nc2nc.nc')
@@ -101,6 +190,264 @@ def test_compress_files():
 
     assert nccompress.are_equal('simple_xy.nc','tmp.nc_compress/simple_xy.nc',verbose=True)
 
+def test_compress_directories(tree):
+
+    directories = [os.path.join(tree, directory) for directory in ['a', 'b', 'b/c']]
+    make_tree(tree, [os.path.join(directory, 'f1.nc') for directory in ['a', 'b', 'b/c']])
+
+    nccompress.main_parse_args(['-r', '-o', '-m', '0', '-np', '2', tree])
+
+    for directory in directories:
+        # Temporary directory is removed when the last file in the directory is compressed
+        assert not os.path.exists(os.path.join(directory, 'tmp.nc_compress'))
+        assert nccompress.is_netCDF(os.path.join(directory, 'f1.nc')) == ('NETCDF4_CLASSIC', True)
+
+def test_compress_shared_tmpdir(tree):
+
+    # An absolute tmpdir is shared by all directories, and cleaning it for
+    # the second directory must not remove files compressed from the first
+    make_tree(tree, ['a/f1.nc', 'b/f2.nc'])
+    tmpdir = os.path.join(tree, 'tmp')
+
+    def directories():
+        yield os.path.join(tree, 'a'), ['f1.nc']
+        # Only find the second directory once the first file is compressed
+        for i in range(100):
+            if os.path.exists(os.path.join(nccompress.temporary_directory(os.path.join(tree, 'a'), tmpdir), 'f1.nc')): break
+            time.sleep(0.1)
+        yield os.path.join(tree, 'b'), ['f2.nc']
+
+    nccompress.compress_files(directories(), tmpdir, False, 0, 5, True, False, True,
+                              False, 64, 500, False, False, 1, False)
+
+    for directory, file in [('a', 'f1.nc'), ('b', 'f2.nc')]:
+        assert os.path.isfile(os.path.join(nccompress.temporary_directory(os.path.join(tree, directory), tmpdir), file))
+
+def test_compress_shared_tmpdir_same_names(tree):
+
+    # Files with the same name in different directories are compressed at the same
+    # time into a shared tmpdir
+    make_tree(tree, ['a/f1.nc', 'b/f1.nc', 'c/f1.nc', 'd/f1.nc'])
+    tmpdir = os.path.join(tree, 'tmp')
+
+    nccompress.main_parse_args(['-r', '-o', '-m', '0', '-np', '4', '-t', tmpdir, tree])
+
+    for directory in ['a', 'b', 'c', 'd']:
+        assert nccompress.is_netCDF(os.path.join(tree, directory, 'f1.nc')) == ('NETCDF4_CLASSIC', True)
+        assert not os.path.exists(nccompress.temporary_directory(os.path.join(tree, directory), tmpdir))
+
+def test_compress_duplicates(tree, capsys):
+
+    make_tree(tree, ['f1.nc'])
+    infile = os.path.join(tree, 'f1.nc')
+
+    nccompress.main_parse_args(['-v', '-o', '-m', '0', infile, infile])
+
+    out = capsys.readouterr().out
+    assert 'has already been found: skipping' in out
+    assert out.count('Directory: ') == 1
+    assert 'Number files compressed: 1' in out
+    assert nccompress.is_netCDF(infile) == ('NETCDF4_CLASSIC', True)
+
+def test_makespan():
+
+    assert nccompress.makespan([], 2) == 0.
+    assert nccompress.makespan([1., 1., 4.], 2) == 5.
+    # Largest first
+    assert nccompress.makespan([4., 1., 1.], 2) == 4.
+
+def test_predict_schedule():
+
+    costs = {'a' : 1., 'b' : 1., 'c' : 4.}
+    # Submitted largest first, found in directory order
+    assert nccompress.predict_schedule([(2, 'c'), (0, 'a'), (1, 'b')], costs, 2) == (4., 5.)
+    # Costs converted to seconds by the time taken per unit of cost
+    rate = nccompress.calibrate_costs(costs, {'a' : 1., 'c' : 4.})
+    assert rate == 1.
+    assert nccompress.predict_schedule([(2, 'c'), (0, 'a'), (1, 'b')], costs, 2, rate=2.) == (8., 10.)
+    # Nothing compressed
+    assert nccompress.calibrate_costs(costs, {}) is None
+
+def test_compress_largest(tree, capsys):
+
+    make_tree(tree)
+    nccompress.main_parse_args(['-o', '-m', '0', '-np', '2', '--schedule', 'largest', tree])
+
+    for file in ['f1.nc', 'f2.nc']:
+        assert nccompress.is_netCDF(os.path.join(tree, file)) == ('NETCDF4_CLASSIC', True)
+    out = capsys.readouterr().out
+    assert 'Predicted makespan' in out and ' s (directory order: ' in out
+
+def test_plan_memory():
+
+    assert nccompress.plan_memory('missing.nc', 1024**2, 4, 500, None) == (0, 500)
+    assert nccompress.plan_memory('tmp.txt', 1024**2, 4, 500, None) == (0, 500)
+    # Estimated by nc2nc from the variables in the header
+    ncfile = Dataset('simple_xy.nc')
+    expected = nc2nc.estimate_memory(ncfile, 4, 500)
+    ncfile.close()
+    assert nccompress.plan_memory('simple_xy.nc', 1024**3, 4, 500, None) == (expected, 500)
+    # nccopy holds a copy buffer, or all the data if that is smaller
+    assert nccompress.plan_memory('simple_xy.nc', 1024**3, 4, 500, None, nccopy=True) == (120*600*4, 500)
+    assert nccompress.plan_memory('simple_xy_noclassic.nc', 1024**3, 4, 500, None) == (120*600*4, 500)
+    # Compressed files are skipped, unless forced
+    nc2nc.nc2nc('simple_xy.nc', 'simple_xy.plan.nc', chunksize=4, clobber=True)
+    assert nccompress.plan_memory('simple_xy.plan.nc', 1024**3, 4, 500, None) == (0, 500)
+    assert nccompress.plan_memory('simple_xy.plan.nc', 1024**3, 4, 500, None, force=True)[0] > 0
+
+    # Copy buffer is halved, in whole MiB, until the estimate fits
+    big = 'simple_xy.big.nc'
+    ncfile = Dataset(big, 'w', format='NETCDF4_CLASSIC')
+    ncfile.createDimension('x', 2048)
+    ncfile.createDimension('y', 1024)
+    ncfile.createVariable('data', 'f4', ('x', 'y'))
+    ncfile.close()
+    memory, buffersize = nccompress.plan_memory(big, 8*1024**2, 4, 500, None)
+    assert memory <= 8*1024**2
+    assert 1 < buffersize < 500 and isinstance(buffersize, int)
+    # Never smaller than 1 MiB
+    memory, buffersize = nccompress.plan_memory(big, 1024, 4, 500, None)
+    assert buffersize == 1
+
+def test_compress_maxmemory(tree):
+
+    make_tree(tree)
+    # Budget is smaller than one file, so files are compressed one at a time
+    nccompress.main_parse_args(['-o', '-m', '0', '-np', '2', '-s', '4', '--max-memory', '1', tree])
+
+    for file in ['f1.nc', 'f2.nc']:
+        assert nccompress.is_netCDF(os.path.join(tree, file)) == ('NETCDF4_CLASSIC', True)
+
+def test_resume_journal(tree, capsys):
+
+    make_tree(tree)
+    tmpdir = os.path.join(tree, 'tmp.nc_compress')
+    journal = os.path.join(tmpdir, nccompress.journal_name)
+
+    nccompress.main_parse_args(['-m', '0', tree])
+    records = nccompress.read_journal(journal)
+    assert records['f1.nc']['state'] == 'committed'
+    assert records['f2.nc']['state'] == 'committed'
+
+    # Simulate a run that was interrupted while writing f2.nc, and a partly written record
+    with open(os.path.join(tmpdir, 'f2.nc'), 'w') as f: f.write('partial')
+    state = { 'infile' : os.path.join(tree, 'f2.nc'), 'key' : records['f2.nc']['key'] }
+    nccompress.write_journal(journal, state, 'started')
+    with open(journal, 'a') as f: f.write('{"file": "f2.nc", "sta')
+    assert nccompress.read_journal(journal)['f2.nc']['state'] == 'started'
+    capsys.readouterr()
+
+    # Completed output is used without being compared, and the unfinished output is deleted
+    records = nccompress.read_journal(journal)
+    retdict = nccompress.run_compress(os.path.join(tree, 'f1.nc'), os.path.join(tmpdir, 'f1.nc'), verbose=True, 
+                                      journal=journal, record=records['f1.nc'])
+    assert retdict['engine'] is None
+    assert not retdict['error']
+    retdict = nccompress.run_compress(os.path.join(tree, 'f2.nc'), os.path.join(tmpdir, 'f2.nc'), verbose=True,
+                                      journal=journal, record=records['f2.nc'])
+    assert retdict['engine'] == 'nc2nc'
+    assert not retdict['error']
+    out = capsys.readouterr().out
+    assert 'tmp.nc_compress/f1.nc was completed by a previous run' in out
+    assert 'tmp.nc_compress/f2.nc was not completed by a previous run' in out
+    assert nccompress.read_journal(journal)['f2.nc']['state'] == 'committed'
+
+    nccompress.main_parse_args(['-o', '-m', '0', tree])
+
+    for file in ['f1.nc', 'f2.nc']:
+        assert nccompress.is_netCDF(os.path.join(tree, file)) == ('NETCDF4_CLASSIC', True)
+    assert not os.path.exists(tmpdir)
+
+def test_resume_journal_paranoid(tree, monkeypatch):
+
+    make_tree(tree, ['f1.nc'])
+    tmpdir = os.path.join(tree, 'tmp.nc_compress')
+    journal = os.path.join(tmpdir, nccompress.journal_name)
+    infile, outfile = os.path.join(tree, 'f1.nc'), os.path.join(tmpdir, 'f1.nc')
+
+    # First run doesn't check the output
+    nccompress.main_parse_args(['-m', '0', tree])
+    record = nccompress.read_journal(journal)['f1.nc']
+    assert record['state'] == 'committed' and record['checked'] == 0.
+
+    calls = []
+    def are_equal(*args):
+        calls.append(args)
+        return True
+    monkeypatch.setattr(nccompress, 'are_equal', are_equal)
+
+    # Resumed with more checking than the first run did, so the output is checked
+    retdict = nccompress.run_compress(infile, outfile, paranoid=True, journal=journal, record=record)
+    assert not retdict['error']
+    assert len(calls) == 1
+    record = nccompress.read_journal(journal)['f1.nc']
+    assert record['state'] == 'committed' and record['checked'] == 1.
+
+    # but not again once it has been checked
+    retdict = nccompress.run_compress(infile, outfile, paranoid=True, journal=journal, record=record)
+    assert len(calls) == 1
+    retdict = nccompress.run_compress(infile, outfile, sample=0.5, journal=journal, record=record)
+    assert len(calls) == 1
+
+def test_compress_report(tree):
+
+    make_tree(tree, ['f1.nc'])
+    open(os.path.join(tree, 'f2.txt'), 'w').close()
+
+    nccompress.main_parse_args(['-o', '-m', '0', '--report', 'nccompress_report.jsonl', tree])
+
+    with open('nccompress_report.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    files = dict((os.path.basename(record['path']), record) for record in records if record['type'] == 'file')
+    assert files['f1.nc']['engine'] == 'nc2nc'
+    assert files['f1.nc']['dlevel'] == 5
+    assert files['f1.nc']['ratio'] > 1.
+    assert files['f1.nc']['chunking']['data'] is not None
+    assert files['f1.nc']['timings']['variables']['data']['write'] > 0.
+    assert files['f1.nc']['touched']['data'] >= 1.
+    assert files['f2.txt']['skipped'] == 'Not a netCDF file'
+    summary = records[-1]
+    assert summary['type'] == 'summary'
+    assert summary['files'] == 2
+    assert summary['compressed'] == 1
+    assert summary['skipped'] == 1
+    assert summary['total_size_old'] == files['f1.nc']['orig_size']
+    assert summary['plan_cache_hits'] == len([record for record in files.values() if record['plan_cache']])
+
+    # A copy which failed part way through has no rate for its variables
+    partial = {'infile' : 'f3.nc', 'error' : 'Compression failed',
+               'stats' : {'variables' : {'data' : {'chunks' : [20, 100], 'read' : 0., 'write' : 0.}}}}
+    assert nccompress.report_record(partial)['timings']['variables']['data']['rate'] is None
+
+    os.remove('nccompress_report.jsonl')
+
+def test_format_rate():
+
+    assert nccompress.format_rate(12.34) == '12.3 MB/s'
+    assert nccompress.format_rate(None) == '- MB/s'
+
+def test_show_progress():
+
+    stream = io.StringIO()
+    progress = nccompress.new_progress(60., stream)
+    assert not progress['tty']
+    progress['files_found'] = 4
+    progress['bytes_found'] = 4000000
+    progress['files_done'] = 1
+    progress['bytes_done'] = 1000000
+    progress['size_old'] = 1000000
+    progress['size_new'] = 250000
+    progress['window'].append((time.time(), 1000000))
+    nccompress.show_progress(progress)
+    # Not shown again until the interval has passed
+    nccompress.show_progress(progress)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith('Files 1/4 Bytes 1.0/4.0 MB')
+    assert 'Ratio 4.00 ETA' in lines[0]
+    nccompress.show_progress(progress, final=True)
+    assert 'Elapsed' in stream.getvalue().splitlines()[-1]
+
 def test_compress_nonnetcdf():
 
     assert not nccompress.main_parse_args(['-v','-p','tmp.txt'])
@@ -36,12 +36,6 @@ def teardown_module(module):
 
 def test_nccopy():
 
-    if which('cdo') is None:
-        print("Could not find cdo in path")
-        assert(False)
-    else:
-        print(which('cdo'))
-
     if which('nccopy') is None:
         print("Could not find nccopy in path")
         assert(False)
@@ -61,8 +55,8 @@ def test_nccopy():
         pass
 
 
-    # Use a function from nccompress which calls cdo diffn. First test it with
-    # the same file
+    # Use a function from nccompress which compares the files in-process. First
+    # test it with the same file
     assert nccompress.are_equal('simple_xy.nc','simple_xy.nc',verbose=True)
 
     assert nccompress.are_equal('simple_xy.nc','simple_xy.nccopy.nc',verbose=True)
@@ -24,6 +24,7 @@ from utils import make_simple_netcdf_file, remove_ncfiles
 from nccompress import ncfind, nc2nc
 
 from glob import glob
+import shutil
 
 verbose = True
 
@@ -75,3 +76,99 @@ def test_find():
     assert(found == files[-1:])
 
 
+
+def test_sniff_format():
+
+    for format in ['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT_DATA']:
+        ncfile = 'simple_{}.nc'.format(format)
+        Dataset(ncfile,'w',format=format).close()
+        assert ncfind.sniff_format(ncfile) == format
+        assert ncfind.is_netCDF_compressed(ncfile) == (True, False)
+
+    assert ncfind.sniff_format(ncfiles[0]) == 'HDF5'
+    assert ncfind.sniff_format(ncfiles[1]) == 'HDF5'
+
+    # HDF5 superblock after a user block
+    with open(ncfiles[0],'rb') as fh:
+        data = fh.read()
+    with open('userblock.nc','wb') as fh:
+        fh.write(b'\0'*1024)
+        fh.write(data)
+    assert ncfind.sniff_format('userblock.nc') == 'HDF5'
+
+    with open('notnetcdf.nc','w') as fh:
+        fh.write('CDF but not netCDF'*100)
+    assert ncfind.sniff_format('notnetcdf.nc') is None
+    assert ncfind.is_netCDF_compressed('notnetcdf.nc') == (False, False)
+
+    assert ncfind.sniff_format('doesnotexist.nc') is None
+
+def test_index():
+
+    arguments = ['-i', 'index.db']
+    arguments.extend(ncfiles + [ncfiles[0]+'2nc.nc'])
+    args = ncfind.parse_args(arguments)
+    found = ncfind.find_files(args)
+    assert len(found) == 3
+
+    index = ncfind.ScanIndex('index.db')
+    assert index.lookup(ncfiles[0]) == ('NETCDF4_CLASSIC', False)
+    assert index.lookup(ncfiles[1]) == ('NETCDF4', False)
+    assert index.lookup(ncfiles[0]+'2nc.nc') == ('NETCDF4_CLASSIC', True)
+
+    # Unchanged files are not probed again
+    index.update(ncfiles[0], 'NETCDF4_CLASSIC', True)
+    assert index.probe(ncfiles[0]) == ('NETCDF4_CLASSIC', True)
+    index.close()
+
+    args = ncfind.parse_args(['-i', 'index.db', '-c', ncfiles[0]])
+    assert [os.path.normpath(file) for file in ncfind.find_files(args)] == [ncfiles[0]]
+
+    # Changed files are probed again
+    os.utime(ncfiles[0], ns=(0, 0))
+    args = ncfind.parse_args(['-i', 'index.db', '-c', ncfiles[0]])
+    assert ncfind.find_files(args) == []
+
+    os.remove('index.db')
+
+def test_find_parallel():
+
+    tree = 'ncfind_tree'
+    for directory in ['b', 'a/y', 'a/x', 'c']:
+        os.makedirs(os.path.join(tree, directory))
+        make_simple_netcdf_file([os.path.join(tree, directory, file) for file in ['f2.nc', 'f1.nc']])
+        with open(os.path.join(tree, directory, 'notnetcdf.txt'), 'w') as fh:
+            fh.write('not a netCDF file')
+
+    # Same order as os.walk
+    expected = [os.path.join(root, file) for root, dirs, files in os.walk(tree)
+                for file in files if file.endswith('.nc')]
+
+    args = ncfind.parse_args(['-r', tree])
+    assert ncfind.find_files(args) == expected
+
+    args = ncfind.parse_args(['-r', '-j', '3', tree])
+    assert ncfind.find_files(args) == expected
+
+    args = ncfind.parse_args(['-r', '-j', '3', '--sort', tree])
+    assert ncfind.find_files(args) == sorted(expected)
+
+    # Not recursive, only files in the top directory
+    args = ncfind.parse_args(['-j', '2', os.path.join(tree, 'a')])
+    assert ncfind.find_files(args) == []
+
+    shutil.rmtree(tree)
+
+def test_iter_files(capsys):
+
+    args = ncfind.parse_args(['-u'] + ncfiles)
+    found = ncfind.iter_files(args)
+    # Results are available before all inputs are classified
+    assert os.path.normpath(next(found)) == ncfiles[0]
+    assert os.path.normpath(next(found)) == ncfiles[1]
+    with pytest.raises(StopIteration):
+        next(found)
+
+    ncfind.main_parse_args(['-0', '-u'] + ncfiles)
+    out, err = capsys.readouterr()
+    assert [os.path.normpath(file) for file in out.split('\0')[:-1]] == ncfiles